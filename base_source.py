@@ -1,19 +1,24 @@
-import bz2
-import gzip
+import copy
 import json
 import logging
 import os
-import re
 import shutil
-import tempfile
-import zipfile
 
-from urlparse import urljoin, urlsplit
+from urlparse import urljoin
 
 import click
-import requests
 
-from data_retrieval.files import copy_file_to_s3
+from data_retrieval import sessions
+from data_retrieval.bgzf import BgzfVCFWriter
+from data_retrieval.bz2_parallel import ParallelBZ2File
+from data_retrieval.decompress import ArchiveError, LineReader
+from data_retrieval.download import Download
+from data_retrieval.metrics import metrics_recorder
+from data_retrieval.files import (LOCAL_PREFIX, StreamUploader,
+                                  copy_file_to_s3, file_digest)
+from data_retrieval.scratch import scratch_manager
+from data_retrieval.stream_validation import IncompleteValidation
+from data_retrieval.upload_queue import UploadError, UploadQueue
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +30,21 @@ DEBUG = False if DEBUG_ENV and DEBUG_ENV.lower() == 'false' else True
 # be set in the environment on both sides
 PRE_SHARED_KEY = os.getenv('PRE_SHARED_KEY')
 
+# Compression for generated VCF files: 'bz2' (.vcf.bz2) or 'bgzip' (BGZF
+# compressed .vcf.gz with a .vcf.gz.tbi tabix index)
+VCF_FORMATS = ['bz2', 'bgzip']
+VCF_FORMAT = os.getenv('VCF_FORMAT', 'bz2')
+
+# Kinds of work a source does, each run from its own queue by its own kind of
+# worker (see Procfile): 'cpu' for converting and compressing large files,
+# 'download' for moving large files, and 'api' for many small, often rate
+# limited, API requests.
+COST_CLASSES = ['cpu', 'download', 'api']
+
+# Metadata that may differ between a new output and the current data file it
+# is identical to.
+UNCHANGED_METADATA_IGNORED = ['content_digest', 'creation_date']
+
 
 class BaseSource(object):
     """
@@ -39,17 +59,24 @@ class BaseSource(object):
         s3_bucket_name: S3 bucket to write resulting file.
         s3_key_dir: S3 key "directory" to write resulting file. The full S3 key
                     name will add a filename to the end of s3_key_dir.
+        vcf_format: 'bz2' or 'bgzip', the format of generated VCF files.
+                    Defaults to the VCF_FORMAT environment variable.
+        task_lock: The TaskLock of the task running the source, if any; files
+                   aren't uploaded if a newer request has superseded it.
 
     Either 'output_directory' (and no S3 arguments), or both S3 arguments (and
     no 'output_directory') must be specified.
     """
 
+    # One of COST_CLASSES, which decides the queue the source's tasks run in.
+    cost_class = 'cpu'
+
     def __init__(self, access_token=None, file_url=None, force=False,
                  input_file=None, local=False,
                  oh_base_url='https://www.openhumans.org/data-import/',
                  oh_user_id=None, oh_username=None, output_directory=None,
                  return_status=None, s3_bucket_name=None, s3_key_dir=None,
-                 sentry=None, **kwargs):
+                 sentry=None, task_lock=None, vcf_format=None, **kwargs):
         self.access_token = access_token
         self.file_url = file_url
         self.force = force
@@ -63,10 +90,42 @@ class BaseSource(object):
         self.s3_bucket_name = s3_bucket_name
         self.s3_key_dir = s3_key_dir
         self.sentry = sentry
+        self.task_lock = task_lock
+        self.vcf_format = vcf_format or VCF_FORMAT
 
         self.temp_files = []
         self.data_files = []
-        self.temp_directory = tempfile.mkdtemp()
+        # IDs of current data files that new output was identical to.
+        self.unchanged_file_ids = []
+        self.download_stats = []
+        self.upload_queue = UploadQueue()
+
+        # Created when first used; see data_retrieval.scratch.
+        self._scratch = None
+
+        # Open Humans GET responses for this run, by URL and query; cleared
+        # whenever we POST changes.
+        self.open_humans_cache = {}
+
+    @property
+    def scratch(self):
+        if self._scratch is None:
+            self._scratch = scratch_manager().create()
+
+        return self._scratch
+
+    def stage_timer(self, stage):
+        """
+        Time a stage of the run, for data_retrieval.metrics.
+        """
+        return metrics_recorder().timer(stage, source=self.source)
+
+    def count_metric(self, name, value=1):
+        metrics_recorder().count(name, value, source=self.source)
+
+    @property
+    def temp_directory(self):
+        return self.scratch.directory
 
     @property
     def files_url(self):
@@ -90,6 +149,27 @@ class BaseSource(object):
             data={'user_id': self.oh_user_id, 'source': self.source},
             method='get')['results']
 
+    def unchanged_file(self, filename, metadata):
+        """
+        Return the current data file with the same name, content digest and
+        other metadata (except UNCHANGED_METADATA_IGNORED) as a new output,
+        or None.
+        """
+        def compared(metadata):
+            return dict((key, value) for key, value in metadata.items()
+                        if key not in UNCHANGED_METADATA_IGNORED)
+
+        for data_file in self.get_current_files():
+            current_metadata = data_file.get('metadata') or {}
+
+            if (data_file['basename'] == filename and
+                    current_metadata.get('content_digest') ==
+                    metadata['content_digest'] and
+                    compared(current_metadata) == compared(metadata)):
+                return data_file
+
+        return None
+
     def archive_files(self):
         """
         The default implementation overrides all files; can be overridden by
@@ -98,7 +178,12 @@ class BaseSource(object):
         self.archive_current_files()
 
     def archive_current_files(self):
-        current_files = self.get_current_files()
+        """
+        Archive the current data files, except those new output was
+        identical to.
+        """
+        current_files = [data_file for data_file in self.get_current_files()
+                         if data_file['id'] not in self.unchanged_file_ids]
 
         if not current_files:
             logger.info('no files to archive')
@@ -140,28 +225,40 @@ class BaseSource(object):
                 self.get_remote_file(self.file_url))
 
     def open_archive(self):
+        """
+        Open the input file for reading lines, decompressing it if needed.
+        The format is detected from its contents; see
+        data_retrieval.decompress.
+        """
         error_message = ("Input file is expected to be either '.txt', "
-                         "'.txt.gz', '.txt.bz2', or a single '.txt' file in a "
-                         "'.zip' ZIP archive.")
+                         "'.txt.gz', '.txt.bz2', '.txt.xz', or a single "
+                         "'.txt' file in a '.zip' ZIP archive.")
+
+        try:
+            with self.stage_timer('open_archive'):
+                reader = LineReader(self.input_file)
+        except ArchiveError:
+            self.sentry_log(error_message)
+            raise ValueError(error_message)
 
-        if self.input_file.endswith('.zip'):
-            zip_file = zipfile.ZipFile(self.input_file)
-            zip_files = self.filter_archive(zip_file)
+        self.count_metric('input_bytes', os.path.getsize(self.input_file))
 
-            if len(zip_files) != 1:
-                self.sentry_log(error_message)
-                raise ValueError(error_message)
+        return reader
 
-            return zip_file.open(zip_files[0])
-        elif self.input_file.endswith('.txt.gz'):
-            return gzip.open(self.input_file)
-        elif self.input_file.endswith('.txt.bz2'):
-            return bz2.BZ2File(self.input_file)
-        elif self.input_file.endswith('.txt'):
-            return open(self.input_file)
+    def read_header_line(self, input_file):
+        """
+        Return the next line of an input file opened with open_archive, which
+        should be there. If the file ends instead, log it and raise
+        ValueError, so an empty or header-only file fails the run rather than
+        replacing the member's data with empty output.
+        """
+        try:
+            return input_file.next()
+        except StopIteration:
+            error_message = 'Input file ended before the expected data.'
 
-        self.sentry_log(error_message)
-        raise ValueError(error_message)
+            self.sentry_log(error_message)
+            raise ValueError(error_message)
 
     @staticmethod
     def filter_archive(zip_file):
@@ -176,50 +273,190 @@ class BaseSource(object):
         if self.sentry:
             self.sentry.captureMessage(message)
 
-    def temp_join(self, path):
-        return os.path.join(self.temp_directory, path)
+    def temp_join(self, path, small=False):
+        """
+        Return the path of a temp file. Pass small=True when first creating
+        a file known to be small (such as JSON metadata, and at most
+        data_retrieval.scratch.SMALL_FILE_SIZE) to let it be kept in the
+        RAM-backed scratch tier.
+        """
+        return self.scratch.join(path, small=small)
 
-    def get_remote_file(self, url):
+    def open_vcf(self, filename_base):
         """
-        Get and save a remote file to temporary directory. Return filename
-        used.
+        Open a temp file for writing VCF data in the configured format. Return
+        the filename used and the file object.
+        """
+        if self.vcf_format not in VCF_FORMATS:
+            raise ValueError('Unknown VCF format "{}"'.format(self.vcf_format))
+
+        if self.vcf_format == 'bgzip':
+            filename = filename_base + '.vcf.gz'
+
+            return filename, BgzfVCFWriter(self.temp_join(filename))
+
+        filename = filename_base + '.vcf.bz2'
+
+        return filename, ParallelBZ2File(self.temp_join(filename))
+
+    def add_vcf_temp_files(self, filename, vcf_file, metadata):
+        """
+        Add a closed VCF temp file with add_temp_file, along with its tabix
+        index if one was written.
+        """
+        self.add_temp_file(filename, metadata)
+
+        if getattr(vcf_file, 'lines_written', None) is not None:
+            self.count_metric('vcf_rows', vcf_file.lines_written)
+
+        index_filename = getattr(vcf_file, 'index_filename', None)
+
+        if not index_filename:
+            return
+
+        index_metadata = dict(metadata)
+        index_metadata['description'] = (
+            metadata['description'] + ', tabix index')
+        index_metadata['tags'] = metadata['tags'] + ['tabix']
+
+        self.add_temp_file(os.path.basename(index_filename), index_metadata)
+
+    def get_remote_file(self, url, verifier=None, directory=None):
+        """
+        Get and save a remote file to temporary directory, or to directory
+        if given. Return filename used.
+
+        Large files are downloaded in parallel parts where the server allows,
+        and interrupted downloads are retried and resumed; see
+        data_retrieval.download.
+
+        If a verifier is given its start() method is called with the filename,
+        feed() with each chunk as it's downloaded and finish() at the end. If
+        any of them raise, the download is aborted and the partial file
+        deleted before the exception is re-raised.
         """
         logger.info('get_remote_file: retrieving "%s"', url)
-        logger.info('get_remote_file: using temporary directory "%s"', url)
+        logger.info('get_remote_file: using temporary directory "%s"',
+                    self.temp_directory)
+
+        with self.stage_timer('download'):
+            download = Download(url, directory or self.temp_directory,
+                                verifier=verifier)
+            download.open()
+
+            return self.save_download(download)
 
-        # start a GET request but don't retrieve the data; we'll start
-        # retrieval below
-        request = requests.get(url, stream=True)
+    def save_download(self, download):
+        """
+        Save an opened Download to the temporary directory, if it fits in the
+        scratch space budget (otherwise data_retrieval.scratch's
+        ScratchSpaceError is raised). Return the filename used.
+        """
+        try:
+            with self.scratch.admission(download.size, download.path):
+                filename = download.save()
+        finally:
+            download.close()
 
-        if request.status_code != 200:
-            raise Exception('File URL not working! Data processing aborted: {}'
-                            .format(url))
+        self.download_stats.append(download.stats)
+        self.count_metric('download_bytes', download.stats.size)
 
-        specified_filename = ''
+        return filename
 
-        # try to retrieve the filename via the 'Content-Disposition' filename
-        # header
-        if 'Content-Disposition' in request.headers:
-            filename = re.match(r'attachment; filename="(.*)"$',
-                                request.headers['Content-Disposition'])
+    def passthrough_remote_file(self, url, destination, validator=None):
+        """
+        Copy a remote file straight to S3 (or the output directory, if local)
+        as it downloads, without storing it in the temporary directory.
+
+        destination is called with the remote file's filename and returns the
+        filename and metadata to store it as, or None to instead download it
+        to the temporary directory as get_remote_file does. validator works as
+        get_remote_file's verifier; if it raises, the upload is cancelled. If
+        it raises IncompleteValidation (it couldn't check the file from what
+        it kept) the file is downloaded again, checked in full and added as a
+        temp file; see add_checked_remote_file.
+
+        Return the filename used in the temporary directory if destination
+        returned None, otherwise None.
+        """
+        logger.info('passthrough_remote_file: retrieving "%s"', url)
 
-            if filename:
-                specified_filename = filename.groups()[0]
+        download = Download(url, self.temp_directory, verifier=validator)
 
-        # if that header isn't sent then use the last portion of the URL as the
-        # filename ('https://test.com/hello/world.zip' becomes 'world.zip')
-        if not specified_filename:
-            specified_filename = urlsplit(request.url)[2].split('/')[-1]
+        # The response must be closed however we finish, or its pooled
+        # connection is never returned (see data_retrieval.sessions).
+        try:
+            target = destination(download.open())
+
+            if target is None:
+                with self.stage_timer('download'):
+                    return self.save_download(download)
+
+            filename, metadata = target
+
+            self.stream_remote_file(url, download, filename, metadata,
+                                    validator)
+        finally:
+            download.close()
+
+        return None
+
+    def stream_remote_file(self, url, download, filename, metadata,
+                           validator=None):
+        """
+        Copy an opened Download straight to S3 (or the output directory, if
+        local) as filename; see passthrough_remote_file.
+        """
+        if self.local:
+            bucket = LOCAL_PREFIX + os.path.abspath(self.output_directory)
+            keypath = filename
+        else:
+            bucket = self.s3_bucket_name
+            keypath = os.path.join(self.s3_key_dir, filename)
 
-        logger.info('get_remote_file: filename "%s"', specified_filename)
+        logger.info('passthrough_remote_file: copying to "%s"', keypath)
 
-        with open(self.temp_join(specified_filename), 'wb') as temp_file:
-            # write each streamed chunk to the temporary file
-            for chunk in request.iter_content(chunk_size=512 * 1024):
-                if chunk:
-                    temp_file.write(chunk)
+        uploader = StreamUploader(bucket, keypath, size=download.size)
 
-        return specified_filename
+        try:
+            with self.stage_timer('passthrough'):
+                download.stream_to(uploader)
+                uploader.close()
+        except IncompleteValidation as e:
+            uploader.abort()
+
+            logger.info('passthrough_remote_file: %s, checking it in full', e)
+
+            self.add_checked_remote_file(url, filename, metadata, validator)
+
+            return
+        except Exception:
+            uploader.abort()
+
+            raise
+
+        self.download_stats.append(download.stats)
+        self.count_metric('download_bytes', download.stats.size)
+        self.count_metric('upload_bytes', download.stats.size)
+
+        if not self.local:
+            self.data_files.append({
+                's3_key': keypath,
+                'metadata': metadata,
+            })
+
+    def add_checked_remote_file(self, url, filename, metadata, validator):
+        """
+        Download a remote file to the temporary directory, check it with
+        validator.check_file and add it as a temp file named filename.
+        """
+        temp_filename = self.get_remote_file(url)
+
+        validator.check_file(self.temp_join(temp_filename))
+
+        os.rename(self.temp_join(temp_filename), self.temp_join(filename))
+
+        self.add_temp_file(filename, metadata)
 
     def should_update(self, files):
         """
@@ -229,46 +466,139 @@ class BaseSource(object):
         return True
 
     def move_file(self, filename):
-        shutil.move(os.path.join(self.temp_directory, filename),
+        shutil.move(self.temp_join(filename),
                     os.path.join(self.output_directory, filename))
 
     def move_file_s3(self, filename, metadata):
         """
         Copy a temp file to S3 or local permanent directory, then delete temp
-        copy.
+        copy. Return the data file to report to Open Humans.
+
+        The file's content digest is added to its metadata. If a current data
+        file has the same name, digest and other metadata (see
+        unchanged_file), it's kept instead: the copy is skipped, its ID is
+        added to unchanged_file_ids and None is returned.
         """
-        source = os.path.join(self.temp_directory, filename)
+        source = self.temp_join(filename)
         destination = os.path.join(self.s3_key_dir, filename)
 
-        copy_file_to_s3(bucket=self.s3_bucket_name,
-                        filepath=source,
-                        keypath=destination)
+        metadata = dict(metadata, content_digest=file_digest(source))
+        unchanged = self.unchanged_file(filename, metadata)
+
+        if unchanged:
+            logger.info('"%s" is unchanged, keeping data file %s', filename,
+                        unchanged['id'])
+
+            os.remove(source)
+            self.unchanged_file_ids.append(unchanged['id'])
+
+            return None
+
+        size = os.path.getsize(source)
+
+        with self.stage_timer('s3_upload'):
+            copy_file_to_s3(bucket=self.s3_bucket_name,
+                            filepath=source,
+                            keypath=destination)
+
+        self.count_metric('upload_bytes', size)
 
         os.remove(source)
 
-        self.data_files.append({
+        return {
             's3_key': destination,
             'metadata': metadata,
-        })
+        }
+
+    def queue_move(self, file_info):
+        """
+        Start moving a finished temp file to its destination in the
+        background.
+        """
+        filename = file_info['temp_filename']
+
+        if self.local:
+            self.upload_queue.put(filename, self.move_file, filename)
+        else:
+            self.upload_queue.put(filename, self.move_file_s3, filename,
+                                  file_info['metadata'])
+
+    def add_temp_file(self, filename, metadata):
+        """
+        Add a finished temp file to temp_files and start uploading it while
+        the source carries on. The file must not be changed or read again.
+
+        The upload isn't started if a newer request has superseded the task;
+        run then stops before uploading anything else. Sources that may
+        return a countdown to be requeued should add their files to
+        temp_files instead, so nothing is uploaded until they finish.
+        """
+        file_info = {
+            'temp_filename': filename,
+            'metadata': metadata,
+        }
+
+        self.temp_files.append(file_info)
+
+        if self.task_lock and not self.task_lock.extend():
+            logger.info('superseded by a newer request, not uploading "%s"',
+                        filename)
+
+            return
+
+        self.queue_move(file_info)
 
     def move_files(self):
+        """
+        Move every temp file not already queued by add_temp_file, and wait
+        for all of them to finish.
+        """
         for file_info in self.temp_files:
-            filename = file_info['temp_filename']
-
-            if self.local:
-                self.move_file(filename)
-            else:
-                self.move_file_s3(filename, file_info['metadata'])
+            if file_info['temp_filename'] not in self.upload_queue:
+                self.queue_move(file_info)
+
+        try:
+            # Only the time spent waiting for uploads started while the
+            # source was creating files.
+            with self.stage_timer('upload_wait'):
+                data_files = self.upload_queue.wait()
+        except UploadError as e:
+            for filename, error in e.failures:
+                self.sentry_log('Failed to upload "{}": {}'.format(filename,
+                                                                   error))
+
+            raise
+        finally:
+            self.clean_up()
+
+        self.data_files.extend(data_file for data_file in data_files
+                               if data_file)
+
+    def clean_up(self):
+        """
+        Remove the scratch space, once any queued uploads are done with it.
+        Safe to call more than once.
+        """
+        try:
+            self.upload_queue.wait()
+        except UploadError:
+            # Reported by move_files, or the run has failed already.
+            pass
 
-        shutil.rmtree(self.temp_directory)
+        if self._scratch:
+            self._scratch.close()
 
-    @staticmethod
-    def open_humans_request(data, url=None, method='get'):
+    def open_humans_request(self, data, url=None, method='get'):
+        """
+        Make a request to the Open Humans API. GET requests return the decoded
+        JSON and are only made once per run for the same URL and data; POST
+        requests return the response and clear the remembered GET responses,
+        since they change what Open Humans would return.
+        """
         args = {
             'params': {
                 'key': PRE_SHARED_KEY,
             },
-            'url': url,
         }
 
         if method == 'get' and data:
@@ -276,12 +606,21 @@ class BaseSource(object):
         elif method == 'post' and data:
             args['json'] = data
 
-        response = getattr(requests, method)(**args)
+        if method != 'get':
+            self.open_humans_cache.clear()
 
-        if method == 'get':
-            return response.json()
+            with self.stage_timer('open_humans_' + method):
+                return sessions.request(method, url, **args)
 
-        return response
+        cache_key = (url, json.dumps(data, sort_keys=True))
+
+        if cache_key not in self.open_humans_cache:
+            with self.stage_timer('open_humans_get'):
+                self.open_humans_cache[cache_key] = sessions.get(
+                    url, **args).json()
+
+        # Callers may change what they're given.
+        return copy.deepcopy(self.open_humans_cache[cache_key])
 
     def update_open_humans(self):
         task_data = {
@@ -298,26 +637,56 @@ class BaseSource(object):
                                  method='post')
 
     def run(self):
-        if not self.local:
-            self.update_parameters()
-
-        if not self.should_update(self.get_current_files()) and not self.force:
-            return
+        """
+        Run the source, recording the time taken by each stage and the
+        outcome (see data_retrieval.metrics).
+        """
+        outcome = 'failed'
 
-        self.coerce_file()
-        self.validate_parameters()
+        try:
+            with self.stage_timer('run'):
+                result = self._run()
 
-        result = self.create_files()
+            outcome = 'requeued' if result else 'completed'
 
-        # A result is only returned if we didn't successfully create files
-        if result:
             return result
+        finally:
+            self.count_metric('runs_' + outcome)
 
-        self.move_files()
+    def _run(self):
+        try:
+            if not self.local:
+                self.update_parameters()
 
-        if not self.local:
-            self.archive_files()
-            self.update_open_humans()
+            if (not self.should_update(self.get_current_files()) and
+                    not self.force):
+                return
+
+            self.coerce_file()
+            self.validate_parameters()
+
+            with self.stage_timer('create_files'):
+                result = self.create_files()
+
+            # A result is only returned if we didn't successfully create files
+            if result:
+                return result
+
+            # Don't upload over the files of the task that superseded us.
+            if self.task_lock and not self.task_lock.extend():
+                logger.info('superseded by a newer request, not uploading')
+
+                return
+
+            self.move_files()
+
+            if not self.local:
+                self.archive_files()
+                self.update_open_humans()
+        finally:
+            # Failed and requeued runs must not leave their files behind.
+            with self.stage_timer('clean_up'):
+                self.clean_up()
 
     def run_cli(self):
         self.run()
@@ -336,6 +705,7 @@ class BaseSource(object):
         @click.option('-d', '--oh-user-id')
         @click.option('-f', '--force', is_flag=True, default=False)
         @click.option('-l', '--local', is_flag=True, default=True)
+        @click.option('--vcf-format', type=click.Choice(VCF_FORMATS))
         def base_cli(**kwargs):
             logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO)
 
@@ -0,0 +1,55 @@
+"""
+Compare two sets of results from benchmarks.run_sources.
+
+Prints each benchmark's wall time and peak RSS before and after, and the
+ratio of after to before; below 1.0 is faster or smaller.
+
+Run from this project's base directory, e.g.
+
+    python -m benchmarks.compare before.json after.json
+"""
+import json
+import sys
+
+
+def load_results(path):
+    with open(path) as f:
+        data = json.load(f)
+
+    return data.get('commit'), {result['benchmark']: result
+                                for result in data['results']}
+
+
+def ratio(before, after, key):
+    if key not in before or key not in after or not before[key]:
+        return 'n/a'
+
+    return '{:.2f}'.format(after[key] / before[key])
+
+
+def main(before_path, after_path):
+    before_commit, before = load_results(before_path)
+    after_commit, after = load_results(after_path)
+
+    print 'before: {}\nafter:  {}\n'.format(before_commit, after_commit)
+
+    print '{:<20} {:>9} {:>9} {:>6} {:>9} {:>9} {:>6}'.format(
+        '', 'wall s', 'wall s', 'ratio', 'RSS MB', 'RSS MB', 'ratio')
+
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name], after[name]
+
+        if 'error' in old or 'error' in new:
+            print '{:<20} {}'.format(name, old.get('error') or
+                                     new.get('error'))
+
+            continue
+
+        print '{:<20} {:9.2f} {:9.2f} {:>6} {:9.1f} {:9.1f} {:>6}'.format(
+            name, old['wall_seconds'], new['wall_seconds'],
+            ratio(old, new, 'wall_seconds'), old['peak_rss_mb'],
+            new['peak_rss_mb'], ratio(old, new, 'peak_rss_mb'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,134 @@
+"""
+Benchmark reading lines from a synthetic 23andMe file in each container
+format.
+
+Compares the readers BaseSource.open_archive used to return (open,
+gzip.open, bz2.BZ2File and zipfile's ZipExtFile, picked by filename) against
+data_retrieval.decompress.LineReader, and checks that both read the same
+lines. The old readers don't support xz, so only the new one is timed for it.
+
+Run from this project's base directory, e.g.
+
+    python -m benchmarks.decompress 2000000
+"""
+import bz2
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from benchmarks.genotype_records import lines_23andme
+from data_retrieval.decompress import LineReader
+
+
+def make_synthetic_files(directory, snp_count):
+    """
+    Write a raw 23andMe file with snp_count lines in each container format.
+    Return a dict of paths by format.
+    """
+    data = '# This data file generated by 23andMe\r\n' + ''.join(
+        lines_23andme(snp_count))
+
+    paths = {'txt': os.path.join(directory, 'genome.txt')}
+
+    with open(paths['txt'], 'wb') as f:
+        f.write(data)
+
+    paths['gz'] = paths['txt'] + '.gz'
+
+    with gzip.open(paths['gz'], 'wb') as f:
+        f.write(data)
+
+    paths['bz2'] = paths['txt'] + '.bz2'
+
+    with open(paths['bz2'], 'wb') as f:
+        f.write(bz2.compress(data))
+
+    paths['zip'] = os.path.join(directory, 'genome.zip')
+
+    with zipfile.ZipFile(paths['zip'], 'w', zipfile.ZIP_DEFLATED) as f:
+        f.write(paths['txt'], 'genome.txt')
+
+    paths['xz'] = paths['txt'] + '.xz'
+
+    with open(paths['xz'], 'wb') as f:
+        subprocess.check_call(['xz', '--stdout', paths['txt']], stdout=f)
+
+    return paths
+
+
+def open_old(path):
+    """
+    The readers open_archive returned before data_retrieval.decompress.
+    """
+    if path.endswith('.zip'):
+        zip_file = zipfile.ZipFile(path)
+
+        return zip_file.open(zip_file.namelist()[0])
+    elif path.endswith('.gz'):
+        return gzip.open(path)
+    elif path.endswith('.bz2'):
+        return bz2.BZ2File(path)
+    elif path.endswith('.xz'):
+        return None
+
+    return open(path)
+
+
+def timed(lines):
+    """
+    Read every line, returning the seconds taken, line count and digest.
+    """
+    digest = hashlib.md5()
+    count = 0
+
+    start = time.time()
+
+    for line in lines:
+        digest.update(line)
+        count += 1
+
+    return time.time() - start, count, digest.hexdigest()
+
+
+def main(snp_count):
+    directory = tempfile.mkdtemp()
+
+    try:
+        paths = make_synthetic_files(directory, snp_count)
+
+        print '{:<5} {:>16} {:>16} {:>8}'.format('', 'old lines/s',
+                                                 'new lines/s', 'speedup')
+
+        for file_format in ['txt', 'gz', 'bz2', 'zip', 'xz']:
+            old_file = open_old(paths[file_format])
+
+            with LineReader(paths[file_format]) as new_file:
+                new_seconds, count, new_digest = timed(new_file)
+
+            if old_file is None:
+                print '{:<5} {:>16} {:16.0f} {:>8}'.format(
+                    file_format, 'n/a', count / new_seconds, 'n/a')
+
+                continue
+
+            old_seconds, old_count, old_digest = timed(old_file)
+            old_file.close()
+
+            assert (old_count, old_digest) == (count, new_digest), (
+                'Readers differ for {}'.format(file_format))
+
+            print '{:<5} {:16.0f} {:16.0f} {:7.1f}x'.format(
+                file_format, count / old_seconds, count / new_seconds,
+                old_seconds / new_seconds)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000000)
@@ -0,0 +1,187 @@
+"""
+A local stand-in for the remote services sources fetch from, for the source
+benchmarks.
+
+FakeAPIServer serves the files in a directory under /files/, and synthetic
+Fitbit, Moves, RunKeeper, PGP Harvard profile and Open Humans responses from
+benchmarks.synthetic, sized by the settings it's given. It counts the bytes
+it sends, so benchmarks of API sources can report throughput.
+
+The sources are pointed at it with their API URL environment variables, as
+benchmarks.run_sources does.
+"""
+import json
+import os
+import re
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import date, datetime, timedelta
+from urlparse import parse_qs, urlsplit
+
+from benchmarks import synthetic
+
+DEFAULT_SETTINGS = {
+    # Days since the Fitbit member joined.
+    'fitbit_days': 730,
+    # Weeks of Moves storyline before the API reports an error.
+    'moves_weeks': 52,
+    'moves_points_per_day': 200,
+    # RunKeeper fitness and background activities.
+    'runkeeper_activities': 500,
+    'runkeeper_points': 500,
+    # The var file (in the served directory) PGP profiles link to.
+    'pgp_var_file': 'var-GS000000000-ASM.tsv.bz2',
+}
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        (r'^/files/(?P<name>[^/]+)$', 'send_data_file'),
+        (r'^/data-import/data-files/$', 'send_open_humans_files'),
+        (r'^/fitbit/1/user/-/profile\.json$', 'send_fitbit_profile'),
+        (r'^/fitbit/1/user/[^/]+/(?P<name>.+?)'
+         r'(?:/date/(?P<start>[0-9-]+)/(?P<end>[0-9-]+))?\.json$',
+         'send_fitbit_series'),
+        (r'^/moves/api/1\.1/user/storyline/daily/'
+         r'(?P<year>[0-9]{4})-W(?P<week>[0-9]{2})$', 'send_moves_week'),
+        (r'^/runkeeper/user$', 'send_runkeeper_user'),
+        (r'^/runkeeper/fitnessActivities/(?P<index>[0-9]+)$',
+         'send_runkeeper_activity'),
+        (r'^/runkeeper/(?P<feed>fitnessActivities|backgroundActivities)$',
+         'send_runkeeper_items'),
+        (r'^/pgp/profile/(?P<hu_id>[^/]+)$', 'send_pgp_profile'),
+    ]
+
+    @property
+    def settings(self):
+        return self.server.settings
+
+    def do_GET(self):
+        path, query = urlsplit(self.path)[2:4]
+
+        for pattern, method in self.routes:
+            match = re.match(pattern, path)
+
+            if match:
+                return getattr(self, method)(query=parse_qs(query),
+                                             **match.groupdict())
+
+        self.send_body('Not found', status=404, content_type='text/plain')
+
+    def send_body(self, body, status=200, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        self.server.count_bytes(len(body))
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data))
+
+    def send_data_file(self, name, query):
+        path = os.path.join(self.server.directory, name)
+
+        if not os.path.isfile(path):
+            return self.send_body('Not found', status=404,
+                                  content_type='text/plain')
+
+        size = os.path.getsize(path)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                self.wfile.write(chunk)
+
+        self.server.count_bytes(size)
+
+    def send_open_humans_files(self, query):
+        self.send_json({'results': []})
+
+    def send_fitbit_profile(self, query):
+        self.send_json(synthetic.fitbit_profile(
+            date.today() - timedelta(days=self.settings['fitbit_days'])))
+
+    def send_fitbit_series(self, name, start, end, query):
+        if start is None:
+            # Overviews without dates.
+            return self.send_json({'summary': {}})
+
+        self.send_json(synthetic.fitbit_series(name, start, end))
+
+    def send_moves_week(self, year, week, query):
+        monday = datetime.strptime('{}-{}-1'.format(year, week), '%Y-%W-%w')
+
+        if (datetime.utcnow() - monday >
+                timedelta(weeks=self.settings['moves_weeks'])):
+            return self.send_json({'error': 'Date is before user signup'})
+
+        self.send_json(synthetic.moves_storyline_week(
+            int(year), int(week), self.settings['moves_points_per_day']))
+
+    def send_runkeeper_user(self, query):
+        self.send_json(synthetic.runkeeper_user())
+
+    def send_runkeeper_items(self, feed, query):
+        self.send_json(synthetic.runkeeper_items(
+            '/' + feed, self.settings['runkeeper_activities']))
+
+    def send_runkeeper_activity(self, index, query):
+        self.send_json(synthetic.runkeeper_activity(
+            int(index), self.settings['runkeeper_activities'],
+            self.settings['runkeeper_points']))
+
+    def send_pgp_profile(self, hu_id, query):
+        var_file_url = self.server.url(
+            '/files/{}'.format(self.settings['pgp_var_file']))
+
+        self.send_body(synthetic.pgp_profile_page(var_file_url),
+                       content_type='text/html')
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPIServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the fake APIs on a local port from a background thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, settings=None, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeAPIHandler)
+
+        self.directory = directory
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.bytes_sent = 0
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def count_bytes(self, size):
+        with self._lock:
+            self.bytes_sent += size
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
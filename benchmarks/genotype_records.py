@@ -0,0 +1,91 @@
+"""
+Microbenchmark genotype line validation for each raw data format.
+
+Reports lines per second for the original per-line regular expressions
+(validation in the cleaning step, then splitting and checking the calls
+again for VCF conversion) and for the single-pass parsers in
+data_retrieval.genotype_records.
+
+Run from this project's base directory, e.g.
+
+    python -m benchmarks.genotype_records 1000000
+"""
+import random
+import re
+import sys
+import time
+
+from data_retrieval.genotype_records import (parse_23andme_line,
+                                             parse_ancestrydna_line)
+
+
+def lines_23andme(count, seed=0):
+    rand = random.Random(seed)
+    chroms = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+    genotypes = ['AA', 'AC', 'GT', 'TT', 'A', '--', 'DI']
+
+    return ['rs{}\t{}\t{}\t{}\r\n'.format(i, rand.choice(chroms), i * 10,
+                                          rand.choice(genotypes))
+            for i in range(count)]
+
+
+def lines_ancestrydna(count, seed=0):
+    rand = random.Random(seed)
+
+    return ['rs{}\t{}\t{}\t{}\t{}\r\n'.format(
+        i, rand.randint(1, 25), i * 10, rand.choice('ACGT0'),
+        rand.choice('ACGTDI0')) for i in range(count)]
+
+
+def legacy_23andme(lines):
+    for line in lines:
+        if re.match(r'(rs|i)[0-9]+\t[1-9XYM][0-9T]?\t[0-9]+\t'
+                    r'[ACGT\-ID][ACGT\-ID]?', line):
+            data = line.rstrip().split('\t')
+            re.match(r'^[ACGT]{1,2}$', data[3])
+
+
+def legacy_ancestrydna(lines):
+    line_re = re.compile(
+        r'(rs|VGXS)[0-9]+\t[1-9][0-9]?\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
+    reported_y = re.compile(
+        r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
+    called_y = re.compile(r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI]\t[ACGTDI]')
+
+    for line in lines:
+        if line_re.match(line):
+            if reported_y.match(line):
+                called_y.match(line)
+
+            data = line.rstrip().split('\t')
+            re.match(r'^[ACGT]$', data[3]) and re.match(r'^[ACGT]$', data[4])
+
+
+def parsed(parser):
+    def run(lines):
+        for line in lines:
+            parser(line)
+
+    return run
+
+
+def timed(name, func, lines):
+    start = time.time()
+    func(lines)
+    elapsed = time.time() - start
+
+    print '{:<22} {:12.0f} lines/s'.format(name, len(lines) / elapsed)
+
+
+def main(count):
+    lines = lines_23andme(count)
+    timed('23andMe legacy', legacy_23andme, lines)
+    timed('23andMe records', parsed(parse_23andme_line), lines)
+
+    lines = lines_ancestrydna(count)
+    timed('AncestryDNA legacy', legacy_ancestrydna, lines)
+    timed('AncestryDNA records', parsed(parse_ancestrydna_line), lines)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
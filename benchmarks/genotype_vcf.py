@@ -0,0 +1,150 @@
+"""
+Benchmark genotype to VCF conversion on a synthetic 23andMe file.
+
+Compares the original per-line conversion (dict-of-dicts reference, one
+regex, dict and join per line) against the chunked converter in
+data_retrieval.genotype_vcf, and checks that both produce the same lines.
+
+Run from this project's base directory, e.g.
+
+    python -m benchmarks.genotype_vcf 1000000
+"""
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from data_retrieval.genotype_vcf import vcf_lines_from_calls
+from data_retrieval.reference_index import open_reference_index
+
+CHROMS = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+GENOTYPES = ['AA', 'AC', 'AG', 'CC', 'CT', 'GG', 'TT', 'A', 'T', '--', 'DI']
+
+VCF_FIELDS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+              'INFO', 'FORMAT', '23ANDME_DATA']
+
+
+def make_synthetic_data(directory, snp_count, seed=0):
+    """
+    Write a reference file and a raw 23andMe body with snp_count lines.
+    """
+    rand = random.Random(seed)
+    reference_path = os.path.join(directory, 'reference_b37.txt')
+    raw_path = os.path.join(directory, 'genome.txt')
+
+    with open(reference_path, 'w') as reference, open(raw_path, 'w') as raw:
+        for i in range(snp_count):
+            chrom = CHROMS[i * len(CHROMS) // snp_count]
+            pos = 1000 + i * 10
+
+            reference.write('{}\t{}\t{}\n'.format(chrom, pos,
+                                                  rand.choice('ACGT')))
+            raw.write('rs{}\t{}\t{}\t{}\n'.format(i, chrom, pos,
+                                                  rand.choice(GENOTYPES)))
+
+    return reference_path, raw_path
+
+
+def per_line(raw_path, reference_path):
+    """
+    The original per-line conversion, kept here as the baseline.
+    """
+    reference = dict()
+
+    with open(reference_path) as f:
+        for line in f:
+            data = line.rstrip().split('\t')
+
+            if data[0] not in reference:
+                reference[data[0]] = dict()
+
+            reference[data[0]][data[1]] = data[2]
+
+    for line in open(raw_path):
+        data = line.rstrip().split('\t')
+
+        if not re.match(r'^[ACGT]{1,2}$', data[3]):
+            continue
+        vcf_data = {x: '.' for x in VCF_FIELDS}
+
+        try:
+            vcf_data['REF'] = reference[data[1]][data[2]]
+        except KeyError:
+            continue
+
+        vcf_data['CHROM'] = 'M' if data[1] == 'MT' else data[1]
+        vcf_data['POS'] = data[2]
+
+        if data[0].startswith('rs'):
+            vcf_data['ID'] = data[0]
+
+        alt_alleles = []
+
+        for alle in data[3]:
+            if alle != vcf_data['REF'] and alle not in alt_alleles:
+                alt_alleles.append(alle)
+
+        if alt_alleles:
+            vcf_data['ALT'] = ','.join(alt_alleles)
+        else:
+            vcf_data['ALT'] = '.'
+            vcf_data['INFO'] = 'END=' + vcf_data['POS']
+
+        vcf_data['FORMAT'] = 'GT'
+        all_alleles = [vcf_data['REF']] + alt_alleles
+        vcf_data['23ANDME_DATA'] = '/'.join([str(all_alleles.index(x))
+                                             for x in data[3]])
+
+        yield '\t'.join([vcf_data[x] for x in VCF_FIELDS]) + '\n'
+
+
+def chunked(raw_path, reference_path):
+    reference = open_reference_index(reference_path)
+    genotype_re = re.compile(r'^[ACGT]{1,2}$')
+
+    def calls():
+        for line in open(raw_path):
+            data = line.rstrip().split('\t')
+
+            if genotype_re.match(data[3]):
+                yield (data[0], data[1], 'M' if data[1] == 'MT' else data[1],
+                       data[2], data[3])
+
+    return vcf_lines_from_calls(calls(), reference)
+
+
+def timed(name, lines, snp_count):
+    start = time.time()
+    output = ''.join(lines)
+    elapsed = time.time() - start
+
+    print '{:<10} {:8.2f}s {:12.0f} lines/s'.format(name, elapsed,
+                                                    snp_count / elapsed)
+
+    return output
+
+
+def main(snp_count):
+    directory = tempfile.mkdtemp()
+
+    try:
+        reference_path, raw_path = make_synthetic_data(directory, snp_count)
+
+        # Build the index up front; it is built once per deployment.
+        open_reference_index(reference_path)
+
+        expected = timed('per-line', per_line(raw_path, reference_path),
+                         snp_count)
+        result = timed('chunked', chunked(raw_path, reference_path),
+                       snp_count)
+
+        assert result == expected, 'Chunked output differs from per-line'
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,344 @@
+"""
+Benchmark sources end to end on synthetic data.
+
+Each benchmark writes deterministic input with benchmarks.synthetic and runs
+a source in local mode against benchmarks.fake_api, which serves anything
+the source downloads. Every source runs in a child process of its own, so
+its peak resident memory is its own. Results are printed as JSON, with the
+commit they were measured at: wall time, input bytes (read from disk and
+downloaded), throughput, output bytes and peak RSS. Save the results of two
+commits and compare them with benchmarks.compare.
+
+Fitbit and Moves cache API responses in the database, and Fitbit's rate
+limits are kept in Redis, so those two need DATABASE_URL and REDIS_URL as a
+worker does; responses cached by earlier benchmark runs are deleted first.
+Fitbit allows 150 requests per member per hour, which a scale much above 1
+will exceed. The PGP benchmark needs the hg19 reference genome, which
+cgivar2gvcf downloads to sources/pgp/resources when it's first used.
+
+Run from this project's base directory, e.g.
+
+    foreman run python -m benchmarks.run_sources --scale 0.1 -o before.json
+"""
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import click
+
+from benchmarks import synthetic
+from benchmarks.fake_api import FakeAPIServer
+from data_retrieval.reference_index import open_reference_index
+
+
+def prepare_twenty_three_and_me(directory, size, server):
+    reference_path = os.path.join(directory, '23andme-reference.txt')
+    input_file = os.path.join(directory, '23andme-genome.txt')
+
+    synthetic.write_reference(reference_path, size, synthetic.CHROMS_23ANDME)
+    synthetic.write_raw_23andme(input_file, size)
+
+    # The index is built once per deployment, not per run.
+    open_reference_index(reference_path)
+
+    return {
+        'source': 'sources.twenty_three_and_me.TwentyThreeAndMeSource',
+        'module_settings': {'REF_23ANDME_FILE': reference_path},
+        'input_file': input_file,
+    }
+
+
+def prepare_ancestry_dna(directory, size, server):
+    reference_path = os.path.join(directory, 'ancestrydna-reference.txt')
+    input_file = os.path.join(directory, 'ancestrydna-genome.txt')
+
+    synthetic.write_reference(reference_path, size,
+                              synthetic.CHROMS_ANCESTRYDNA)
+    synthetic.write_raw_ancestrydna(input_file, size)
+
+    open_reference_index(reference_path)
+
+    return {
+        'source': 'sources.ancestry_dna.AncestryDNASource',
+        'module_settings': {'REF_ANCESTRYDNA_FILE': reference_path},
+        'input_file': input_file,
+    }
+
+
+def prepare_vcf_data(directory, size, server):
+    synthetic.write_vcf(os.path.join(directory, 'genome.vcf.gz'), size)
+
+    return {
+        'source': 'sources.vcf_data.VCFDataSource',
+        'parameters': {
+            'vcf_data': [{
+                'vcf_file': {'url': server.url('/files/genome.vcf.gz')},
+                'vcf_source': 'other',
+                'additional_notes': '',
+            }],
+        },
+    }
+
+
+def prepare_pgp(directory, size, server):
+    synthetic.write_var_file(
+        os.path.join(directory, server.settings['pgp_var_file']), size)
+
+    return {
+        'source': 'sources.pgp.PGPSource',
+        'parameters': {'hu_id': 'hu000000'},
+    }
+
+
+def prepare_wildlife(directory, size, server):
+    files = {}
+
+    for i, filename in enumerate(['bacteria-kit-1.csv.bz2',
+                                  'fungi-kit-1.csv.bz2']):
+        synthetic.write_otu_counts(os.path.join(directory, filename), size,
+                                   seed=i)
+
+        files[filename] = server.url('/files/' + filename)
+
+    synthetic.write_home_data(os.path.join(directory, 'home-data-1.json'))
+
+    files['home-data-1.json'] = server.url('/files/home-data-1.json')
+
+    return {
+        'source': 'sources.wildlife.WildlifeSource',
+        'parameters': {'files': files},
+    }
+
+
+def prepare_fitbit(directory, size, server):
+    server.settings['fitbit_days'] = size
+
+    return {
+        'source': 'sources.fitbit.FitbitSource',
+        'cached_responses': os.environ['FITBIT_API_URL'],
+    }
+
+
+def prepare_moves(directory, size, server):
+    server.settings['moves_weeks'] = size
+
+    return {
+        'source': 'sources.moves.MovesSource',
+        'cached_responses': os.environ['MOVES_API_URL'],
+    }
+
+
+def prepare_runkeeper(directory, size, server):
+    server.settings['runkeeper_activities'] = size
+
+    return {
+        'source': 'sources.runkeeper.RunKeeperSource',
+    }
+
+
+# Name, size at a scale of 1 (in SNPs, records, loci, OTUs per file, days of
+# membership, weeks of storyline and activities respectively) and the
+# function that prepares the input.
+BENCHMARKS = [
+    ('twenty_three_and_me', 600000, prepare_twenty_three_and_me),
+    ('ancestry_dna', 700000, prepare_ancestry_dna),
+    ('vcf_data', 500000, prepare_vcf_data),
+    ('pgp', 500000, prepare_pgp),
+    ('wildlife', 5000, prepare_wildlife),
+    ('fitbit', 730, prepare_fitbit),
+    ('moves', 52, prepare_moves),
+    ('runkeeper', 500, prepare_runkeeper),
+]
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident memory of this process, or of any process it
+    waited for if larger, in megabytes.
+    """
+    # ru_maxrss is in kilobytes on Linux.
+    kilobytes = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    return kilobytes / 1024.0
+
+
+def delete_cached_responses(url):
+    """
+    Delete responses cached for URLs starting with url.
+    """
+    from models import CacheItem
+    from utilities import init_db
+
+    db = init_db()
+
+    (CacheItem.query
+     .filter(CacheItem.key.startswith(url))
+     .delete(synchronize_session=False))
+    db.session.commit()
+
+
+def run_source(benchmark, server_url, output_directory, connection):
+    """
+    Run a prepared benchmark's source and send its timing through
+    connection. Runs in a child process.
+    """
+    try:
+        module_name, class_name = benchmark['source'].rsplit('.', 1)
+        module = importlib.import_module(module_name)
+
+        for name, value in benchmark.get('module_settings', {}).items():
+            setattr(module, name, value)
+
+        if benchmark.get('cached_responses'):
+            delete_cached_responses(benchmark['cached_responses'])
+
+        source = getattr(module, class_name)(
+            access_token='benchmark',
+            force=True,
+            input_file=benchmark.get('input_file'),
+            local=True,
+            oh_base_url=server_url + '/data-import/',
+            oh_user_id='benchmark-{}'.format(os.getpid()),
+            oh_username='benchmark',
+            output_directory=output_directory)
+
+        # As update_parameters would set them.
+        for name, value in benchmark.get('parameters', {}).items():
+            setattr(source, name, value)
+
+        start = time.time()
+        result = source.run()
+        wall_seconds = time.time() - start
+
+        if result:
+            raise RuntimeError('Source asked to be retried: {}'.format(
+                result))
+
+        connection.send({'wall_seconds': wall_seconds,
+                         'peak_rss_mb': peak_rss_mb()})
+    except Exception as e:
+        logging.exception('Benchmark failed')
+
+        connection.send({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def run_benchmark(name, size, prepare, server, directory):
+    """
+    Prepare and run one benchmark, returning its results.
+    """
+    input_directory = os.path.join(directory, name)
+    output_directory = os.path.join(directory, name + '-output')
+
+    os.mkdir(input_directory)
+    os.mkdir(output_directory)
+
+    server.directory = input_directory
+
+    benchmark = prepare(input_directory, size, server)
+
+    input_bytes = (os.path.getsize(benchmark['input_file'])
+                   if benchmark.get('input_file') else 0)
+    bytes_sent = server.bytes_sent
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=run_source,
+        args=(benchmark, server.url(), output_directory, sender))
+    process.start()
+    result = receiver.recv()
+    process.join()
+
+    result.update({
+        'benchmark': name,
+        'size': size,
+        'input_bytes': input_bytes + server.bytes_sent - bytes_sent,
+    })
+
+    if 'error' not in result:
+        output_files = os.listdir(output_directory)
+
+        result.update({
+            'output_files': len(output_files),
+            'output_bytes': sum(
+                os.path.getsize(os.path.join(output_directory, filename))
+                for filename in output_files),
+            'records_per_second': size / result['wall_seconds'],
+            'input_mb_per_second': (result['input_bytes'] / 1e6 /
+                                    result['wall_seconds']),
+        })
+
+    shutil.rmtree(input_directory)
+    shutil.rmtree(output_directory)
+
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('-s', '--scale', type=float, default=1.0,
+              help='Multiplier for the size of every input.')
+@click.option('--only', multiple=True,
+              type=click.Choice([name for name, _, _ in BENCHMARKS]),
+              help='Run only this benchmark; may be repeated.')
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help='File to write the JSON results to.')
+def main(scale, only, output):
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    server = FakeAPIServer(directory).start()
+
+    # Read by the sources when the child processes import them.
+    os.environ.update({
+        'FITBIT_API_URL': server.url('/fitbit'),
+        'MOVES_API_URL': server.url('/moves'),
+        'RUNKEEPER_API_URL': server.url('/runkeeper'),
+        'PGP_BASE_URL': server.url('/pgp'),
+    })
+
+    results = []
+
+    try:
+        for name, size, prepare in BENCHMARKS:
+            if only and name not in only:
+                continue
+
+            result = run_benchmark(name, max(1, int(size * scale)), prepare,
+                                   server, directory)
+            results.append(result)
+
+            if 'error' in result:
+                click.echo('{}: {}'.format(name, result['error']), err=True)
+            else:
+                click.echo('{}: {:.2f}s'.format(name, result['wall_seconds']),
+                           err=True)
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+    json.dump({
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'scale': scale,
+        'results': results,
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Measure the import time and memory of the web and worker processes.
+
+Each measurement runs in a fresh Python process:
+
+    web     imports data_processing, as each uWSGI process does.
+    worker  imports data_processing, then every source in turn, as a worker
+            does over its first tasks; each source's import time and the
+            memory it adds are reported separately.
+
+Before sources were imported lazily both process types imported every
+source at startup, so the worker's total is also the cost of the old
+startup. Results are printed as JSON with the commit they were measured at.
+Run from this project's base directory with the environment a worker has,
+e.g.
+
+    foreman run python -m benchmarks.startup -o startup.json
+"""
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import click
+
+
+def rss_mb():
+    # ru_maxrss is in kilobytes on Linux; imports only ever grow memory, so
+    # the peak is the current size.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(process_type):
+    """
+    Import data_processing (and for a worker, each source) and return the
+    timings. Runs in a child process.
+    """
+    result = {'baseline_rss_mb': rss_mb()}
+
+    start = time.time()
+
+    import data_processing
+
+    result.update({
+        'import_seconds': time.time() - start,
+        'rss_mb': rss_mb(),
+    })
+
+    if process_type == 'worker':
+        result['sources'] = {}
+
+        for name, source in sorted(data_processing.SOURCES.items()):
+            rss_before = rss_mb()
+            start = time.time()
+
+            # Sources imported at startup are classes already.
+            if hasattr(source, 'load'):
+                source.load()
+
+            result['sources'][name] = {
+                'import_seconds': time.time() - start,
+                'rss_mb': rss_mb() - rss_before,
+            }
+
+        result.update({
+            'all_sources_seconds': result['import_seconds'] + sum(
+                s['import_seconds'] for s in result['sources'].values()),
+            'all_sources_rss_mb': rss_mb(),
+        })
+
+    return result
+
+
+@click.command()
+@click.option('--child', type=click.Choice(['web', 'worker']),
+              help='Measure one process type in this process.')
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help='File to write the JSON results to.')
+def main(child, output):
+    if child:
+        json.dump(measure(child), sys.stdout)
+
+        return
+
+    # Imported here so the child processes don't pay for it.
+    from benchmarks.run_sources import current_commit
+
+    results = {}
+
+    for process_type in ['web', 'worker']:
+        results[process_type] = json.loads(subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.startup', '--child',
+             process_type]))
+
+        click.echo('{}: {:.2f}s, {:.0f} MB'.format(
+            process_type, results[process_type]['import_seconds'],
+            results[process_type]['rss_mb']), err=True)
+
+    json.dump({
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'results': results,
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+"""
+Deterministic synthetic inputs for the source benchmarks.
+
+Every generator draws from a random.Random seeded by its arguments, so the
+same arguments always give the same bytes and benchmark results can be
+compared between commits. File generators write to a path and return the
+number of records written; API payload generators return JSON-serializable
+objects for benchmarks.fake_api to serve.
+"""
+import bz2
+import gzip
+import json
+import os
+import random
+
+from datetime import date, datetime, timedelta
+
+from sources.ancestry_dna import EXPECTED_COLUMNS_HEADER, HEADER_V2
+
+CHROMS_23ANDME = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+CHROMS_ANCESTRYDNA = [str(i) for i in range(1, 26)]
+CHROMS_VCF = [str(i) for i in range(1, 23)] + ['X', 'Y']
+
+GENOTYPES_23ANDME = ['AA', 'AC', 'AG', 'CC', 'CT', 'GG', 'TT', 'A', 'T',
+                     '--', 'DI']
+
+HEADER_23ANDME = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'sources', 'twenty_three_and_me',
+    'header-v2.txt')
+
+RUNKEEPER_TIME_FORMAT = '%a, %d %b %Y %H:%M:%S'
+
+TAXONOMY = [
+    ['k__Bacteria', 'k__Fungi'],
+    ['p__Proteobacteria', 'p__Firmicutes', 'p__Ascomycota',
+     'p__Basidiomycota', 'p__Actinobacteria'],
+    ['c__Alphaproteobacteria', 'c__Bacilli', 'c__Dothideomycetes',
+     'c__Agaricomycetes', 'c__Actinobacteria', 'c__Clostridia'],
+    ['o__Rhizobiales', 'o__Lactobacillales', 'o__Pleosporales',
+     'o__Polyporales', 'o__Actinomycetales'],
+]
+
+
+def positions(count, chroms, step=10):
+    """
+    Generate count (chromosome, position) pairs, sorted, spread evenly over
+    the chromosomes and step apart on each one.
+    """
+    chrom = None
+
+    for i in range(count):
+        if chroms[i * len(chroms) // count] != chrom:
+            chrom = chroms[i * len(chroms) // count]
+            pos = 1000000
+
+        yield chrom, pos
+
+        pos += step
+
+
+def write_reference(path, count, chroms, seed=0):
+    """
+    Write a reference file ('reference_b37.txt' format) for the positions
+    of a raw genotyping file of count lines.
+    """
+    rand = random.Random(seed)
+
+    with open(path, 'w') as f:
+        for chrom, pos in positions(count, chroms):
+            f.write('{}\t{}\t{}\n'.format(chrom, pos, rand.choice('ACGT')))
+
+    return count
+
+
+def write_raw_23andme(path, count, seed=0):
+    """
+    Write a raw 23andMe genotyping file with count SNPs and a current
+    (version 2) header.
+    """
+    rand = random.Random(seed)
+
+    with open(HEADER_23ANDME) as f:
+        header = f.read()
+
+    with open(path, 'w') as f:
+        f.write('# This data file generated by 23andMe at: '
+                'Mon Jan  4 10:11:12 2016\n')
+        f.write(header)
+
+        for i, (chrom, pos) in enumerate(positions(count, CHROMS_23ANDME)):
+            f.write('rs{}\t{}\t{}\t{}\n'.format(
+                i, chrom, pos, rand.choice(GENOTYPES_23ANDME)))
+
+    return count
+
+
+def write_raw_ancestrydna(path, count, seed=0):
+    """
+    Write a raw AncestryDNA genotyping file with count SNPs, of a genome
+    with a Y chromosome.
+    """
+    rand = random.Random(seed)
+
+    with open(path, 'w') as f:
+        f.write('#AncestryDNA raw data download\r\n'
+                '#This file was generated by AncestryDNA at: '
+                '01/04/2016 10:11:12 MDT\r\n'
+                '#Data was collected using AncestryDNA array version: '
+                'V1.0\r\n'
+                '#Data is formatted using AncestryDNA converter version: '
+                'V1.0\r\n')
+        f.writelines(HEADER_V2)
+        f.write(EXPECTED_COLUMNS_HEADER)
+
+        for i, (chrom, pos) in enumerate(positions(count,
+                                                   CHROMS_ANCESTRYDNA)):
+            first = rand.choice('ACGT0')
+            second = first if chrom in ('23', '24') else rand.choice('ACGT0')
+
+            f.write('rs{}\t{}\t{}\t{}\t{}\r\n'.format(i, chrom, pos, first,
+                                                       second))
+
+    return count
+
+
+def write_vcf(path, count, seed=0):
+    """
+    Write a gzipped single sample VCF file with count records.
+    """
+    rand = random.Random(seed)
+
+    with gzip.open(path, 'wb') as f:
+        f.write('##fileformat=VCFv4.1\n'
+                '##source=open_humans_data_processing.benchmarks\n'
+                '##FORMAT=<ID=GT,Number=1,Type=String,'
+                'Description="Genotype">\n'
+                '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t'
+                'SAMPLE\n')
+
+        for i, (chrom, pos) in enumerate(positions(count, CHROMS_VCF)):
+            ref = rand.choice('ACGT')
+            alt = rand.choice([base for base in 'ACGT' if base != ref])
+
+            f.write('{}\t{}\trs{}\t{}\t{}\t{}\tPASS\t.\tGT\t{}\n'.format(
+                chrom, pos, i, ref, alt, rand.randint(10, 99),
+                rand.choice(['0/1', '1/1'])))
+
+    return count
+
+
+def write_var_file(path, count, seed=0):
+    """
+    Write a bzip2 compressed Complete Genomics var file with count loci,
+    a mix of reference, no-call and SNP lines on chromosomes 1 to 22.
+    """
+    rand = random.Random(seed)
+
+    with bz2.BZ2File(path, 'w') as f:
+        f.write('#ASSEMBLY_ID\tGS00000-DNA_A01_37_0000\n'
+                '#BUILD\t37\n'
+                '#FORMAT_VERSION\t2.0\n'
+                '#GENOME_REFERENCE\tNCBI build 37\n'
+                '#TYPE\tVAR-ANNOTATION\n'
+                '\n'
+                '>locus\tploidy\tallele\tchromosome\tbegin\tend\tvarType\t'
+                'reference\talleleSeq\tvarScoreVAF\tvarScoreEAF\t'
+                'varQuality\thapLink\txRef\n')
+
+        var_chroms = ['chr{}'.format(i) for i in range(1, 23)]
+
+        for locus, (chrom, begin) in enumerate(positions(count, var_chroms,
+                                                         step=100)):
+            kind = rand.random()
+
+            if kind < 0.7:
+                f.write('{}\t2\tall\t{}\t{}\t{}\tref\t=\t=\t\t\t\t\t\n'
+                        .format(locus, chrom, begin, begin + 99))
+            elif kind < 0.8:
+                f.write('{}\t2\tall\t{}\t{}\t{}\tno-call\t=\t?\t\t\t\t\t\n'
+                        .format(locus, chrom, begin, begin + 99))
+            else:
+                ref = rand.choice('ACGT')
+                alt = rand.choice([base for base in 'ACGT' if base != ref])
+
+                f.write('{}\t2\tall\t{}\t{}\t{}\tsnp\t{}\t{}\t{}\t{}\t'
+                        'VQHIGH\t\tdbsnp.100:rs{}\n'.format(
+                            locus, chrom, begin, begin + 1, ref, alt,
+                            rand.randint(20, 200), rand.randint(20, 200),
+                            locus))
+
+    return count
+
+
+def write_otu_counts(path, count, samples=4, seed=0):
+    """
+    Write a bzip2 compressed Wild Life of Our Homes OTU count CSV with
+    count OTUs and samples sample columns.
+    """
+    rand = random.Random(seed)
+
+    with bz2.BZ2File(path, 'w') as f:
+        f.write(','.join(['OTU'] +
+                         ['sample-{}'.format(i) for i in range(samples)] +
+                         ['taxonomy']) + '\n')
+
+        for i in range(count):
+            taxonomy = '/'.join(rand.choice(level) for level in TAXONOMY)
+            counts = [str(rand.choice([0, 0, 1, rand.randint(1, 500)]))
+                      for _ in range(samples)]
+
+            f.write(','.join(['OTU_{}'.format(i)] + counts + [taxonomy]) +
+                    '\n')
+
+    return count
+
+
+def write_home_data(path, seed=0):
+    """
+    Write a Wild Life of Our Homes home data JSON file.
+    """
+    rand = random.Random(seed)
+
+    with open(path, 'w') as f:
+        json.dump({
+            'latitude': round(rand.uniform(25, 48), 2),
+            'longitude': round(rand.uniform(-124, -67), 2),
+            'home_type': rand.choice(['house', 'apartment', 'condo']),
+            'pets': rand.choice(['cat', 'dog', 'none']),
+            'rooms': rand.randint(1, 9),
+        }, f)
+
+    return 1
+
+
+def fitbit_profile(member_since):
+    return {
+        'user': {
+            'averageDailySteps': 7500,
+            'encodedId': 'BENCH1',
+            'height': 175.5,
+            'memberSince': member_since.strftime('%Y-%m-%d'),
+            'strideLengthRunning': 110.2,
+            'strideLengthWalking': 72.6,
+            'weight': 70.1,
+        },
+    }
+
+
+def fitbit_series(name, start, end):
+    """
+    Return a Fitbit time series payload with a value for every day from
+    start to end (dates as 'YYYY-MM-DD' strings).
+    """
+    rand = random.Random('{}{}{}'.format(name, start, end))
+
+    day = datetime.strptime(start, '%Y-%m-%d').date()
+    last = min(datetime.strptime(end, '%Y-%m-%d').date(), date.today())
+
+    values = []
+
+    while day <= last:
+        values.append({'dateTime': day.strftime('%Y-%m-%d'),
+                       'value': str(rand.randint(0, 20000))})
+        day += timedelta(days=1)
+
+    return {name.replace('/', '-'): values}
+
+
+def moves_storyline_week(year, week, points_per_day=200):
+    """
+    Return a Moves daily storyline payload for the seven days of a week
+    ('%W' numbered, as MovesSource requests them).
+    """
+    rand = random.Random('{}-{}'.format(year, week))
+    monday = datetime.strptime('{}-{}-1'.format(year, week), '%Y-%W-%w')
+
+    days = []
+
+    for offset in range(7):
+        day = monday + timedelta(days=offset)
+        track_points = []
+
+        for i in range(points_per_day):
+            point_time = day + timedelta(
+                seconds=i * 86400 // points_per_day)
+
+            track_points.append({
+                'lat': round(42.36 + rand.uniform(-0.05, 0.05), 6),
+                'lon': round(-71.06 + rand.uniform(-0.05, 0.05), 6),
+                'time': point_time.strftime('%Y%m%dT%H%M%SZ'),
+            })
+
+        days.append({
+            'date': day.strftime('%Y%m%d'),
+            'summary': [{'activity': 'walking', 'group': 'walking',
+                         'duration': rand.randint(600, 7200),
+                         'distance': rand.randint(500, 9000),
+                         'steps': rand.randint(1000, 15000)}],
+            'segments': [{
+                'type': 'move',
+                'startTime': track_points[0]['time'],
+                'endTime': track_points[-1]['time'],
+                'activities': [{'activity': 'walking', 'group': 'walking',
+                                'trackPoints': track_points}],
+            }],
+            'lastUpdate': day.strftime('%Y%m%dT%H%M%SZ'),
+        })
+
+    return days
+
+
+def runkeeper_time(index, count):
+    """
+    Return the start time of the index-th of count activities, spread over
+    the last two years.
+    """
+    start = datetime.combine(date.today() - timedelta(days=730),
+                             datetime.min.time())
+
+    return (start + timedelta(seconds=index * 730 * 86400 // max(count, 1))
+            ).strftime(RUNKEEPER_TIME_FORMAT)
+
+
+def runkeeper_user():
+    return {
+        'userID': 1,
+        'fitness_activities': '/fitnessActivities',
+        'background_activities': '/backgroundActivities',
+    }
+
+
+def runkeeper_items(path, count):
+    """
+    Return a RunKeeper page holding all count items of a feed.
+    """
+    if path == '/fitnessActivities':
+        items = [{'uri': '/fitnessActivities/{}'.format(i),
+                  'type': 'Running',
+                  'start_time': runkeeper_time(i, count)}
+                 for i in range(count)]
+    else:
+        rand = random.Random(path)
+
+        items = [{'timestamp': runkeeper_time(i, count),
+                  'steps': rand.randint(100, 20000),
+                  'calories_burned': rand.randint(10, 900),
+                  'source': 'RunKeeper'}
+                 for i in range(count)]
+
+    return {'size': count, 'items': items}
+
+
+def runkeeper_activity(index, count, points=500):
+    """
+    Return a RunKeeper fitness activity with a GPS path of points points.
+    """
+    rand = random.Random(index)
+
+    return {
+        'type': 'Running',
+        'equipment': 'None',
+        'start_time': runkeeper_time(index, count),
+        'utc_offset': -5,
+        'total_distance': rand.uniform(1000, 20000),
+        'duration': rand.uniform(600, 7200),
+        'total_calories': rand.uniform(100, 1500),
+        'climb': rand.uniform(0, 300),
+        'source': 'RunKeeper',
+        'path': [{'latitude': 42.36 + rand.uniform(-0.05, 0.05),
+                  'longitude': -71.06 + rand.uniform(-0.05, 0.05),
+                  'altitude': rand.uniform(0, 100),
+                  'timestamp': i * 5.0,
+                  'type': 'gps'}
+                 for i in range(points)],
+    }
+
+
+def pgp_profile_page(var_file_url):
+    """
+    Return a PGP Harvard public profile page listing one Complete Genomics
+    var file, and no surveys.
+    """
+    return ('<html><body>\n'
+            '<h3>Uploaded data</h3>\n'
+            '<div class="profile-data"><table>\n'
+            '<tr><th>Date</th><th>Name</th><th>Data type</th>'
+            '<th>Source</th><th></th></tr>\n'
+            '<tr><td>2016-01-04</td><td>var file</td>'
+            '<td>Complete Genomics</td><td>PGP</td>'
+            '<td><a href="{}">Download</a></td></tr>\n'
+            '</table></div>\n'
+            '<h3>Surveys</h3>\n'
+            '<p>No surveys.</p>\n'
+            '</body></html>\n').format(var_file_url)
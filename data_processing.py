@@ -5,17 +5,19 @@ Flask app to run data retrieval tasks for Open Humans
 """
 
 import imp
-import inspect
 import json
 import logging
 import os
 import pkgutil
+import re
+import threading
+import time
 
 from functools import partial
 
 from celery.signals import after_setup_logger
 
-from flask import Flask, request
+from flask import Flask, Response, jsonify, request
 from flask_sslify import SSLify
 
 from raven.contrib.flask import Sentry
@@ -23,7 +25,10 @@ from werkzeug.contrib.fixers import ProxyFix
 
 from celery_worker import make_worker
 
-from base_source import BaseSource
+from base_source import COST_CLASSES, BaseSource
+from data_retrieval.metrics import metrics_recorder, prometheus_text
+from data_retrieval.task_locks import (LOCK_TIMEOUT, TaskLock,
+                                       input_fingerprint)
 from models import db
 
 app = Flask(__name__)
@@ -44,8 +49,11 @@ DEBUG = False if DEBUG_ENV and DEBUG_ENV.lower() == 'false' else True
 #     },
 # }
 
+# LazySource instances by name; see add_rules.
 SOURCES = {}
 
+_import_lock = threading.Lock()
+
 logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO)
 logging.info('Starting data-processing')
 
@@ -140,18 +148,99 @@ def debug_json(value):
 #     task_update.apply_async(args=[update_url, task_data], queue='priority')
 
 
-def load_sources():
+class LazySource(object):
+    """
+    A source found in the sources/ directory, whose module is only imported
+    when the source is first used.
+
+    Calling it makes an instance of the source class, as calling the class
+    would.
+    """
+
+    # Read from the source's module without importing it.
+    class_re = re.compile(r'^class (\w+)\((?:\w+\.)?BaseSource\):', re.M)
+    cost_class_re = re.compile(r"^    cost_class = '(\w+)'", re.M)
+
+    def __init__(self, name, path, cls_name, cost_class):
+        self.name = name
+        self.path = path
+        self.cls_name = cls_name
+        self.cost_class = cost_class
+
+        self._cls = None
+
+    @classmethod
+    def scan(cls, name, path, code):
+        """
+        Return a LazySource for a source module's code, or None if it doesn't
+        define exactly one source class.
+        """
+        cls_names = cls.class_re.findall(code)
+
+        if len(cls_names) != 1:
+            return None
+
+        # The class's attributes, up to the next top level statement.
+        body = code[code.index('class {}('.format(cls_names[0])):]
+        body = re.split(r'\n(?=\S)', body, maxsplit=1)[0]
+
+        cost_class = cls.cost_class_re.search(body)
+
+        return cls(name, path, cls_names[0],
+                   cost_class.group(1) if cost_class else BaseSource.cost_class)
+
+    def load(self):
+        """
+        Import the source's module, if it isn't already, and return its
+        class.
+        """
+        with _import_lock:
+            if self._cls is None:
+                start = time.time()
+
+                f, pathname, desc = imp.find_module(self.name, [self.path])
+                module = imp.load_module(self.name, f, pathname, desc)
+
+                cls = getattr(module, self.cls_name)
+
+                # Its queue was chosen from the scanned cost class.
+                if cls.cost_class != self.cost_class:
+                    raise ValueError(
+                        '"{}" has cost class "{}", but was scanned as "{}"'
+                        .format(self.name, cls.cost_class, self.cost_class))
+
+                self._cls = cls
+
+                logging.info('Imported "%s" in %.2fs', self.name,
+                             time.time() - start)
+
+        return self._cls
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+def find_sources():
     """
-    A generator that iterates and loads all of the modules in the sources/
-    directory.
+    A generator that iterates the sources in the sources/ directory without
+    importing them.
     """
-    source_path = [os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), 'sources')]
+    source_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'sources')
+
+    for _, name, is_package in pkgutil.iter_modules([source_path]):
+        if is_package:
+            filename = os.path.join(source_path, name, '__init__.py')
+        else:
+            filename = os.path.join(source_path, name + '.py')
 
-    for _, name, _ in pkgutil.iter_modules(source_path):
-        f, pathname, desc = imp.find_module(name, source_path)
+        with open(filename) as f:
+            source = LazySource.scan(name, source_path, f.read())
 
-        yield (name, imp.load_module(name, f, pathname, desc))
+        if source:
+            yield source
+        else:
+            logging.warning('No source class found in "%s"', filename)
 
 
 @celery_worker.task
@@ -159,8 +248,8 @@ def source_task(name, **kwargs):
     """
     Task to run appropriate create_files method, with EXTRA_DATA mapping.
 
-    The 'name' parameter is used to look up the corresponding module, loaded
-    by load_sources.
+    The 'name' parameter is used to look up the corresponding source, found
+    by find_sources; its module is imported when the first task for it runs.
 
     We handle rate caps by caching results in our database and requeing a
     task with the same paramaters. To do this, tasks that need requeueing
@@ -174,42 +263,113 @@ def source_task(name, **kwargs):
     indicates the delay to impose on the re-queued task. This allows us to work
     gracefully with rate caps, caching successful queries in db and re-using
     those when re-running the task.
+
+    Tasks queued by generic_handler carry the token of their TaskLock in
+    'lock_token', and stop if a newer request has superseded them.
     """
-    return_status = SOURCES[name](sentry=sentry, **kwargs).run()
+    lock_token = kwargs.pop('lock_token', None)
+    task_lock = TaskLock(name, kwargs.get('oh_user_id'), token=lock_token)
+
+    if not task_lock.extend():
+        logging.info('Not running %s for %s, superseded by a newer request',
+                     name, kwargs.get('oh_user_id'))
+
+        return 'superseded'
+
+    try:
+        return_status = SOURCES[name](sentry=sentry, task_lock=task_lock,
+                                      **kwargs).run()
+    except Exception:
+        task_lock.release()
+
+        raise
 
     if return_status and 'countdown' in return_status:
-        kwargs.update({'return_status': return_status})
+        # The lock needs to last until the requeued task runs.
+        if not task_lock.extend(timeout=(LOCK_TIMEOUT +
+                                         return_status['countdown'])):
+            return 'superseded'
+
+        kwargs.update({'return_status': return_status,
+                       'lock_token': lock_token})
 
         source_task.apply_async(args=[name],
                                 kwargs=kwargs,
-                                countdown=return_status['countdown'])
+                                countdown=return_status['countdown'],
+                                queue=SOURCES[name].cost_class)
 
         return 'resubmitted'
 
+    task_lock.release()
+
 
 def generic_handler(name):
     logging.debug('POST JSON: %s', debug_json(request.json))
 
-    source_task.delay(name, **request.json)
+    data = dict(request.json or {})
+
+    # Coalesce duplicate requests into the task already queued or running
+    # for this member; a request with different inputs supersedes it.
+    if data.get('oh_user_id'):
+        task_lock = TaskLock(name, data['oh_user_id'])
+
+        if not task_lock.claim(input_fingerprint(data)):
+            logging.info('Coalesced duplicate %s request for %s', name,
+                         data['oh_user_id'])
+
+            return '{} dataset already started'.format(name)
+
+        data['lock_token'] = task_lock.token
+
+    # Each cost class has its own queue, so slow conversions don't hold up
+    # quick API requests.
+    source_task.apply_async(args=[name],
+                            kwargs=data,
+                            queue=SOURCES[name].cost_class)
 
     return '{} dataset started'.format(name)
 
 
+def queue_depths():
+    """
+    Return the tasks waiting in and workers consuming from each cost class's
+    queue.
+    """
+    depths = {}
+
+    with celery_worker.connection_or_acquire() as connection:
+        for cost_class in COST_CLASSES:
+            channel = connection.channel()
+
+            try:
+                _, tasks, workers = channel.queue_declare(queue=cost_class,
+                                                          passive=True)
+            except connection.channel_errors:
+                # Not declared yet; nothing has used it.
+                tasks, workers = 0, 0
+            else:
+                channel.close()
+
+            depths[cost_class] = {'tasks': tasks, 'workers': workers}
+
+    return depths
+
+
 def add_rules():
-    for name, source in load_sources():
-        for cls_name, cls in inspect.getmembers(source):
-            if (inspect.isclass(cls) and
-                    issubclass(cls, BaseSource) and
-                    cls is not BaseSource and
-                    name not in SOURCES):
-                logging.info('Adding "%s", "%s"', name, cls_name)
+    for source in find_sources():
+        if source.cost_class not in COST_CLASSES:
+            raise ValueError('Unknown cost class "{}" for "{}"'.format(
+                source.cost_class, source.name))
 
-                SOURCES[name] = cls
+        logging.info('Adding "%s", "%s" (%s)', source.name, source.cls_name,
+                     source.cost_class)
 
-                app.add_url_rule('/{}/'.format(name),
-                                 name,
-                                 partial(generic_handler, name),
-                                 methods=['GET', 'POST'])
+        SOURCES[source.name] = source
+
+        app.add_url_rule('/{}/'.format(source.name),
+                         source.name,
+                         partial(generic_handler, source.name),
+                         methods=['GET', 'POST'])
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -220,4 +380,21 @@ def index():
     return 'Open Humans Data Processing'
 
 
+@app.route('/queues/', methods=['GET'])
+def queues():
+    """
+    Report the depth of each cost class's queue, for monitoring.
+    """
+    return jsonify(queue_depths())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Report source stage timings and counters in the Prometheus text format.
+    """
+    return Response(prometheus_text(metrics_recorder().snapshot()),
+                    mimetype='text/plain; version=0.0.4')
+
+
 add_rules()
@@ -0,0 +1,297 @@
+"""
+BGZF compressed, tabix indexed VCF output in pure Python.
+
+BGZF is the blocked gzip format written by bgzip: a series of gzip members
+holding at most 64KB of data each, so a reader can seek to any block. A
+"virtual offset" addresses a byte of uncompressed data as the compressed
+offset of its block shifted left 16 bits, plus the offset within the block.
+
+BgzfVCFWriter writes VCF lines to a BGZF file and builds a tabix index (the
+'.tbi' file read by tabix, htslib, pysam, etc.) of the records in the same
+pass, so region queries don't need to decompress the whole file. See the
+SAM/BAM and tabix specifications for the formats.
+"""
+import logging
+import struct
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed bytes per block, as used by bgzip.
+BLOCK_DATA_SIZE = 0xff00
+
+BLOCK_HEADER = struct.Struct('<BBBBIBBHBBHH')
+BLOCK_FOOTER = struct.Struct('<II')
+
+# The empty block that marks the end of a BGZF file.
+EOF_BLOCK = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02'
+             '\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+TABIX_MAGIC = 'TBI\x01'
+TABIX_FORMAT_VCF = 2
+LINEAR_SHIFT = 14
+
+
+def compress_block(data, compresslevel=6):
+    """
+    Return data compressed as one BGZF block.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = BLOCK_HEADER.size + len(deflated) + BLOCK_FOOTER.size
+
+    return (BLOCK_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                              block_size - 1) +
+            deflated +
+            BLOCK_FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def reg2bin(beg, end):
+    """
+    Return the smallest tabix bin containing the 0-based region [beg, end).
+    """
+    end -= 1
+
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+
+    return 0
+
+
+class BgzfWriter(object):
+    """
+    Write-only file-like object producing a BGZF file.
+    """
+
+    def __init__(self, filename, compresslevel=6):
+        self.name = filename
+        self.compresslevel = compresslevel
+        self.closed = False
+
+        self._file = open(filename, 'wb')
+        self._block_offset = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def tell(self):
+        """
+        Return the virtual offset of the next byte to be written.
+        """
+        return (self._block_offset << 16) | self._buffered
+
+    def _flush_block(self):
+        block = compress_block(''.join(self._buffer), self.compresslevel)
+
+        self._file.write(block)
+        self._block_offset += len(block)
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        while data:
+            space = BLOCK_DATA_SIZE - self._buffered
+
+            self._buffer.append(data[:space])
+            self._buffered += min(space, len(data))
+            data = data[space:]
+
+            if self._buffered == BLOCK_DATA_SIZE:
+                self._flush_block()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self._buffered:
+            self._flush_block()
+
+        self._file.write(EOF_BLOCK)
+        self._file.close()
+        self.closed = True
+
+
+class TabixIndex(object):
+    """
+    Tabix index of VCF records, built from records added in file order.
+
+    Records must be grouped by chromosome and sorted by position within each
+    chromosome; add() raises ValueError otherwise.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.bins = {}
+        self.linear = {}
+        self.last_pos = None
+
+    @staticmethod
+    def record_region(line):
+        """
+        Return the chromosome and 0-based [beg, end) region of a VCF line.
+        Raises ValueError if the line is too short to be a record.
+        """
+        fields = line.split('\t', 8)
+
+        if len(fields) < 8:
+            raise ValueError('Not a VCF record: "{}"'.format(line.rstrip()))
+        beg = int(fields[1]) - 1
+        end = beg + len(fields[3])
+
+        for item in fields[7].split(';'):
+            if item.startswith('END='):
+                end = max(end, int(item[4:]))
+
+        return fields[0], beg, end
+
+    def add(self, line, start_offset, end_offset):
+        chrom, beg, end = self.record_region(line)
+
+        if not self.names or self.names[-1] != chrom:
+            if chrom in self.bins:
+                raise ValueError(
+                    'Chromosome "{}" is not contiguous'.format(chrom))
+
+            self.names.append(chrom)
+            self.bins[chrom] = {}
+            self.linear[chrom] = []
+            self.last_pos = None
+
+        if self.last_pos is not None and beg < self.last_pos:
+            raise ValueError('Position {} on "{}" is out of order'.format(
+                beg + 1, chrom))
+
+        self.last_pos = beg
+
+        chunks = self.bins[chrom].setdefault(reg2bin(beg, end), [])
+
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        linear = self.linear[chrom]
+        last_window = (end - 1) >> LINEAR_SHIFT
+
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+
+        for window in range(beg >> LINEAR_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+    def write(self, filename):
+        """
+        Write the index as a BGZF compressed '.tbi' file.
+        """
+        names = ''.join(name + '\0' for name in self.names)
+        parts = [TABIX_MAGIC,
+                 struct.pack('<8i', len(self.names), TABIX_FORMAT_VCF,
+                             1, 2, 0, ord('#'), 0, len(names)),
+                 names]
+
+        for name in self.names:
+            bins = self.bins[name]
+            parts.append(struct.pack('<i', len(bins)))
+
+            for bin_number in sorted(bins):
+                chunks = bins[bin_number]
+                parts.append(struct.pack('<Ii', bin_number, len(chunks)))
+
+                for start_offset, end_offset in chunks:
+                    parts.append(struct.pack('<QQ', start_offset, end_offset))
+
+            # Windows without records point at the next record before them.
+            linear = []
+            previous = 0
+
+            for offset in self.linear[name]:
+                previous = offset if offset is not None else previous
+                linear.append(previous)
+
+            parts.append(struct.pack('<i', len(linear)))
+            parts.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+
+        with BgzfWriter(filename) as index_file:
+            index_file.write(''.join(parts))
+
+
+class BgzfVCFWriter(object):
+    """
+    Write-only file-like object producing a BGZF VCF and its tabix index.
+
+    Data may be written in any pieces; it is split into lines as it arrives.
+    On close the index is written to the VCF filename plus '.tbi'. If the
+    records turn out not to be sorted, the VCF is still written but without
+    an index (index_filename is then None).
+    """
+
+    def __init__(self, filename, compresslevel=6):
+        self.name = filename
+        self.index_filename = filename + '.tbi'
+        self.closed = False
+        self.lines_written = 0
+
+        self._writer = BgzfWriter(filename, compresslevel)
+        self._index = TabixIndex()
+        self._partial = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_line(self, line):
+        start_offset = self._writer.tell()
+        self._writer.write(line)
+
+        # Blank lines (such as a trailing one) are kept but not indexed.
+        if (self._index is not None and not line.startswith('#') and
+                line.strip()):
+            try:
+                self._index.add(line, start_offset, self._writer.tell())
+            except (IndexError, ValueError) as e:
+                logger.warn('Not indexing "%s": %s', self.name, e)
+                self._index = None
+
+    def write(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+
+        for line in lines:
+            self._write_line(line + '\n')
+
+        self.lines_written += len(lines)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self._partial:
+            self._write_line(self._partial)
+            self._partial = ''
+            self.lines_written += 1
+
+        self._writer.close()
+
+        if self._index is not None:
+            self._index.write(self.index_filename)
+        else:
+            self.index_filename = None
+
+        self.closed = True
@@ -0,0 +1,124 @@
+"""
+Parallel bzip2 compression for generated output files.
+
+ParallelBZ2File is a drop-in replacement for a bz2.BZ2File opened for
+writing. Written data is cut into independent blocks that are compressed
+concurrently by a pool of threads (bz2.compress releases the GIL), and the
+compressed streams are written out in order. As with pbzip2 the result is a
+multi-stream bzip2 file, which bunzip2 and other standard tools decompress
+to the concatenation of the blocks.
+
+The threads are shared by every file compressed in a worker process, so at
+most BZ2_THREADS blocks are compressed at once however many are being
+written.
+
+Note that Python 2's bz2.BZ2File only reads the first stream of such a
+file, so it must not be used to read these files back; nothing in this
+project does (data_retrieval.decompress reads every stream), and README.md
+warns members' tools of the same.
+"""
+import bz2
+import multiprocessing
+import os
+import threading
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Uncompressed bytes per independent stream; bzip2 -9 uses 900k blocks.
+BLOCK_SIZE = 900 * 1024
+
+# Blocks a worker process compresses at once. Each of the cpu worker's
+# CPU_CONCURRENCY processes may be compressing at once, so by default they
+# share the CPUs between them.
+BZ2_THREADS = int(os.getenv('BZ2_THREADS') or
+                  max(1, multiprocessing.cpu_count() //
+                      int(os.getenv('CPU_CONCURRENCY') or 2)))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def compress_pool():
+    """
+    Return the worker's compression thread pool, creating it if needed.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(BZ2_THREADS)
+
+    return _pool
+
+
+class ParallelBZ2File(object):
+    """
+    Write-only file-like object producing a multi-stream bzip2 file.
+    """
+
+    def __init__(self, filename, mode='w', compresslevel=9,
+                 block_size=BLOCK_SIZE):
+        if mode not in ('w', 'wb'):
+            raise ValueError('ParallelBZ2File only supports writing')
+
+        self.name = filename
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.closed = False
+        self.lines_written = 0
+
+        self._file = open(filename, 'wb')
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _submit(self):
+        """
+        Queue the buffered data for compression as one stream.
+        """
+        block = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        self._pending.append(compress_pool().apply_async(
+            bz2.compress, (block, self.compresslevel)))
+
+        # Bound memory use by writing out the oldest streams as they finish.
+        while len(self._pending) > 2 * BZ2_THREADS:
+            self._file.write(self._pending.popleft().get())
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.lines_written += data.count('\n')
+
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self._buffered or not self._pending:
+                self._submit()
+
+            while self._pending:
+                self._file.write(self._pending.popleft().get())
+        finally:
+            self.closed = True
+            self._file.close()
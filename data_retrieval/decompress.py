@@ -0,0 +1,223 @@
+"""
+Fast reading of compressed files, whatever their filename.
+
+The format is sniffed from a file's first bytes rather than trusted from its
+name. Supported are gzip (including multi-member files such as BGZF), bzip2
+(including multi-stream files such as those written by bz2_parallel, of
+which Python 2's bz2.BZ2File only reads the first stream), xz (through the
+xz command, as Python 2 has no lzma module), ZIP archives holding a single
+file, and uncompressed files.
+
+Data is decompressed in large chunks and each chunk is split into lines in
+C, so iterating over a LineReader is several times faster than over
+gzip.GzipFile or zipfile.ZipExtFile objects, which read lines in Python.
+"""
+import bz2
+import gzip
+import itertools
+import subprocess
+import zipfile
+
+from cStringIO import StringIO
+
+# Compressed bytes read at a time.
+READ_SIZE = 1024 * 1024
+
+MAGIC_BYTES = [
+    ('\x1f\x8b', 'gz'),
+    ('BZh', 'bz2'),
+    ('PK\x03\x04', 'zip'),
+    ('PK\x05\x06', 'zip'),
+    ('\xfd7zXZ\x00', 'xz'),
+]
+
+
+class ArchiveError(ValueError):
+    """
+    Raised when a ZIP archive doesn't hold exactly one file.
+    """
+
+
+def sniff_format(filepath):
+    """
+    Return 'gz', 'bz2', 'zip' or 'xz' for a compressed file, or None if it
+    doesn't start with any of their magic bytes.
+    """
+    with open(filepath, 'rb') as input_file:
+        prefix = input_file.read(6)
+
+    for magic, file_format in MAGIC_BYTES:
+        if prefix.startswith(magic):
+            return file_format
+
+    return None
+
+
+def read_chunks(input_file, *others):
+    """
+    Generate the data read from input_file in chunks, closing it and any
+    other files given at the end.
+    """
+    try:
+        for chunk in iter(lambda: input_file.read(READ_SIZE), ''):
+            yield chunk
+    finally:
+        for open_file in (input_file,) + others:
+            open_file.close()
+
+
+def gzip_chunks(filepath):
+    input_file = open(filepath, 'rb')
+
+    # GzipFile reads every member, and checks each one's CRC and length.
+    return read_chunks(gzip.GzipFile(fileobj=input_file), input_file)
+
+
+def bz2_chunks(filepath):
+    decompressor = bz2.BZ2Decompressor()
+
+    for data in read_chunks(open(filepath, 'rb')):
+        while data:
+            try:
+                output = decompressor.decompress(data)
+            except EOFError:
+                # The last stream ended exactly at the end of a read.
+                decompressor = bz2.BZ2Decompressor()
+
+                continue
+
+            if output:
+                yield output
+
+            data = decompressor.unused_data
+
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+
+    # A finished stream refuses more data, an unfinished one doesn't.
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return
+
+    raise IOError('Compressed file ended before the end-of-stream marker '
+                  'was reached: {}'.format(filepath))
+
+
+def xz_chunks(filepath):
+    process = subprocess.Popen(['xz', '--decompress', '--stdout', filepath],
+                               stdout=subprocess.PIPE)
+
+    try:
+        for chunk in read_chunks(process.stdout):
+            yield chunk
+    except BaseException:
+        # Including GeneratorExit, if the reader is closed early.
+        if process.poll() is None:
+            process.kill()
+
+        process.wait()
+
+        raise
+
+    if process.wait():
+        raise IOError('Unable to decompress {}: xz exited with status {}'
+                      .format(filepath, process.returncode))
+
+
+def zip_chunks(filepath):
+    zip_file = zipfile.ZipFile(filepath)
+
+    members = [name for name in zip_file.namelist()
+               if not name.startswith('__MACOSX/')]
+
+    if len(members) != 1:
+        zip_file.close()
+
+        raise ArchiveError('Expected one file in ZIP archive {}, found {}'
+                           .format(filepath, len(members)))
+
+    return read_chunks(zip_file.open(members[0]), zip_file)
+
+
+def plain_chunks(filepath):
+    return read_chunks(open(filepath, 'rb'))
+
+
+CHUNK_READERS = {
+    'gz': gzip_chunks,
+    'bz2': bz2_chunks,
+    'xz': xz_chunks,
+    'zip': zip_chunks,
+    None: plain_chunks,
+}
+
+
+def decompressed_chunks(filepath):
+    """
+    Return an iterator over a file's decompressed data in large chunks.
+    """
+    return CHUNK_READERS[sniff_format(filepath)](filepath)
+
+
+def line_blocks(chunks):
+    """
+    Generate lists of the complete lines in a series of data chunks.
+    """
+    remainder = ''
+
+    for chunk in chunks:
+        lines = StringIO(chunk).readlines()
+
+        # Join the partial line carried over from the last chunk, and carry
+        # over this one's.
+        lines[0] = remainder + lines[0]
+
+        if lines[-1].endswith('\n'):
+            remainder = ''
+        else:
+            remainder = lines.pop()
+
+        yield lines
+
+    if remainder:
+        yield [remainder]
+
+
+class LineReader(object):
+    """
+    Read-only iterator over the lines of a file, decompressed as needed.
+
+    Lines keep their line endings, as with a file opened in binary mode.
+    Closing the reader (or leaving a with block) closes the file.
+    """
+
+    def __init__(self, filepath):
+        self.name = filepath
+
+        file_format = sniff_format(filepath)
+
+        if file_format is None:
+            # Python's own iteration is fastest for uncompressed files.
+            self._file = open(filepath, 'rb')
+            self._lines = iter(self._file)
+        else:
+            self._file = CHUNK_READERS[file_format](filepath)
+            self._lines = itertools.chain.from_iterable(
+                line_blocks(self._file))
+
+    def __iter__(self):
+        # Iterating over the chain directly keeps the per-line work in C.
+        return self._lines
+
+    def next(self):
+        return next(self._lines)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,519 @@
+"""
+Resumable, parallel HTTP downloads, used by BaseSource.get_remote_file.
+
+A Download starts with a plain streaming GET, which also tells us the
+filename and size. Large files from servers that accept byte ranges are then
+split into parts fetched concurrently with Range requests; anything else is
+streamed in one piece.
+
+Either way, a connection error, timeout or server error part way through is
+retried with exponential backoff, resuming from the last byte written rather
+than from the start of the file (ranges are requested with If-Range, so a
+file that changes in between is caught). An MD5 checksum of the file is
+computed as it downloads and checked against the Content-MD5 header or S3
+ETag when the server gives one, and each download records DownloadStats.
+
+Instead of being saved, an opened download can be streamed in order to any
+file-like object with stream_to(), which BaseSource.passthrough_remote_file
+uses to copy files straight to S3.
+"""
+import base64
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit, urlunsplit
+
+import requests
+
+from data_retrieval import sessions
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 512 * 1024
+
+# Files at least this large are downloaded in parallel parts if possible.
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+PARALLEL_PARTS = 4
+MIN_PART_SIZE = 16 * 1024 * 1024
+
+RETRIES = 5
+BACKOFF = 1
+MAX_BACKOFF = 30
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (10, 60)
+
+TRANSIENT_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+
+
+class DownloadError(Exception):
+    pass
+
+
+class TransientError(DownloadError):
+    """
+    A failure that may succeed on retry.
+    """
+
+
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout,
+                    TransientError)
+
+
+class DownloadStats(namedtuple('DownloadStats', ['url', 'filename', 'size',
+                                                 'seconds', 'parts',
+                                                 'retries', 'md5'])):
+    """
+    Statistics for a completed download.
+    """
+
+    @property
+    def bytes_per_second(self):
+        return self.size / self.seconds if self.seconds else 0
+
+
+def public_url(url):
+    """
+    Return a URL without its query string, which may hold credentials.
+    """
+    return urlunsplit(urlsplit(url)[:3] + ('', ''))
+
+
+def response_filename(response):
+    """
+    Return the filename given by a response's 'Content-Disposition' header,
+    or else the last portion of its URL ('https://test.com/hello/world.zip'
+    becomes 'world.zip').
+    """
+    if 'Content-Disposition' in response.headers:
+        filename = re.match(r'attachment; filename="(.*)"$',
+                            response.headers['Content-Disposition'])
+
+        if filename:
+            return filename.groups()[0]
+
+    return urlsplit(response.url)[2].split('/')[-1]
+
+
+def expected_md5(response):
+    """
+    Return the hex MD5 digest a response says its content has, or None.
+    """
+    if 'Content-MD5' in response.headers:
+        return base64.b64decode(response.headers['Content-MD5']).encode('hex')
+
+    # S3's ETag is the MD5 of the object, unless it was a multipart upload.
+    etag = response.headers.get('ETag', '').strip('"')
+
+    if 'x-amz-request-id' in response.headers and re.match(r'^[0-9a-f]{32}$',
+                                                           etag):
+        return etag
+
+    return None
+
+
+class StreamOutput(object):
+    """
+    Adapts a stream for Download.fetch_range, which seeks back to the start
+    of the file if a server can't resume it. Data at positions already
+    written is skipped.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def seek(self, position):
+        self.position = position
+
+    def write(self, data):
+        data_end = self.position + len(data)
+
+        if data_end > self.written:
+            self.stream.write(data[self.written - self.position:])
+            self.written = data_end
+
+        self.position = data_end
+
+    def truncate(self, size):
+        pass
+
+
+class Download(object):
+    """
+    A download of a URL to a file in a directory.
+
+    If a verifier is given its start() method is called with the filename,
+    feed() with the file's data in order and finish() at the end; the file is
+    then always downloaded in one stream. Exceptions raised by the verifier
+    abort the download.
+    """
+
+    def __init__(self, url, directory, verifier=None, parts=PARALLEL_PARTS):
+        self.url = url
+        self.directory = directory
+        self.verifier = verifier
+        self.parts = parts
+
+        self.filename = None
+        self.size = None
+        self.stats = None
+
+        self.response = None
+        self.validator = None
+        self.stream = None
+        self._started = None
+
+        self.retries = 0
+        self._aborted = False
+        self._lock = threading.Lock()
+
+        # Data is checksummed and verified in order, up to _processed bytes.
+        self._md5 = hashlib.md5()
+        self._processed = 0
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.filename)
+
+    def open_output(self):
+        """
+        Open the output for writing at any position.
+        """
+        if self.stream:
+            return StreamOutput(self.stream)
+
+        return open(self.path, 'r+b')
+
+    def request(self, start=0, end=None, validator=None):
+        """
+        Start a GET request for bytes start to end (or the end of the file).
+        """
+        headers = {}
+
+        if start or end is not None:
+            headers['Range'] = 'bytes={}-{}'.format(
+                start, '' if end is None else end - 1)
+
+            if validator:
+                headers['If-Range'] = validator
+
+        response = sessions.get(self.url, headers=headers, stream=True,
+                                timeout=TIMEOUT)
+
+        if response.status_code in (200, 206):
+            return response
+
+        response.close()
+
+        if response.status_code in TRANSIENT_STATUS_CODES:
+            raise TransientError('HTTP status {}'.format(response.status_code))
+
+        raise DownloadError('File URL not working! Data processing aborted: {}'
+                            .format(public_url(self.url)))
+
+    def retry(self, attempt, error):
+        """
+        Wait before the next attempt, or raise if out of retries.
+        """
+        if attempt > RETRIES:
+            raise DownloadError('Download of {} failed after {} retries: {}'
+                                .format(public_url(self.url), RETRIES, error))
+
+        delay = min(BACKOFF * 2 ** (attempt - 1), MAX_BACKOFF)
+
+        logger.warn('download: retrying "%s" in %ss after error: %s',
+                    public_url(self.url), delay, error)
+
+        with self._lock:
+            self.retries += 1
+
+        time.sleep(delay)
+
+    def process(self, position, data):
+        """
+        Checksum and verify data at position that hasn't been already.
+        """
+        data = data[self._processed - position:]
+
+        if not data:
+            return
+
+        if self.verifier:
+            self.verifier.feed(data)
+
+        self._md5.update(data)
+        self._processed += len(data)
+
+    def fetch_range(self, start, end, response=None, validator=None,
+                    in_order=False):
+        """
+        Write bytes start to end of the file (or to its end if end is None)
+        to their place in the output file, resuming after errors. If given,
+        response is an already started request for the same range.
+
+        If in_order is set the data is also checksummed and verified as it
+        arrives, and a server that ignores Range headers is handled by
+        starting over from the beginning of the file.
+        """
+        position = start
+        attempt = 0
+
+        with self.open_output() as output_file:
+            while end is None or position < end:
+                try:
+                    if response is None:
+                        response = self.request(position, end, validator)
+
+                        if response.status_code == 200 and position:
+                            if not in_order:
+                                raise DownloadError(
+                                    'File changed during download: {}'.format(
+                                        public_url(self.url)))
+
+                            # The file can't be resumed; start over.
+                            position = 0
+
+                    output_file.seek(position)
+
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if self._aborted:
+                            raise DownloadError('Download aborted')
+
+                        if end is not None:
+                            chunk = chunk[:end - position]
+
+                        if in_order:
+                            self.process(position, chunk)
+
+                        output_file.write(chunk)
+                        position += len(chunk)
+
+                        if position == end:
+                            break
+
+                    response.close()
+                    response = None
+
+                    if end is None:
+                        output_file.truncate(position)
+
+                        break
+
+                    if position < end:
+                        raise TransientError('Connection closed early')
+                except TRANSIENT_ERRORS as e:
+                    if response is not None:
+                        response.close()
+                        response = None
+
+                    attempt += 1
+
+                    try:
+                        self.retry(attempt, e)
+                    except DownloadError:
+                        # Stop any other parts of the download.
+                        self._aborted = True
+
+                        raise
+
+        return position
+
+    def fetch_parallel(self, response, validator):
+        """
+        Download the file in parts, checksumming each part in order as it
+        completes.
+        """
+        parts = min(self.parts, -(-self.size // MIN_PART_SIZE))
+        part_size = -(-self.size // parts)
+        ranges = [(start, min(start + part_size, self.size))
+                  for start in range(0, self.size, part_size)]
+
+        pool = ThreadPool(len(ranges))
+
+        # The first part reuses the request already started for the file.
+        results = [pool.apply_async(self.fetch_range, (
+            start, end, response if start == 0 else None, validator))
+            for start, end in ranges]
+
+        pool.close()
+
+        try:
+            with open(self.path, 'rb') as input_file:
+                for (start, end), result in zip(ranges, results):
+                    result.get()
+
+                    input_file.seek(start)
+
+                    while input_file.tell() < end:
+                        self._md5.update(input_file.read(
+                            min(CHUNK_SIZE, end - input_file.tell())))
+        except Exception:
+            self._aborted = True
+
+            raise
+        finally:
+            pool.join()
+
+        return len(ranges)
+
+    def start(self):
+        """
+        Start the initial request, retrying transient errors.
+        """
+        attempt = 0
+
+        while True:
+            try:
+                return self.request()
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                self.retry(attempt, e)
+
+    def open(self):
+        """
+        Start the download, finding the filename and size. Return the
+        filename.
+        """
+        self._started = time.time()
+        self.response = self.start()
+
+        self.filename = response_filename(self.response)
+
+        logger.info('download: filename "%s"', self.filename)
+
+        # Encoded content is decoded as it's read, so its length and ranges
+        # don't match the data we write.
+        encoded = self.response.headers.get('Content-Encoding',
+                                            'identity') != 'identity'
+
+        if 'Content-Length' in self.response.headers and not encoded:
+            self.size = int(self.response.headers['Content-Length'])
+
+        self.validator = self.response.headers.get('ETag')
+
+        if not self.validator or self.validator.startswith('W/'):
+            self.validator = self.response.headers.get('Last-Modified')
+
+        return self.filename
+
+    def check(self):
+        """
+        Finish verification and check the checksum of the downloaded data.
+        """
+        if self.verifier:
+            self.verifier.finish()
+
+        expected = expected_md5(self.response)
+
+        if expected and self._md5.hexdigest() != expected:
+            raise DownloadError('Checksum mismatch for {}: {} != {}'.format(
+                public_url(self.url), self._md5.hexdigest(), expected))
+
+    def record_stats(self, size, parts):
+        seconds = time.time() - self._started
+
+        self.stats = DownloadStats(url=public_url(self.url),
+                                   filename=self.filename,
+                                   size=size,
+                                   seconds=seconds,
+                                   parts=parts,
+                                   retries=self.retries,
+                                   md5=self._md5.hexdigest())
+
+        logger.info('download: "%s" %s bytes in %.1fs (%.0f bytes/s), '
+                    '%s parts, %s retries', self.filename, size, seconds,
+                    self.stats.bytes_per_second, parts, self.retries)
+
+    def save(self):
+        """
+        Save the opened download to the directory. Return the filename used.
+        """
+        parallel = (self.size is not None and
+                    self.size >= PARALLEL_THRESHOLD and
+                    not self.verifier and
+                    self.response.headers.get('Accept-Ranges') == 'bytes')
+
+        try:
+            if self.verifier:
+                self.verifier.start(self.filename)
+
+            with open(self.path, 'wb') as output_file:
+                if parallel:
+                    output_file.truncate(self.size)
+
+            if parallel:
+                parts = self.fetch_parallel(self.response, self.validator)
+            else:
+                parts = 1
+                self.fetch_range(0, self.size, self.response, self.validator,
+                                 in_order=True)
+
+            self.check()
+        except Exception:
+            logger.info('download: aborted "%s"', public_url(self.url))
+
+            self.response.close()
+
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+            raise
+
+        self.record_stats(os.path.getsize(self.path), parts)
+
+        return self.filename
+
+    def stream_to(self, stream):
+        """
+        Write the opened download in order to a file-like stream, such as a
+        files.StreamUploader, instead of saving it.
+        """
+        self.stream = stream
+
+        try:
+            if self.verifier:
+                self.verifier.start(self.filename)
+
+            self.fetch_range(0, self.size, self.response, self.validator,
+                             in_order=True)
+
+            self.check()
+        except Exception:
+            logger.info('download: aborted "%s"', public_url(self.url))
+
+            self.response.close()
+
+            raise
+
+        self.record_stats(self._processed, 1)
+
+    def close(self):
+        """
+        Close the initial request, if it's still open.
+        """
+        if self.response is not None:
+            self.response.close()
+
+    def run(self):
+        """
+        Download the file. Return the filename used.
+        """
+        self.open()
+
+        return self.save()
@@ -0,0 +1,209 @@
+"""
+Fair shares of a realm's request budget for the members using it at once.
+
+A requests-respectful realm, such as the global 'fitbit' one, lets requests
+through first come first served, so one member with years of history to
+retrieve can use the whole budget while members who need a couple of
+requests to finish keep getting rate limited.
+
+FairShareAllocator divides each window of a realm's budget (its timespan)
+between the members with retrievals in progress by weighted max-min
+fairness, as weighted fair queuing does: members who need less than their
+share get all of it, and what they leave is split between the rest in
+proportion to their weights. A member's weight grows with the fraction of
+their retrieval already done, so nearly complete retrievals are served
+first. What a member has used in the window is read from their own realm.
+
+Members record their demand when they ask for a grant and clear it when
+they finish; demand not renewed for a window is forgotten.
+"""
+import json
+import logging
+import time
+
+from redis import RedisError
+
+from data_retrieval.rate_limits import (COUNTDOWN_MARGIN, MIN_COUNTDOWN,
+                                        REALM_KEY, request_ttls,
+                                        seconds_until_free)
+
+logger = logging.getLogger(__name__)
+
+DEMAND_KEY = 'FairShare:{}:DEMAND'
+
+# Extra weight given to a member whose retrieval is complete but for its
+# last request; a member starting from nothing has a weight of 1.
+COMPLETION_WEIGHT = 3
+
+
+def fair_shares(capacity, demands, weights):
+    """
+    Return a dict of each member's share of capacity, divided by weighted
+    max-min fairness between their demands.
+    """
+    shares = dict((member, 0) for member in demands)
+    pending = set(member for member, demand in demands.items() if demand > 0)
+
+    while pending and capacity > 0:
+        level = float(capacity) / sum(weights[member] for member in pending)
+
+        satisfied = [member for member in pending
+                     if demands[member] <= level * weights[member]]
+
+        if not satisfied:
+            for member in pending:
+                shares[member] = int(level * weights[member])
+
+            break
+
+        for member in satisfied:
+            shares[member] = demands[member]
+            capacity -= demands[member]
+
+            pending.remove(member)
+
+    return shares
+
+
+class FairShareGrant(object):
+    """
+    The requests a member may make now, and the seconds until they should
+    ask again once they're used.
+    """
+
+    def __init__(self, quota, wait=0):
+        self.quota = quota
+        self.wait = wait
+
+    def take(self):
+        """
+        Use one request of the grant; return False if there are none left.
+        """
+        if self.quota is not None:
+            if self.quota <= 0:
+                return False
+
+            self.quota -= 1
+
+        return True
+
+
+class FairShareAllocator(object):
+    """
+    Grants members their fair share of a realm's budget. member_realm is
+    the format of each member's own realm, e.g. 'fitbit-{}'.
+    """
+
+    def __init__(self, redis, realm, member_realm, safety_threshold=0):
+        self.redis = redis
+        self.realm = realm
+        self.member_realm = member_realm
+        self.safety_threshold = safety_threshold
+
+    def realm_limits(self, realm):
+        """
+        Return a realm's usable requests per window and its timespan, or
+        None if it isn't registered.
+        """
+        realm_info = self.redis.hgetall(REALM_KEY.format(realm))
+
+        if not realm_info:
+            return None
+
+        return (int(realm_info['max_requests']) - self.safety_threshold,
+                int(realm_info['timespan']))
+
+    def demands(self, timespan):
+        """
+        Return the recorded demand of each member, forgetting any that are
+        older than a window.
+        """
+        demands = {}
+        expired = []
+
+        for member, value in self.redis.hgetall(
+                DEMAND_KEY.format(self.realm)).items():
+            demand = json.loads(value)
+
+            if time.time() - demand['time'] > timespan:
+                expired.append(member)
+            else:
+                demands[member] = demand
+
+        if expired:
+            self.redis.hdel(DEMAND_KEY.format(self.realm), *expired)
+
+        return demands
+
+    def grant(self, member, remaining, done=0):
+        """
+        Record that member needs remaining more requests to finish a
+        retrieval of which done are already complete, and return their
+        FairShareGrant.
+        """
+        try:
+            return self._grant(str(member), remaining, done)
+        except RedisError as e:
+            logger.warning('Unable to read fair shares, not limiting: %s', e)
+
+            return FairShareGrant(None)
+
+    def _grant(self, member, remaining, done):
+        realm_limits = self.realm_limits(self.realm)
+        member_limits = self.realm_limits(self.member_realm.format(member))
+
+        # Realms that aren't registered don't limit requests.
+        if realm_limits is None or member_limits is None:
+            logger.warning('Realm %s or %s not registered, not limiting',
+                           self.realm, self.member_realm.format(member))
+
+            return FairShareGrant(None)
+
+        limit, timespan = realm_limits
+        member_limit, _ = member_limits
+
+        # What the member has made in the current window.
+        ttls = request_ttls(self.redis, self.member_realm.format(member))
+        used = len(ttls)
+
+        self.redis.hset(DEMAND_KEY.format(self.realm), member, json.dumps({
+            'demand': min(used + remaining, member_limit),
+            'weight': 1 + COMPLETION_WEIGHT * float(done) / (done + remaining),
+            'time': time.time(),
+        }))
+
+        demands = self.demands(timespan)
+
+        shares = fair_shares(
+            limit,
+            dict((m, d['demand']) for m, d in demands.items()),
+            dict((m, d['weight']) for m, d in demands.items()))
+
+        share = shares.get(member, 0)
+
+        logger.info('Fair share of %s for %s: %s of %s requests (%s used, '
+                    '%s members)', self.realm, member, share, limit, used,
+                    len(demands))
+
+        if used < share:
+            return FairShareGrant(share - used)
+
+        if share:
+            # Wait until enough of the member's requests expire to bring
+            # them back under their share.
+            wait = ttls[used - share]
+        else:
+            # Others' shares take the whole budget; wait for some of it.
+            wait = seconds_until_free(self.redis, self.realm,
+                                      safety_threshold=self.safety_threshold)
+
+        return FairShareGrant(0, max(MIN_COUNTDOWN, wait + COUNTDOWN_MARGIN))
+
+    def release(self, member):
+        """
+        Clear a member's demand once their retrieval is complete.
+        """
+        try:
+            self.redis.hdel(DEMAND_KEY.format(self.realm), str(member))
+        except RedisError as e:
+            logger.warning('Unable to clear fair share demand: %s', e)
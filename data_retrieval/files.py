@@ -1,22 +1,114 @@
+"""
+Uploading files to S3.
+
+Files smaller than MULTIPART_THRESHOLD go up as a single PUT. Larger files
+use an S3 multipart upload, with parts uploaded concurrently by a shared pool
+of threads; a part that fails is retried on its own, without restarting the
+upload. Each thread keeps its own S3 connection and bucket objects for reuse
+across parts and files (boto connections aren't safe to share).
+
+StreamUploader uploads data as it's written, without a local file, holding
+only a few STREAM_PART_SIZE parts in memory.
+
+If the bucket name is a 'file://' URL the files are written under that local
+directory instead, going through the same part splitting, threads and
+retries, so uploads can be tested without S3.
+"""
+import hashlib
+import logging
 import os
+import shutil
+import threading
+import time
+import uuid
+
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
 
+logger = logging.getLogger(__name__)
 
-def copy_file_to_s3(bucket, keypath, filepath):
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 32 * 1024 * 1024
+
+# Parts of streamed uploads are held in memory, so they're smaller.
+STREAM_PART_SIZE = 8 * 1024 * 1024
+
+# S3 allows at most this many parts per upload.
+MAX_PARTS = 10000
+
+UPLOAD_THREADS = 4
+
+RETRIES = 5
+BACKOFF = 1
+
+LOCAL_PREFIX = 'file://'
+
+_local = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def upload_pool():
     """
-    Copy a local file to S3.
+    Return the thread pool used for uploading parts, creating it if needed.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(UPLOAD_THREADS)
+
+    return _pool
+
+
+def with_retries(function, *args):
+    """
+    Call function, retrying with exponential backoff if it raises.
+    """
+    for attempt in range(RETRIES + 1):
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt == RETRIES:
+                raise
+
+            logger.warn('%s failed, retrying: %s', function.__name__, e)
+
+            # Start again with a fresh connection in case it was the problem.
+            _local.__dict__.clear()
+
+            time.sleep(BACKOFF * 2 ** attempt)
+
+
+def get_bucket(bucket_name):
     """
-    key = os.getenv('AWS_ACCESS_KEY_ID')
-    secret = os.getenv('AWS_SECRET_ACCESS_KEY')
+    Return this thread's bucket object for bucket_name, connecting to S3 if
+    this thread hasn't already.
+    """
+    if not hasattr(_local, 'connection'):
+        key = os.getenv('AWS_ACCESS_KEY_ID')
+        secret = os.getenv('AWS_SECRET_ACCESS_KEY')
+
+        if not (key and secret):
+            raise Exception('You must specify AWS credentials.')
 
-    if not (key and secret):
-        raise Exception('You must specify AWS credentials.')
+        _local.connection = S3Connection(key, secret)
+        _local.buckets = {}
 
-    s3 = S3Connection(key, secret)
+    if bucket_name not in _local.buckets:
+        _local.buckets[bucket_name] = _local.connection.get_bucket(bucket_name)
 
-    bucket = s3.get_bucket(bucket)
-    key = bucket.new_key(keypath)
+    return _local.buckets[bucket_name]
+
+
+def content_type_headers(keypath):
+    """
+    Return the headers to upload a key with.
+    """
     # Override MIME type for compressed files, which AWS sets automatically.
     # These can be erroneous and, even if correct, ome browsers try to "help",
     # for example:
@@ -25,10 +117,286 @@ def copy_file_to_s3(bucket, keypath, filepath):
     # - 'foo.csv.bz2' set to type 'application/x-bzip2', browser renames the
     #    downloaded file to 'foo.bz2'.
     if keypath.endswith('.gz') or keypath.endswith('.bz2'):
-        key.set_metadata('Content-Type', 'application/octet-stream')
+        return {'Content-Type': 'application/octet-stream'}
+
+    return {}
+
+
+class S3Uploader(object):
+    """
+    Uploads to a key in an S3 bucket.
+    """
+
+    def __init__(self, bucket_name, keypath):
+        self.bucket_name = bucket_name
+        self.keypath = keypath
+        self.upload_id = None
+
+    def put(self, filepath):
+        key = get_bucket(self.bucket_name).new_key(self.keypath)
+        key.set_contents_from_filename(
+            filepath, headers=content_type_headers(self.keypath))
+        key.close()
+
+    def put_data(self, data):
+        key = get_bucket(self.bucket_name).new_key(self.keypath)
+        key.set_contents_from_string(
+            data, headers=content_type_headers(self.keypath))
+        key.close()
+
+    def _multipart_upload(self):
+        multipart_upload = MultiPartUpload(get_bucket(self.bucket_name))
+        multipart_upload.key_name = self.keypath
+        multipart_upload.id = self.upload_id
+
+        return multipart_upload
+
+    def start(self):
+        self.upload_id = get_bucket(self.bucket_name).initiate_multipart_upload(
+            self.keypath, headers=content_type_headers(self.keypath)).id
+
+    def put_part(self, part_number, filepath, offset, size):
+        with open(filepath, 'rb') as part_file:
+            part_file.seek(offset)
+
+            self._multipart_upload().upload_part_from_file(
+                part_file, part_number, size=size)
+
+    def put_part_data(self, part_number, data):
+        self._multipart_upload().upload_part_from_file(StringIO(data),
+                                                       part_number)
+
+    def complete(self):
+        self._multipart_upload().complete_upload()
+
+    def cancel(self):
+        self._multipart_upload().cancel_upload()
+
+
+class LocalUploader(object):
+    """
+    Uploads to a file in a local directory, standing in for S3.
+    """
+
+    def __init__(self, bucket_name, keypath):
+        self.directory = bucket_name[len(LOCAL_PREFIX):]
+        self.keypath = keypath
+        self.parts_directory = None
+
+    @property
+    def destination(self):
+        return os.path.join(self.directory, self.keypath)
+
+    def _make_parent(self):
+        if not os.path.isdir(os.path.dirname(self.destination)):
+            os.makedirs(os.path.dirname(self.destination))
+
+    def put(self, filepath):
+        self._make_parent()
+        shutil.copyfile(filepath, self.destination)
+
+    def put_data(self, data):
+        self._make_parent()
+
+        with open(self.destination, 'wb') as output_file:
+            output_file.write(data)
+
+    def start(self):
+        self.parts_directory = os.path.join(self.directory, '.uploads',
+                                            uuid.uuid4().hex)
+        os.makedirs(self.parts_directory)
+
+    def _part_path(self, part_number):
+        return os.path.join(self.parts_directory,
+                            'part-{:05d}'.format(part_number))
+
+    def put_part(self, part_number, filepath, offset, size):
+        with open(filepath, 'rb') as part_file, \
+                open(self._part_path(part_number), 'wb') as output_file:
+            part_file.seek(offset)
+            output_file.write(part_file.read(size))
+
+    def put_part_data(self, part_number, data):
+        with open(self._part_path(part_number), 'wb') as output_file:
+            output_file.write(data)
+
+    def complete(self):
+        self._make_parent()
+
+        with open(self.destination, 'wb') as output_file:
+            for part in sorted(os.listdir(self.parts_directory)):
+                with open(os.path.join(self.parts_directory, part),
+                          'rb') as part_file:
+                    shutil.copyfileobj(part_file, output_file)
+
+        self._remove_parts()
+
+    def cancel(self):
+        self._remove_parts()
+
+    def _remove_parts(self):
+        shutil.rmtree(self.parts_directory)
+
+        # Tidy up the uploads directory too, unless other uploads are using it.
+        try:
+            os.rmdir(os.path.dirname(self.parts_directory))
+        except OSError:
+            pass
+
+
+def make_uploader(bucket, keypath):
+    if bucket.startswith(LOCAL_PREFIX):
+        return LocalUploader(bucket, keypath)
+
+    return S3Uploader(bucket, keypath)
+
+
+def file_digest(filepath):
+    """
+    Return a digest of a file's contents, in the form 'sha256$<hex digest>'.
+    """
+    digest = hashlib.sha256()
+
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(PART_SIZE), ''):
+            digest.update(chunk)
+
+    return 'sha256$' + digest.hexdigest()
+
+
+def part_ranges(size):
+    """
+    Return the (part number, offset, size) of each part of a file.
+    """
+    part_size = max(PART_SIZE, -(-size // MAX_PARTS))
+
+    return [(number + 1, offset, min(part_size, size - offset))
+            for number, offset in enumerate(range(0, size, part_size))]
+
+
+def upload_file(uploader, filepath):
+    """
+    Upload a file with a single PUT or, if it's large, in concurrent parts.
+    """
+    size = os.path.getsize(filepath)
+
+    if size < MULTIPART_THRESHOLD:
+        with_retries(uploader.put, filepath)
+
+        return
+
+    with_retries(uploader.start)
+
+    parts = [upload_pool().apply_async(
+        with_retries, (uploader.put_part, number, filepath, offset,
+                       part_size))
+        for number, offset, part_size in part_ranges(size)]
+
+    try:
+        for part in parts:
+            part.get()
+
+        with_retries(uploader.complete)
+    except Exception:
+        # Let parts still in progress finish before cancelling the upload.
+        for part in parts:
+            part.wait()
+
+        uploader.cancel()
+
+        raise
+
+
+def copy_file_to_s3(bucket, keypath, filepath):
+    """
+    Copy a local file to S3.
+    """
+    upload_file(make_uploader(bucket, keypath), filepath)
 
-    key.set_contents_from_filename(filepath)
     print 'Setting bucket {} and key {} to contents from {}'.format(
         bucket, keypath, filepath)
-    key.close()
-    s3.close()
+
+
+class StreamUploader(object):
+    """
+    Write-only file-like object that uploads what's written to it, without
+    storing it on disk.
+
+    Data is uploaded in parts while it's still being written, and at most
+    UPLOAD_THREADS + 1 parts are held in memory. Data that fits in one part
+    is sent with a single PUT on close(). Call abort() instead of close() to
+    cancel the upload.
+
+    If the final size is known, passing it avoids running out of parts.
+    """
+
+    def __init__(self, bucket, keypath, size=None):
+        self.uploader = make_uploader(bucket, keypath)
+        self.part_size = max(STREAM_PART_SIZE, -(-(size or 0) // MAX_PARTS))
+        self.size = 0
+        self.closed = False
+
+        self._buffer = []
+        self._buffered = 0
+        self._parts = deque()
+        self._part_number = 0
+
+    def _submit(self, data):
+        if not self._part_number:
+            with_retries(self.uploader.start)
+
+        self._part_number += 1
+        self._parts.append(upload_pool().apply_async(
+            with_retries, (self.uploader.put_part_data, self._part_number,
+                           data)))
+
+        # Bound memory use by waiting for the oldest parts.
+        while len(self._parts) > UPLOAD_THREADS:
+            self._parts.popleft().get()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+
+        if self._buffered >= self.part_size:
+            data = ''.join(self._buffer)
+
+            while len(data) >= self.part_size:
+                self._submit(data[:self.part_size])
+                data = data[self.part_size:]
+
+            self._buffer = [data]
+            self._buffered = len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        if not self._part_number:
+            with_retries(self.uploader.put_data, ''.join(self._buffer))
+        else:
+            if self._buffered:
+                self._submit(''.join(self._buffer))
+
+            while self._parts:
+                self._parts.popleft().get()
+
+            with_retries(self.uploader.complete)
+
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+        if not self._part_number:
+            return
+
+        # Let parts still in progress finish before cancelling the upload.
+        for part in self._parts:
+            part.wait()
+
+        self.uploader.cancel()
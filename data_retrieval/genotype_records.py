@@ -0,0 +1,88 @@
+"""
+Validation and tokenizing of raw genotyping data lines.
+
+The genotyping sources (23andMe, AncestryDNA) validate every body line of a
+member's raw data against a strict pattern before keeping it, and then need
+the fields of that line for sex inference and VCF conversion. The parsers
+here do both with one compiled regular expression per line and return a
+GenotypeRecord:
+
+    line      the original line, as written to the cleaned raw file
+    rsid      SNP identifier, e.g. 'rs123' or 'i456'
+    chrom     chromosome code as given in the file, e.g. '1', 'MT' or '24'
+    pos       position, as a string
+    alleles   the genotype as one string, e.g. 'AG'
+    called    True if every allele is an explicit base call (A, C, G or T)
+    y_called  True for AncestryDNA Y chromosome (24) lines with both alleles
+              called, including deletions and insertions
+
+Header lines are carried as records with only the line set, so cleaned
+files can be generated as one stream of records.
+"""
+import re
+
+from collections import namedtuple
+
+GenotypeRecord = namedtuple(
+    'GenotypeRecord',
+    ['line', 'rsid', 'chrom', 'pos', 'alleles', 'called', 'y_called'])
+
+LINE_23ANDME_RE = re.compile(
+    r'((?:rs|i)[0-9]+)\t([1-9XYM][0-9T]?)\t([0-9]+)\t([ACGT\-ID][ACGT\-ID]?)')
+CALLED_23ANDME_RE = re.compile(r'^[ACGT]{1,2}$')
+
+LINE_ANCESTRYDNA_RE = re.compile(
+    r'((?:rs|VGXS)[0-9]+)\t([1-9][0-9]?)\t([0-9]+)\t([ACGTDI0])\t([ACGTDI0])')
+BASES = frozenset('ACGT')
+Y_CALLS = frozenset('ACGTDI')
+
+
+def header_record(line):
+    return GenotypeRecord(line, None, None, None, None, False, False)
+
+
+def fields(match, line):
+    """
+    Return the tab separated fields of a line matched by a line pattern.
+
+    The patterns only match the start of a line, so if anything but
+    whitespace follows the match the last field may be longer than the
+    matched group; split the line in that case.
+    """
+    if line[match.end():].strip():
+        return line.rstrip().split('\t')
+
+    return match.groups()
+
+
+def parse_23andme_line(line):
+    """
+    Return a GenotypeRecord for a valid 23andMe body line, or None.
+    """
+    match = LINE_23ANDME_RE.match(line)
+
+    if not match:
+        return None
+
+    data = fields(match, line)
+
+    return GenotypeRecord(line, data[0], data[1], data[2], data[3],
+                          bool(CALLED_23ANDME_RE.match(data[3])), False)
+
+
+def parse_ancestrydna_line(line):
+    """
+    Return a GenotypeRecord for a valid AncestryDNA body line, or None.
+    """
+    match = LINE_ANCESTRYDNA_RE.match(line)
+
+    if not match:
+        return None
+
+    data = fields(match, line)
+
+    return GenotypeRecord(
+        line, data[0], data[1], data[2], data[3] + data[4],
+        data[3] in BASES and data[4] in BASES,
+        data[1] == '24' and match.group(4) in Y_CALLS and
+        match.group(5) in Y_CALLS)
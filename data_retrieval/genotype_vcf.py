@@ -0,0 +1,97 @@
+"""
+Chunked conversion of genotype calls to VCF lines.
+
+Used by the genotyping sources (23andMe, AncestryDNA) to turn their parsed
+raw data into VCF records. Instead of handling one line at a time, calls are
+collected into chunks: reference bases for a whole chunk are resolved with a
+single batched index lookup, the ALT/INFO/GT columns come from a table
+memoized per (reference base, alleles) pair, and each chunk is formatted
+into one string.
+
+Genotype calls are tuples of:
+
+    (rsid, chrom, vcf_chrom, pos, alleles)
+
+where chrom is the chromosome name used by the reference index, vcf_chrom
+is the name to report in the VCF, pos is the position as a string and
+alleles is a string of one or two bases.
+"""
+from itertools import islice, izip
+
+CHUNK_SIZE = 50000
+
+VCF_LINE = '%s\t%s\t%s\t%s\t%s\t.\t.\t%s\tGT\t%s'
+
+# (ref, alleles) -> (ALT column, whether there are ALT alleles, GT column)
+_GENOTYPE_FIELDS = {}
+
+
+def genotype_fields(ref, alleles):
+    """
+    Return the ALT column, whether any ALT alleles exist, and the GT column.
+    """
+    key = (ref, alleles)
+
+    if key not in _GENOTYPE_FIELDS:
+        alt_alleles = []
+
+        for allele in alleles:
+            if allele != ref and allele not in alt_alleles:
+                alt_alleles.append(allele)
+
+        all_alleles = [ref] + alt_alleles
+        genotype_indexed = '/'.join([str(all_alleles.index(x))
+                                     for x in alleles])
+
+        _GENOTYPE_FIELDS[key] = (','.join(alt_alleles) or '.',
+                                 bool(alt_alleles),
+                                 genotype_indexed)
+
+    return _GENOTYPE_FIELDS[key]
+
+
+def chunks(iterable, size=CHUNK_SIZE):
+    """
+    Generate lists of up to size items from an iterable.
+    """
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def vcf_lines_from_calls(calls, reference, chunk_size=CHUNK_SIZE):
+    """
+    Generate blocks of VCF body lines from an iterable of genotype calls.
+
+    Each block is a string of complete, newline terminated lines. Calls
+    without a reference base are skipped.
+    """
+    for chunk in chunks(calls, chunk_size):
+        refs = reference.lookup_many([(call[1], call[3]) for call in chunk])
+        lines = []
+
+        for (rsid, _, vcf_chrom, pos, alleles), ref in izip(chunk, refs):
+            if not ref:
+                continue
+
+            alt, has_alt, genotype_indexed = genotype_fields(ref, alleles)
+
+            lines.append(VCF_LINE % (
+                vcf_chrom,
+                pos,
+                rsid if rsid.startswith('rs') else '.',
+                ref,
+                alt,
+                '.' if has_alt else 'END=' + pos,
+                genotype_indexed))
+
+        if lines:
+            lines.append('')
+
+            yield '\n'.join(lines)
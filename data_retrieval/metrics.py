@@ -0,0 +1,235 @@
+"""
+Stage timers and byte and row counters for source runs.
+
+BaseSource records how long each stage of a run takes (downloading,
+opening the input, creating files, uploading to S3, Open Humans requests and
+so on) and how many bytes and rows it handles, labelled with the source.
+They're sent to the backends named in METRICS_BACKENDS (comma separated):
+
+    memory  totals kept in the process.
+    redis   totals kept in Redis (at REDIS_URL), shared by every process.
+    statsd  sent to a StatsD server at STATSD_HOST:STATSD_PORT as timings
+            and counters named <STATSD_PREFIX>.<source>.<name>.
+
+GET /metrics on the web process reports the totals of the first backend that
+keeps them, in the Prometheus text format. Tasks run in worker processes, so
+for /metrics to report them use the redis backend. Recording a metric never
+raises; failures are logged and the metric is dropped.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_BACKENDS = os.getenv('METRICS_BACKENDS') or 'memory'
+
+STATSD_HOST = os.getenv('STATSD_HOST') or 'localhost'
+STATSD_PORT = int(os.getenv('STATSD_PORT') or 8125)
+STATSD_PREFIX = os.getenv('STATSD_PREFIX') or 'data_processing'
+
+# Prefixed to metric names in the Prometheus text format.
+PROMETHEUS_PREFIX = 'data_processing_'
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+class MemoryBackend(object):
+    """
+    Keeps totals in the process.
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+        self._lock = threading.Lock()
+
+    def count(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.totals[key] = self.totals.get(key, 0) + value
+
+    def timing(self, name, labels, seconds):
+        self.count(name + '_seconds', labels, seconds)
+        self.count(name + '_runs', labels, 1)
+
+    def snapshot(self):
+        with self._lock:
+            return [(name, dict(labels), value)
+                    for (name, labels), value in self.totals.items()]
+
+
+class RedisBackend(MemoryBackend):
+    """
+    Keeps totals in a Redis hash, so every process adds to the same ones.
+    """
+
+    key = 'Metrics:TOTALS'
+
+    def __init__(self, redis=None):
+        if redis is None:
+            from data_retrieval.task_locks import get_redis
+
+            redis = get_redis()
+
+        self.redis = redis
+
+    def count(self, name, labels, value):
+        self.redis.hincrbyfloat(
+            self.key, json.dumps([name, sorted(labels.items())]), value)
+
+    def snapshot(self):
+        totals = []
+
+        for field, value in self.redis.hgetall(self.key).items():
+            name, labels = json.loads(field)
+
+            totals.append((name, dict(labels), float(value)))
+
+        return totals
+
+
+class StatsdBackend(object):
+    """
+    Sends timings and counters to a StatsD server over UDP.
+    """
+
+    def __init__(self, host=STATSD_HOST, port=STATSD_PORT,
+                 prefix=STATSD_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def metric_name(self, name, labels):
+        return '.'.join([self.prefix] +
+                        [labels[label] for label in sorted(labels)] +
+                        [name])
+
+    def send(self, data):
+        self._socket.sendto(data, self.address)
+
+    def count(self, name, labels, value):
+        self.send('{}:{}|c'.format(self.metric_name(name, labels), value))
+
+    def timing(self, name, labels, seconds):
+        self.send('{}:{:.3f}|ms'.format(self.metric_name(name, labels),
+                                        seconds * 1000))
+
+    def snapshot(self):
+        return None
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'redis': RedisBackend,
+    'statsd': StatsdBackend,
+}
+
+
+class MetricsRecorder(object):
+    """
+    Records metrics to each of a list of backends.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+
+    def _send(self, method, name, labels, value):
+        for backend in self.backends:
+            try:
+                getattr(backend, method)(name, labels, value)
+            except Exception as e:
+                logger.warning('metrics: unable to record "%s" with %s: %s',
+                               name, type(backend).__name__, e)
+
+    def count(self, name, value=1, **labels):
+        self._send('count', name, labels, value)
+
+    def timing(self, name, seconds, **labels):
+        self._send('timing', name, labels, seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Record the time taken by a with block, whether or not it raises.
+        """
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        """
+        Return (name, labels, value) for every total kept by the first
+        backend that keeps them, or an empty list.
+        """
+        for backend in self.backends:
+            try:
+                totals = backend.snapshot()
+            except Exception as e:
+                logger.warning('metrics: unable to read %s: %s',
+                               type(backend).__name__, e)
+
+                continue
+
+            if totals is not None:
+                return totals
+
+        return []
+
+
+def metrics_recorder():
+    """
+    Return the process's MetricsRecorder, creating it if needed.
+    """
+    global _recorder
+
+    with _recorder_lock:
+        if _recorder is None:
+            backends = []
+
+            for name in METRICS_BACKENDS.split(','):
+                name = name.strip()
+
+                if name not in BACKENDS:
+                    raise ValueError('Unknown metrics backend "{}"'.format(
+                        name))
+
+                backends.append(BACKENDS[name]())
+
+            _recorder = MetricsRecorder(backends)
+
+    return _recorder
+
+
+def prometheus_text(totals):
+    """
+    Format totals from MetricsRecorder.snapshot as Prometheus counters.
+    """
+    lines = []
+    names = set()
+
+    for name, labels, value in sorted(totals):
+        metric = '{}{}_total'.format(PROMETHEUS_PREFIX, name)
+
+        if metric not in names:
+            names.add(metric)
+            lines.append('# TYPE {} counter'.format(metric))
+
+        label_text = ','.join(
+            '{}="{}"'.format(label, str(labels[label]).replace('"', '\\"'))
+            for label in sorted(labels))
+
+        lines.append('{}{{{}}} {}'.format(metric, label_text, repr(value)))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,103 @@
+"""
+Fingerprints of original source file paths, stored as orig_file_hash.
+
+Genotyping sources store a fingerprint of the uploaded file's URL path in
+the metadata of the files they create, and skip reprocessing if a new task
+has the same path.
+
+Fingerprints used to be bcrypt hashes, which are deliberately slow to check.
+New fingerprints are a keyed HMAC-SHA256 of the path, prefixed with the
+scheme name so further schemes can be added:
+
+    hmac-sha256$<hex digest>
+
+Stored bcrypt hashes still verify. Once one has been checked against a path,
+the result is cached as the HMAC fingerprint of that path (in the process,
+and in the CacheItem table if persist is set), so later checks of old files
+cost an HMAC rather than a bcrypt round.
+"""
+import hashlib
+import hmac
+import os
+
+import bcrypt
+
+from models import CacheItem, db
+
+HMAC_PREFIX = 'hmac-sha256$'
+
+# Key for HMAC fingerprints. It must never change: stored fingerprints made
+# with another key don't match, so every member's files would be reprocessed.
+# Only needed by sources processing a file_url, so checked when used.
+ORIG_FILE_HASH_KEY = os.getenv('ORIG_FILE_HASH_KEY')
+
+CACHE_KEY_PREFIX = 'orig_file_hash:'
+
+# bcrypt hash -> HMAC fingerprint of the path it was verified against
+_VERIFIED = {}
+
+
+def make_orig_file_hash(url_path):
+    """
+    Return the current-scheme fingerprint of a URL path.
+    """
+    if not ORIG_FILE_HASH_KEY:
+        raise RuntimeError('ORIG_FILE_HASH_KEY must be set; it keys the '
+                           'orig_file_hash fingerprints of processed files')
+
+    return HMAC_PREFIX + hmac.new(ORIG_FILE_HASH_KEY, str(url_path),
+                                  hashlib.sha256).hexdigest()
+
+
+def _cached_fingerprint(orig_file_hash, persist):
+    if orig_file_hash in _VERIFIED:
+        return _VERIFIED[orig_file_hash]
+
+    if persist:
+        cached = (CacheItem.query
+                  .filter_by(key=CACHE_KEY_PREFIX + orig_file_hash)
+                  .first())
+
+        if cached:
+            _VERIFIED[orig_file_hash] = cached.response['fingerprint']
+
+            return _VERIFIED[orig_file_hash]
+
+    return None
+
+
+def _cache_fingerprint(orig_file_hash, fingerprint, persist):
+    _VERIFIED[orig_file_hash] = fingerprint
+
+    if persist:
+        db.session.add(CacheItem(CACHE_KEY_PREFIX + orig_file_hash,
+                                 {'fingerprint': fingerprint}))
+        db.session.commit()
+
+
+def check_orig_file_hash(orig_file_hash, url_path, persist=False):
+    """
+    Return True if orig_file_hash is a fingerprint of url_path.
+
+    Accepts current HMAC fingerprints and legacy bcrypt hashes.
+    """
+    if not orig_file_hash:
+        return False
+
+    orig_file_hash = str(orig_file_hash)
+    fingerprint = make_orig_file_hash(url_path)
+
+    if orig_file_hash.startswith(HMAC_PREFIX):
+        return hmac.compare_digest(orig_file_hash, fingerprint)
+
+    cached = _cached_fingerprint(orig_file_hash, persist)
+
+    if cached:
+        return hmac.compare_digest(cached, fingerprint)
+
+    if bcrypt.hashpw(str(url_path), orig_file_hash) != orig_file_hash:
+        return False
+
+    _cache_fingerprint(orig_file_hash, fingerprint, persist)
+
+    return True
@@ -0,0 +1,99 @@
+"""
+Requeue delays from the rate limit state requests-respectful keeps in Redis.
+
+requests-respectful stores each realm's limits in the hash
+'RespectfulRequester:REALMS:<realm>' (max_requests and timespan), and each
+request made in a realm as a key 'RespectfulRequester:REQUEST:<realm>:<id>'
+that expires timespan seconds after the request. A realm allows another
+request while fewer than max_requests minus the safety threshold of those
+keys exist, so the time until n more requests are allowed is the time until
+enough of them have expired.
+
+requeue_countdown uses this to requeue a rate limited task for when the
+budget for its remaining requests is next free in all of its realms, rather
+than after a fixed delay.
+"""
+import logging
+
+from redis import RedisError
+
+logger = logging.getLogger(__name__)
+
+REALM_KEY = 'RespectfulRequester:REALMS:{}'
+REQUEST_KEYS = 'RespectfulRequester:REQUEST:{}:*'
+
+# Never requeue sooner than this, in seconds; budget may be taken again by
+# other tasks in the meantime.
+MIN_COUNTDOWN = 10
+
+# Added to computed delays to allow for the granularity of Redis TTLs.
+COUNTDOWN_MARGIN = 2
+
+# Used if Redis can't be read.
+FALLBACK_COUNTDOWN = 900
+
+
+def request_ttls(redis, realm):
+    """
+    Return the seconds until each request counted against a realm expires,
+    sorted.
+    """
+    keys = list(redis.scan_iter(match=REQUEST_KEYS.format(realm), count=1000))
+
+    pipeline = redis.pipeline(transaction=False)
+
+    for key in keys:
+        pipeline.ttl(key)
+
+    # Keys that expired since the scan have a TTL of -2.
+    return sorted(ttl for ttl in pipeline.execute() if ttl >= 0)
+
+
+def seconds_until_free(redis, realm, requests_needed=1, safety_threshold=0):
+    """
+    Return the seconds until a realm allows requests_needed more requests,
+    or as many as it ever allows at once if that's fewer. Realms that aren't
+    registered don't limit requests.
+    """
+    realm_info = redis.hgetall(REALM_KEY.format(realm))
+
+    if not realm_info:
+        return 0
+
+    limit = int(realm_info['max_requests']) - safety_threshold
+    requests_needed = max(1, min(requests_needed, limit))
+
+    ttls = request_ttls(redis, realm)
+
+    # Requests are allowed while fewer than limit are counted, so this many
+    # have to expire first.
+    expiring = len(ttls) - (limit - requests_needed)
+
+    if expiring <= 0:
+        return 0
+
+    return ttls[expiring - 1]
+
+
+def requeue_countdown(redis, realms, requests_needed=None, safety_threshold=0,
+                      minimum=MIN_COUNTDOWN):
+    """
+    Return the delay in seconds after which every realm will allow the
+    requests a task still needs (or one request, if that isn't known).
+    """
+    try:
+        waits = [seconds_until_free(redis, realm, requests_needed or 1,
+                                    safety_threshold)
+                 for realm in realms]
+    except RedisError as e:
+        logger.warning('Unable to read rate limits, requeueing in %ss: %s',
+                       FALLBACK_COUNTDOWN, e)
+
+        return FALLBACK_COUNTDOWN
+
+    countdown = max([minimum] + [wait + COUNTDOWN_MARGIN for wait in waits])
+
+    logger.info('Rate limited in %s; %s requests needed, requeueing in %ss',
+                ', '.join(realms), requests_needed or 'unknown', countdown)
+
+    return countdown
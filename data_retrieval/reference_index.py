@@ -0,0 +1,247 @@
+"""
+Memory-mapped reference genotype index.
+
+The genotyping sources need the reference base for every called position in
+a member's raw data file. The reference is shipped as a tab separated text
+file ('reference_b37.txt', one "chromosome, position, base" triple per line)
+which is slow to parse and expensive to hold as Python strings.
+
+This module compiles that text file once into a binary index stored next to
+it (same name with an '.idx' suffix) and opens it with mmap. The index pages
+live in the OS page cache, so every forked Celery child reads the same
+physical memory instead of building its own dict.
+
+Index layout (all integers little-endian):
+
+    magic            8 bytes, INDEX_MAGIC
+    chromosome count uint32
+    record count     uint32
+    chromosome table chromosome count entries of:
+                         name   16 bytes, NUL padded
+                         start  uint32, first record index
+                         end    uint32, one past the last record index
+    positions        record count uint32, sorted within each chromosome
+    bases            record count bytes, the reference base per position
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+from bisect import bisect_left
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = 'OHREFIX1'
+INDEX_SUFFIX = '.idx'
+
+HEADER = struct.Struct('<8sII')
+CHROM_ENTRY = struct.Struct('<16sII')
+POSITION = struct.Struct('<I')
+
+# Opened indexes, keyed by reference file path, shared by the whole process.
+_INDEXES = {}
+
+
+def index_path_for(reference_path):
+    return reference_path + INDEX_SUFFIX
+
+
+def build_reference_index(reference_path, index_path=None):
+    """
+    Compile a reference text file into a binary index, return its path.
+
+    The index is written to a temporary file and renamed into place, so
+    concurrent workers never see a partially written index.
+    """
+    if not index_path:
+        index_path = index_path_for(reference_path)
+
+    logger.info('Building reference index "%s" from "%s"', index_path,
+                reference_path)
+
+    reference = {}
+
+    with open(reference_path) as f:
+        for line in f:
+            data = line.rstrip().split('\t')
+
+            if len(data) < 3:
+                continue
+
+            reference.setdefault(data[0], {})[int(data[1])] = data[2][0]
+
+    chroms = sorted(reference.keys())
+    table = []
+    positions = []
+    bases = []
+
+    for chrom in chroms:
+        start = len(positions)
+
+        for pos in sorted(reference[chrom]):
+            positions.append(pos)
+            bases.append(reference[chrom][pos])
+
+        table.append((chrom, start, len(positions)))
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(index_path) or '.')
+
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(INDEX_MAGIC, len(table), len(positions)))
+
+        for chrom, start, end in table:
+            f.write(CHROM_ENTRY.pack(chrom, start, end))
+
+        f.write(struct.pack('<{}I'.format(len(positions)), *positions))
+        f.write(''.join(bases))
+
+    # mkstemp creates the file readable only by us; the index is shared.
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, index_path)
+
+    return index_path
+
+
+class ReferenceIndex(object):
+    """
+    Read-only lookups of reference bases in a memory-mapped index.
+
+    Positions may be given as integers or as the decimal strings found in
+    raw genotyping files. Lookups for unknown chromosomes or positions
+    return None.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+        with open(index_path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, chrom_count, self.record_count = HEADER.unpack_from(self.mmap)
+
+        if magic != INDEX_MAGIC:
+            raise ValueError('Not a reference index: "{}"'.format(index_path))
+
+        self.chroms = {}
+
+        for i in range(chrom_count):
+            name, start, end = CHROM_ENTRY.unpack_from(
+                self.mmap, HEADER.size + i * CHROM_ENTRY.size)
+
+            self.chroms[name.rstrip('\0')] = (start, end)
+
+        self.positions_offset = HEADER.size + chrom_count * CHROM_ENTRY.size
+        self.bases_offset = (self.positions_offset +
+                             self.record_count * POSITION.size)
+
+    def __len__(self):
+        return self.record_count
+
+    def _position(self, i):
+        return POSITION.unpack_from(
+            self.mmap, self.positions_offset + i * POSITION.size)[0]
+
+    def _bisect(self, pos, lo, hi):
+        """
+        Return the first record index in [lo, hi) with a position >= pos.
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._position(mid) < pos:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _base(self, i):
+        offset = self.bases_offset + i
+
+        return self.mmap[offset:offset + 1]
+
+    def lookup(self, chrom, pos):
+        """
+        Return the reference base at a chromosome and position, or None.
+        """
+        try:
+            start, end = self.chroms[chrom]
+        except KeyError:
+            return None
+
+        pos = int(pos)
+        i = self._bisect(pos, start, end)
+
+        if i < end and self._position(i) == pos:
+            return self._base(i)
+
+        return None
+
+    def lookup_many(self, loci):
+        """
+        Return reference bases for a sequence of (chromosome, position) pairs.
+
+        The result is a list aligned with the input, containing None for
+        unknown loci. For each chromosome the span of the index covering the
+        requested positions is unpacked in one call and searched with the C
+        bisect, rather than walking the mmap one position at a time.
+        """
+        results = [None] * len(loci)
+        queries = defaultdict(list)
+
+        for i, (chrom, pos) in enumerate(loci):
+            queries[chrom].append((int(pos), i))
+
+        for chrom, chrom_queries in queries.items():
+            if chrom not in self.chroms:
+                continue
+
+            start, end = self.chroms[chrom]
+            query_positions = [pos for pos, _ in chrom_queries]
+            lo = self._bisect(min(query_positions), start, end)
+            hi = self._bisect(max(query_positions) + 1, lo, end)
+
+            positions = struct.unpack_from(
+                '<{}I'.format(hi - lo), self.mmap,
+                self.positions_offset + lo * POSITION.size)
+            bases = self.mmap[self.bases_offset + lo:self.bases_offset + hi]
+
+            for pos, i in chrom_queries:
+                j = bisect_left(positions, pos)
+
+                if j < len(positions) and positions[j] == pos:
+                    results[i] = bases[j]
+
+        return results
+
+
+def open_reference_index(reference_path):
+    """
+    Return the shared ReferenceIndex for a reference text file.
+
+    The binary index is built on first use, and rebuilt if the reference text
+    file is newer than it.
+    """
+    if reference_path in _INDEXES:
+        return _INDEXES[reference_path]
+
+    index_path = index_path_for(reference_path)
+
+    if (not os.path.exists(index_path) or
+            (os.path.exists(reference_path) and
+             os.path.getmtime(reference_path) > os.path.getmtime(index_path))):
+        build_reference_index(reference_path, index_path)
+
+    _INDEXES[reference_path] = ReferenceIndex(index_path)
+
+    return _INDEXES[reference_path]
+
+
+if __name__ == '__main__':
+    import sys
+
+    for path in sys.argv[1:]:
+        print 'Wrote {}'.format(build_reference_index(path))
@@ -0,0 +1,379 @@
+"""
+Scratch space for sources' temporary files, managed per worker process.
+
+Each source run gets a ScratchSpace: a directory under SCRATCH_DIRECTORY,
+plus one on a RAM-backed tmpfs (SCRATCH_FAST_DIRECTORY, /dev/shm by default)
+for files the source says are small, such as JSON metadata. A small file
+may be up to SMALL_FILE_SIZE bytes; its size isn't known when it's placed,
+so a new one goes in the fast tier only if that much would fit. The fast
+tier holds at most SCRATCH_FAST_BUDGET bytes for each process, and every
+worker process shares the tmpfs, so it must also have SMALL_FILE_SIZE plus
+MIN_FAST_FREE_SPACE free. Otherwise, or if there's no tmpfs, small files go
+to disk like the rest.
+
+Downloads are admitted before they start: a file whose Content-Length would
+take the process's scratch usage over SCRATCH_DISK_BUDGET (if set), or leave
+less than MIN_FREE_SPACE free on the disk, raises ScratchSpaceError instead
+of filling the disk part way through. Downloads still in progress count as
+what they've written so far (which is already on disk) plus the rest of
+their Content-Length.
+
+Spaces are removed by close(), which BaseSource.run calls on every exit
+path. Prefork worker children end with os._exit, which skips atexit
+handlers, so a space left open when one of them ends (or is killed) is only
+removed by the sweep: when a process first uses scratch space it removes
+the directories of this host's processes that are no longer running.
+"""
+import atexit
+import errno
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_DIRECTORY = os.getenv('SCRATCH_DIRECTORY') or tempfile.gettempdir()
+
+# Bytes of scratch space on disk a worker process may use; 0 for no limit
+# other than the disk's free space.
+SCRATCH_DISK_BUDGET = int(os.getenv('SCRATCH_DISK_BUDGET', 0))
+
+SCRATCH_FAST_DIRECTORY = os.getenv('SCRATCH_FAST_DIRECTORY', '/dev/shm')
+SCRATCH_FAST_BUDGET = int(os.getenv('SCRATCH_FAST_BUDGET', 64 * 1024 * 1024))
+
+# Free space always left on the scratch disk by admitted downloads.
+MIN_FREE_SPACE = 256 * 1024 * 1024
+
+# The largest file a source may create with small=True.
+SMALL_FILE_SIZE = 4 * 1024 * 1024
+
+# Free space always left on the fast tier's tmpfs, which is RAM.
+MIN_FAST_FREE_SPACE = 64 * 1024 * 1024
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class ScratchSpaceError(IOError):
+    """
+    Raised when a download doesn't fit in the scratch space budget.
+    """
+
+
+def directory_size(directory):
+    """
+    Return the total size of the files under a directory.
+    """
+    size = 0
+
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                # Removed while we were looking.
+                pass
+
+    return size
+
+
+def free_space(directory):
+    stat = os.statvfs(directory)
+
+    return stat.f_bavail * stat.f_frsize
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+class ScratchManager(object):
+    """
+    Tracks the scratch spaces of a worker process, their budget and usage
+    metrics.
+    """
+
+    def __init__(self, directory=SCRATCH_DIRECTORY,
+                 disk_budget=SCRATCH_DISK_BUDGET,
+                 fast_directory=SCRATCH_FAST_DIRECTORY,
+                 fast_budget=SCRATCH_FAST_BUDGET):
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self.fast_budget = fast_budget
+
+        if fast_directory and os.access(fast_directory, os.W_OK):
+            self.fast_directory = fast_directory
+        else:
+            self.fast_directory = None
+
+        # Directories are named for the host and process that made them, so
+        # stale ones can be recognized.
+        self.prefix = 'ohdp-{}-'.format(socket.gethostname())
+
+        self.spaces = set()
+        # (size, path) of each admitted download still in progress.
+        self.reservations = []
+
+        self.counts = {
+            'spaces_created': 0,
+            'spaces_closed': 0,
+            'spaces_swept': 0,
+            'downloads_admitted': 0,
+            'downloads_rejected': 0,
+            'bytes_admitted': 0,
+            'fast_files': 0,
+            'fast_fallbacks': 0,
+            'peak_disk_usage': 0,
+        }
+
+        self._lock = threading.Lock()
+
+    def make_directory(self, directory):
+        return tempfile.mkdtemp(
+            prefix='{}{}-'.format(self.prefix, os.getpid()), dir=directory)
+
+    def create(self):
+        """
+        Return a new ScratchSpace.
+        """
+        space = ScratchSpace(self, self.make_directory(self.directory))
+
+        with self._lock:
+            self.spaces.add(space)
+            self.counts['spaces_created'] += 1
+
+        return space
+
+    def closed(self, space):
+        with self._lock:
+            self.spaces.discard(space)
+            self.counts['spaces_closed'] += 1
+
+    def disk_usage(self):
+        return sum(directory_size(space.directory)
+                   for space in list(self.spaces))
+
+    def fast_usage(self):
+        return sum(directory_size(space.fast_directory)
+                   for space in list(self.spaces) if space.fast_directory)
+
+    def use_fast(self):
+        """
+        Return whether another small file, of up to SMALL_FILE_SIZE bytes,
+        fits in the fast tier: within this process's budget, and leaving
+        MIN_FAST_FREE_SPACE free on the tmpfs the other processes share.
+        """
+        fits = (self.fast_directory is not None and
+                self.fast_usage() + SMALL_FILE_SIZE <= self.fast_budget and
+                free_space(self.fast_directory) - SMALL_FILE_SIZE >=
+                MIN_FAST_FREE_SPACE)
+
+        with self._lock:
+            self.counts['fast_files' if fits else 'fast_fallbacks'] += 1
+
+        return fits
+
+    def reserved(self):
+        """
+        Return the bytes admitted downloads have still to write. What they've
+        written is already counted by disk_usage.
+        """
+        reserved = 0
+
+        for size, path in list(self.reservations):
+            try:
+                written = os.path.getsize(path) if path else 0
+            except OSError:
+                # Not created yet.
+                written = 0
+
+            reserved += max(0, size - written)
+
+        return reserved
+
+    def admit(self, size, path=None):
+        """
+        Reserve space for a download of size bytes (None if unknown) to path,
+        or raise ScratchSpaceError if it won't fit. Return the reservation,
+        to pass to release.
+        """
+        with self._lock:
+            usage = self.disk_usage()
+
+            self.counts['peak_disk_usage'] = max(
+                self.counts['peak_disk_usage'], usage)
+
+            needed = self.reserved() + (size or 0)
+
+            if self.disk_budget and usage + needed > self.disk_budget:
+                error = ('would exceed the scratch disk budget of {} bytes '
+                         '({} in use)'.format(self.disk_budget, usage))
+            elif free_space(self.directory) - needed < MIN_FREE_SPACE:
+                error = 'would leave less than {} bytes free on disk'.format(
+                    MIN_FREE_SPACE)
+            else:
+                error = None
+
+            if error:
+                self.counts['downloads_rejected'] += 1
+
+                raise ScratchSpaceError('Download of {} bytes {}'.format(
+                    size if size is not None else 'unknown', error))
+
+            reservation = (size or 0, path)
+
+            self.reservations.append(reservation)
+            self.counts['downloads_admitted'] += 1
+            self.counts['bytes_admitted'] += size or 0
+
+            return reservation
+
+    def release(self, reservation):
+        with self._lock:
+            self.reservations.remove(reservation)
+
+    def sweep(self):
+        """
+        Remove scratch directories left by this host's dead processes.
+        """
+        for directory in set([self.directory, self.fast_directory]):
+            if not directory:
+                continue
+
+            for name in os.listdir(directory):
+                if not name.startswith(self.prefix):
+                    continue
+
+                pid = name[len(self.prefix):].split('-')[0]
+
+                if not pid.isdigit() or process_alive(int(pid)):
+                    continue
+
+                logger.info('scratch: removing stale directory "%s"', name)
+
+                shutil.rmtree(os.path.join(directory, name),
+                              ignore_errors=True)
+
+                self.counts['spaces_swept'] += 1
+
+    def close_all(self):
+        for space in list(self.spaces):
+            space.close()
+
+    def metrics(self):
+        """
+        Return a dict of usage counters and current usage in bytes.
+        """
+        metrics = dict(self.counts)
+
+        metrics.update({
+            'spaces_open': len(self.spaces),
+            'disk_usage': self.disk_usage(),
+            'fast_usage': self.fast_usage(),
+            'reserved': self.reserved(),
+        })
+
+        metrics['peak_disk_usage'] = max(metrics['peak_disk_usage'],
+                                         metrics['disk_usage'])
+
+        return metrics
+
+
+def scratch_manager():
+    """
+    Return the worker process's ScratchManager, creating it (and sweeping
+    up after dead processes) if needed.
+    """
+    global _manager
+
+    with _manager_lock:
+        if _manager is None:
+            _manager = ScratchManager()
+            _manager.sweep()
+
+            # Only runs in processes that exit normally, such as a CLI run;
+            # see the sweep above for prefork worker children.
+            atexit.register(_manager.close_all)
+
+    return _manager
+
+
+class ScratchSpace(object):
+    """
+    The scratch directories of one source run.
+    """
+
+    def __init__(self, manager, directory):
+        self.manager = manager
+        self.directory = directory
+        self.fast_directory = None
+        self.closed = False
+
+        self._fast_files = set()
+
+    def join(self, path, small=False):
+        """
+        Return the path for a file in the scratch space. Files first joined
+        with small=True may be put in the fast tier, and are found there
+        afterwards.
+        """
+        if path in self._fast_files:
+            return os.path.join(self.fast_directory, path)
+
+        if small and self.manager.use_fast():
+            if not self.fast_directory:
+                self.fast_directory = self.manager.make_directory(
+                    self.manager.fast_directory)
+
+            self._fast_files.add(path)
+
+            return os.path.join(self.fast_directory, path)
+
+        return os.path.join(self.directory, path)
+
+    @contextmanager
+    def admission(self, size, path=None):
+        """
+        Hold a reservation for a download of size bytes to path while it
+        runs.
+        """
+        reservation = self.manager.admit(size, path)
+
+        try:
+            yield
+        finally:
+            self.manager.release(reservation)
+
+    def close(self):
+        """
+        Remove the scratch directories. Safe to call more than once.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+
+        logger.info('scratch: removing "%s" (%s bytes)', self.directory,
+                    directory_size(self.directory))
+
+        for directory in [self.directory, self.fast_directory]:
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        self.manager.closed(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,68 @@
+"""
+Pooled HTTP sessions, shared by everything in a worker process.
+
+Module-level requests.get() and requests.post() open a new connection (and
+TLS handshake) for every call. Calls made through request(), get() and post()
+here instead use one requests.Session per scheme and host, which keeps
+connections alive between calls. At most HTTP_POOL_SIZE connections are kept
+to each host; once that many are in use further requests wait for one.
+
+The sessions never store cookies, since they're shared by every member's
+tasks: a cookie set in response to one member's request would otherwise be
+sent with the next member's. Cookies passed to a request are still sent.
+"""
+import os
+import threading
+
+from cookielib import DefaultCookiePolicy
+from urlparse import urlsplit
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+# Connections kept open to each host.
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def session_for(url):
+    """
+    Return the shared session for a URL's scheme and host, creating it if
+    needed.
+    """
+    scheme, host = urlsplit(url)[:2]
+
+    with _sessions_lock:
+        if (scheme, host) not in _sessions:
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=HTTP_POOL_SIZE,
+                                  pool_block=True)
+
+            session = requests.Session()
+            session.mount('{}://'.format(scheme), adapter)
+
+            # Don't keep cookies from one member's requests for the next.
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+            _sessions[(scheme, host)] = session
+
+    return _sessions[(scheme, host)]
+
+
+def request(method, url, **kwargs):
+    """
+    Make a request with the shared session for its host; takes the same
+    arguments as requests.request().
+    """
+    return session_for(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('get', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('post', url, **kwargs)
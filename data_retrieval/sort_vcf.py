@@ -1,19 +1,47 @@
 """
-Use UNIX commands to sort a VCF file.
+Sort a VCF file with an external merge sort.
 
-Uses tempfiles to store intermediate products. Useful if you don't trust the
-file to be sorted. Doesn't check, just sorts.
+Body lines are read in runs that fit in a memory budget; each run is sorted
+in memory and spilled to a tempfile, then the runs are merged into the
+output. Input that is already sorted is detected and passed straight through
+without sorting. Input that fits in one run never touches a run file.
 
 Sorts by chromosome 1st: Chr1, Chr2... Chr9, Chr10... Chr22, ChrX, ChrY, ChrM
-Then numerically by position column.
+Then numerically by position column, then by the whole line.
 Works with these chromosome name variations: "1", "Chr1", and "chr1".
+Lines on other chromosomes are dropped.
+
+Whole-genome files can instead be split into per-chromosome buckets that are
+sorted in a process pool and concatenated (sort_vcf_by_chromosome).
+
+Run files, buckets and the sorted output are temp files in directory, if
+given (a source's scratch directory, so they count towards its usage), or
+the system temp directory.
 """
-import bz2
-import gzip
+import heapq
+import itertools
+import os
+import shutil
 import tempfile
-import subprocess
 import sys
 
+from billiard import Pool, cpu_count
+
+from data_retrieval.decompress import LineReader
+
+# Bytes of body lines held in memory before a sorted run is spilled to disk.
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Files larger than this are sorted per chromosome, in parallel.
+PARTITION_THRESHOLD = 256 * 1024 * 1024
+
+# Processes sorting the buckets of one file. Each of the cpu worker's
+# CPU_CONCURRENCY processes may be sorting at once, so by default they share
+# the CPUs between them.
+SORT_PROCESSES = int(os.getenv('SORT_PROCESSES') or
+                     max(1, cpu_count() //
+                         int(os.getenv('CPU_CONCURRENCY') or 2)))
+
 CHROM_ORDER = {
     'chr1': '1',
     'chr2': '2',
@@ -96,52 +124,234 @@ CHROM_ORDER = {
 }
 
 
-def sort_vcf(input_file):
-    outputfile = tempfile.TemporaryFile()
-    sortingfile = tempfile.TemporaryFile()
-    next_line = input_file.next()
-    while next_line and next_line.startswith('#'):
-        outputfile.write(next_line)
-        try:
-            next_line = input_file.next()
-        except StopIteration:
-            next_line = None
-            break
-    while next_line:
-        for key in CHROM_ORDER:
-            if next_line.startswith(key + '\t'):
-                sortingfile.write(CHROM_ORDER[key] + '\t' + next_line)
-                break
-        try:
-            next_line = input_file.next()
-        except StopIteration:
-            next_line = None
-            break
-    sortingfile.seek(0)
-    sort_proc = subprocess.Popen(['sort', '-k', '1n,1', '-k', '3n,3'],
-                                 stdin=sortingfile,
-                                 stdout=subprocess.PIPE)
-    cut_proc = subprocess.Popen(['cut', '-f', '2-'],
-                                stdin=sort_proc.stdout,
-                                stdout=subprocess.PIPE)
-    for line in cut_proc.stdout:
+CHROM_RANK = {chrom: int(rank) for chrom, rank in CHROM_ORDER.items()}
+
+
+def sort_key(line):
+    """
+    Return the (chromosome rank, position, line) sort key for a body line.
+
+    Returns None if the chromosome isn't one we sort.
+    """
+    fields = line.split('\t', 2)
+
+    try:
+        rank = CHROM_RANK[fields[0]]
+    except KeyError:
+        return None
+
+    try:
+        pos = int(fields[1])
+    except (IndexError, ValueError):
+        pos = 0
+
+    return rank, pos, line
+
+
+def temp_file(directory=None):
+    """
+    Return a temp file, removed when it's closed. It's named, so it's
+    counted by data_retrieval.scratch while it's open.
+    """
+    return tempfile.NamedTemporaryFile(dir=directory)
+
+
+def spill_run(run, directory=None):
+    """
+    Write a sorted run of keyed lines to a tempfile, return the tempfile.
+    """
+    run_file = temp_file(directory)
+
+    run_file.writelines(keyed[2] for keyed in run)
+    run_file.seek(0)
+
+    return run_file
+
+
+def read_run(run_file):
+    for line in run_file:
+        yield sort_key(line)
+
+
+def split_header(input_file, outputfile):
+    """
+    Copy the header lines of input_file to outputfile, return an iterator
+    over the remaining body lines.
+    """
+    lines = iter(input_file)
+
+    for line in lines:
+        if not line.startswith('#'):
+            return itertools.chain([line], lines)
+
         outputfile.write(line)
+
+    return iter([])
+
+
+def sort_body(lines, outputfile, memory_budget=MEMORY_BUDGET,
+              directory=None):
+    """
+    Write VCF body lines to outputfile in sorted order.
+    """
+    run_files = []
+    run = []
+    run_bytes = 0
+    already_sorted = True
+    previous = None
+
+    for line in lines:
+        if not line.endswith('\n'):
+            line += '\n'
+
+        keyed = sort_key(line)
+
+        if not keyed:
+            continue
+
+        if already_sorted and previous and keyed < previous:
+            already_sorted = False
+
+        previous = keyed
+        run.append(keyed)
+        run_bytes += len(line)
+
+        if run_bytes >= memory_budget:
+            if not already_sorted:
+                run.sort()
+
+            run_files.append(spill_run(run, directory))
+            run = []
+            run_bytes = 0
+
+    if already_sorted:
+        # Runs are consecutive, so concatenating them is the sorted output.
+        for run_file in run_files:
+            shutil.copyfileobj(run_file, outputfile)
+            run_file.close()
+
+        outputfile.writelines(keyed[2] for keyed in run)
+    else:
+        run.sort()
+
+        runs = [read_run(run_file) for run_file in run_files] + [run]
+
+        outputfile.writelines(keyed[2] for keyed in heapq.merge(*runs))
+
+        for run_file in run_files:
+            run_file.close()
+
+
+def sort_vcf(input_file, memory_budget=MEMORY_BUDGET, directory=None):
+    """
+    Sort VCF lines from input_file, return a tempfile of the sorted VCF.
+    """
+    outputfile = temp_file(directory)
+
+    sort_body(split_header(input_file, outputfile), outputfile, memory_budget,
+              directory)
+
     outputfile.seek(0)
     return outputfile
 
 
-def sort_vcf_file(input_filepath):
-    error_message = ("Input file is expected to be either '.vcf', '.vcf.gz', "
-                     "'.vcf.bz2'.")
-    if input_filepath.endswith('.vcf.gz'):
-        input_file = gzip.open(input_filepath)
-    elif input_filepath.endswith('.vcf.bz2'):
-        input_file = bz2.BZ2File(input_filepath)
-    elif input_filepath.endswith('.vcf'):
-        input_file = open(input_filepath)
-    else:
-        raise ValueError(error_message)
-    return sort_vcf(input_file)
+def sort_bucket(args):
+    """
+    Sort one chromosome bucket file, return the path of the sorted copy.
+
+    Takes a single (path, memory_budget, directory) tuple so it can be used
+    with Pool.map.
+    """
+    path, memory_budget, directory = args
+    sorted_path = path + '.sorted'
+
+    with open(path) as bucket, open(sorted_path, 'w') as outputfile:
+        sort_body(bucket, outputfile, memory_budget, directory)
+
+    os.remove(path)
+
+    return sorted_path
+
+
+def sort_vcf_by_chromosome(input_file, processes=None,
+                           memory_budget=MEMORY_BUDGET, directory=None):
+    """
+    Sort VCF lines from input_file, return a tempfile of the sorted VCF.
+
+    Body lines are split into one bucket file per chromosome in a single
+    pass, the buckets are sorted in a pool of processes (SORT_PROCESSES by
+    default), and the sorted buckets are concatenated in CHROM_ORDER order.
+    Each process may hold up to memory_budget bytes of lines.
+
+    The pool is billiard's (Celery's fork of multiprocessing), which unlike
+    multiprocessing's can be started from the daemonic processes of a Celery
+    prefork worker.
+    """
+    outputfile = temp_file(directory)
+    bucket_directory = tempfile.mkdtemp(dir=directory)
+    buckets = {}
+
+    try:
+        for line in split_header(input_file, outputfile):
+            keyed = sort_key(line)
+
+            if not keyed:
+                continue
+
+            if keyed[0] not in buckets:
+                buckets[keyed[0]] = open(os.path.join(
+                    bucket_directory, '{}.vcf'.format(keyed[0])), 'w')
+
+            buckets[keyed[0]].write(line if line.endswith('\n')
+                                    else line + '\n')
+
+        for bucket in buckets.values():
+            bucket.close()
+
+        jobs = [(buckets[rank].name, memory_budget, directory)
+                for rank in sorted(buckets)]
+
+        processes = processes or SORT_PROCESSES
+
+        if len(jobs) < 2 or processes == 1:
+            sorted_paths = [sort_bucket(job) for job in jobs]
+        else:
+            pool = Pool(min(processes, len(jobs)))
+
+            try:
+                sorted_paths = pool.map(sort_bucket, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        for sorted_path in sorted_paths:
+            with open(sorted_path) as sorted_bucket:
+                shutil.copyfileobj(sorted_bucket, outputfile)
+    finally:
+        shutil.rmtree(bucket_directory)
+
+    outputfile.seek(0)
+    return outputfile
+
+
+def sort_vcf_file(input_filepath, by_chromosome=None, processes=None,
+                  directory=None):
+    """
+    Sort a VCF file, return a tempfile of the sorted VCF. The file may be
+    compressed in any format data_retrieval.decompress reads.
+
+    By default files larger than PARTITION_THRESHOLD bytes (on disk) are
+    sorted with sort_vcf_by_chromosome; pass by_chromosome to choose.
+    """
+    if by_chromosome is None:
+        by_chromosome = os.path.getsize(input_filepath) > PARTITION_THRESHOLD
+
+    with LineReader(input_filepath) as input_file:
+        if by_chromosome:
+            return sort_vcf_by_chromosome(input_file, processes=processes,
+                                          directory=directory)
+
+        return sort_vcf(input_file, directory=directory)
 
 
 if __name__ == '__main__':
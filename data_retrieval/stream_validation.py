@@ -0,0 +1,238 @@
+"""
+Light validation of files that are streamed rather than stored.
+
+These validators follow the verifier protocol of BaseSource.get_remote_file
+(start() with the filename, feed() with each chunk and finish() at the end,
+any of which may raise ValueError) and only keep a small prefix and suffix
+of the data.
+
+ZipValidator reads a ZIP archive's member names from its central directory,
+which is at the end of the file, by giving zipfile a file object that holds
+only the file's last bytes. The end of central directory record (or the
+ZIP64 one) says where the central directory starts; if that's before the
+bytes kept, finish() raises IncompleteValidation, and the file should be
+downloaded and checked in full with check_file() instead.
+"""
+import struct
+import zipfile
+
+from collections import deque
+
+# Leading bytes of each kind of file, by filename extension.
+MAGIC_BYTES = {
+    '.gz': ['\x1f\x8b'],
+    '.bz2': ['BZh'],
+    '.zip': ['PK\x03\x04', 'PK\x05\x06'],
+}
+
+# Bytes kept from the end of a ZIP archive; archives whose central directory
+# doesn't fit are checked in full instead.
+ZIP_SUFFIX_SIZE = 4 * 1024 * 1024
+
+# The end of central directory record, and the ZIP64 end of central directory
+# locator (just before it) and record.
+EOCD = struct.Struct('<4s4H2LH')
+EOCD_SIGNATURE = 'PK\x05\x06'
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_LOCATOR_SIGNATURE = 'PK\x06\x07'
+ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_EOCD_SIGNATURE = 'PK\x06\x06'
+
+# The most an archive comment, which follows the record, can take.
+MAX_COMMENT_SIZE = 0xffff
+
+
+class IncompleteValidation(ValueError):
+    """
+    Raised by a validator that didn't keep enough of a streamed file to check
+    it; check the whole file with its check_file() method instead.
+    """
+
+
+def extension(filename):
+    for file_extension in MAGIC_BYTES:
+        if filename.endswith(file_extension):
+            return file_extension
+
+    return None
+
+
+def central_directory_offset(suffix, size):
+    """
+    Return where a ZIP archive's central directory starts, read from suffix,
+    the last bytes of an archive of size bytes.
+
+    Raise ValueError if there's no end of central directory record, and
+    IncompleteValidation if it points to a ZIP64 record before suffix.
+    """
+    position = suffix.rfind(EOCD_SIGNATURE,
+                            max(0, len(suffix) - EOCD.size - MAX_COMMENT_SIZE))
+
+    if position < 0 or position + EOCD.size > len(suffix):
+        raise ValueError('No end of central directory record found')
+
+    offset = EOCD.unpack_from(suffix, position)[6]
+
+    if offset != 0xffffffff:
+        return offset
+
+    locator = position - ZIP64_LOCATOR.size
+
+    if (locator < 0 or
+            ZIP64_LOCATOR.unpack_from(suffix, locator)[0] !=
+            ZIP64_LOCATOR_SIGNATURE):
+        raise ValueError('No ZIP64 end of central directory locator found')
+
+    record = (ZIP64_LOCATOR.unpack_from(suffix, locator)[2] -
+              (size - len(suffix)))
+
+    if record < 0:
+        raise IncompleteValidation(
+            'ZIP64 end of central directory record is not in the last {} '
+            'bytes'.format(len(suffix)))
+
+    if (record + ZIP64_EOCD.size > len(suffix) or
+            ZIP64_EOCD.unpack_from(suffix, record)[0] !=
+            ZIP64_EOCD_SIGNATURE):
+        raise ValueError('No ZIP64 end of central directory record found')
+
+    return ZIP64_EOCD.unpack_from(suffix, record)[-1]
+
+
+class PrefixValidator(object):
+    """
+    Checks that a file starts with the magic bytes for its filename
+    extension, if it has one we know.
+    """
+
+    def __init__(self):
+        self.filename = None
+        self.prefix = ''
+
+    def start(self, filename):
+        self.filename = filename
+
+    def feed(self, data):
+        magic = MAGIC_BYTES.get(extension(self.filename))
+
+        if not magic or len(self.prefix) >= max(len(m) for m in magic):
+            return
+
+        self.prefix += data[:max(len(m) for m in magic)]
+
+        if not any(self.prefix.startswith(m[:len(self.prefix)])
+                   for m in magic):
+            raise ValueError('"{}" does not look like a {} file'.format(
+                self.filename, extension(self.filename)))
+
+    def finish(self):
+        self.feed('')
+
+
+class SuffixFile(object):
+    """
+    Read-only file object for a file of which only the last bytes are held.
+    Reading before them raises IOError.
+    """
+
+    def __init__(self, suffix, size):
+        self.suffix = suffix
+        self.size = size
+        self.start = size - len(suffix)
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if self.position < self.start:
+            raise IOError('Data before the end of the file is not available')
+
+        begin = self.position - self.start
+        end = len(self.suffix) if size < 0 else begin + size
+        data = self.suffix[begin:end]
+
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        pass
+
+
+class ZipValidator(PrefixValidator):
+    """
+    Checks that a file is a ZIP archive and passes its member names (except
+    '__MACOSX/' entries) to check_names, which raises ValueError if they're
+    not as expected.
+    """
+
+    def __init__(self, check_names):
+        super(ZipValidator, self).__init__()
+
+        self.check_names = check_names
+        self.size = 0
+
+        self._chunks = deque()
+        self._kept = 0
+
+    def start(self, filename):
+        if not filename.endswith('.zip'):
+            raise ValueError('Input file is expected to be a ZIP archive')
+
+        super(ZipValidator, self).start(filename)
+
+    def feed(self, data):
+        super(ZipValidator, self).feed(data)
+
+        self.size += len(data)
+        self._chunks.append(data)
+        self._kept += len(data)
+
+        while self._kept - len(self._chunks[0]) >= ZIP_SUFFIX_SIZE:
+            self._kept -= len(self._chunks.popleft())
+
+    def finish(self):
+        super(ZipValidator, self).finish()
+
+        suffix = ''.join(self._chunks)
+
+        try:
+            offset = central_directory_offset(suffix, self.size)
+        except IncompleteValidation:
+            raise
+        except ValueError as e:
+            raise ValueError('Unable to read ZIP archive "{}": {}'.format(
+                self.filename, e))
+
+        if offset < self.size - len(suffix):
+            raise IncompleteValidation(
+                'Central directory of "{}" starts {} bytes from its end, '
+                'more than the {} kept'.format(
+                    self.filename, self.size - offset, len(suffix)))
+
+        self.check_zip(SuffixFile(suffix, self.size))
+
+    def check_file(self, path):
+        """
+        Check a ZIP archive that has been downloaded in full.
+        """
+        self.check_zip(path)
+
+    def check_zip(self, zip_file):
+        try:
+            zip_file = zipfile.ZipFile(zip_file)
+        except (IOError, zipfile.BadZipfile) as e:
+            raise ValueError('Unable to read ZIP archive "{}": {}'.format(
+                self.filename, e))
+
+        self.check_names([name for name in zip_file.namelist()
+                          if not name.startswith('__MACOSX/')])
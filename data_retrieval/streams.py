@@ -0,0 +1,17 @@
+"""
+Helpers for processing files as streams of lines.
+"""
+
+
+def write_through(lines, output, key=None):
+    """
+    Write each line to output as it passes through, then yield it.
+
+    Lets one pass over an input generator feed two outputs, e.g. a cleaned
+    copy of a raw file and a conversion of the same lines. If key is given,
+    key(line) is written instead of the line itself.
+    """
+    for line in lines:
+        output.write(key(line) if key else line)
+
+        yield line
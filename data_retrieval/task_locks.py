@@ -0,0 +1,162 @@
+"""
+Coalescing of duplicate source task requests, with locks in Redis.
+
+Each source and member has at most one current task, recorded in the key
+'TaskLock:<source>:<member>' with a fingerprint of the request that started
+it and a token the task carries. A request with the same fingerprint as the
+current task (Open Humans retrying, or a member clicking twice) is
+coalesced into it rather than queued again. A request with different
+inputs replaces the lock, superseding the older task: that task checks its
+lock when it starts, before it uploads files and before it requeues itself,
+and stops once it's no longer current.
+
+Locks expire LOCK_TIMEOUT seconds after they were last claimed or extended,
+so a task lost with its worker only holds up new requests for that long.
+"""
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+from redis import RedisError, StrictRedis
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'TaskLock:{}:{}'
+
+# Seconds a lock lasts without its task extending it; longer than any task
+# should take to run.
+LOCK_TIMEOUT = int(os.getenv('TASK_LOCK_TIMEOUT') or 6 * 60 * 60)
+
+# Request fields that don't change what a task does.
+IGNORED_FIELDS = ['return_status']
+
+# Keep the current lock if it's for the same request, otherwise replace it;
+# return the lock in effect.
+CLAIM_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+
+if current and cjson.decode(current)['fingerprint'] == ARGV[1] then
+    return current
+end
+
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+
+return ARGV[2]
+"""
+
+# Extend the lock if it still has our token; return whether it did.
+EXTEND_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+
+if current and cjson.decode(current)['token'] == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+
+    return 1
+end
+
+return 0
+"""
+
+# Delete the lock if it still has our token.
+RELEASE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+
+if current and cjson.decode(current)['token'] == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+
+return 0
+"""
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+
+    if _redis is None:
+        _redis = StrictRedis.from_url(
+            os.getenv('REDIS_URL', 'redis://localhost:6379'))
+
+    return _redis
+
+
+def input_fingerprint(data):
+    """
+    Return a fingerprint of a source task request's inputs.
+    """
+    inputs = dict((key, value) for key, value in (data or {}).items()
+                  if key not in IGNORED_FIELDS)
+
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+class TaskLock(object):
+    """
+    The lock of a source task for one member. Tasks hold it by its token,
+    which travels with the task when it's requeued.
+    """
+
+    def __init__(self, source, member, token=None, redis=None):
+        self.key = LOCK_KEY.format(source, member)
+        self.token = token
+        self.redis = redis or get_redis()
+
+    def claim(self, fingerprint, timeout=LOCK_TIMEOUT):
+        """
+        Claim the lock for a request, returning True if a task should be
+        queued for it and False if it's a duplicate of the current task.
+
+        If Redis can't be reached every request is queued.
+        """
+        token = uuid.uuid4().hex
+
+        try:
+            current = json.loads(self.redis.eval(
+                CLAIM_SCRIPT, 1, self.key, fingerprint,
+                json.dumps({'fingerprint': fingerprint, 'token': token}),
+                timeout))
+        except RedisError as e:
+            logger.warning('Unable to claim task lock "%s": %s', self.key, e)
+
+            # Queue the task unlocked.
+            self.token = None
+
+            return True
+
+        self.token = current['token']
+
+        return self.token == token
+
+    def extend(self, timeout=LOCK_TIMEOUT):
+        """
+        Extend the lock, returning False if a newer request has superseded
+        its task.
+
+        Tasks run as if they're current if Redis can't be reached.
+        """
+        if not self.token:
+            return True
+
+        try:
+            return bool(self.redis.eval(
+                EXTEND_SCRIPT, 1, self.key, self.token, timeout))
+        except RedisError as e:
+            logger.warning('Unable to extend task lock "%s": %s', self.key, e)
+
+            return True
+
+    def release(self):
+        """
+        Release the lock if its task is still current.
+        """
+        if not self.token:
+            return
+
+        try:
+            self.redis.eval(RELEASE_SCRIPT, 1, self.key, self.token)
+        except RedisError as e:
+            logger.warning('Unable to release task lock "%s": %s', self.key,
+                           e)
@@ -0,0 +1,91 @@
+"""
+Background uploads of finished files.
+
+Sources hand each generated file to their UploadQueue as soon as it's
+complete, and it's uploaded while they carry on generating the next. Uploads
+run in a thread pool shared by every source in the worker process, so at most
+UPLOAD_CONCURRENCY files are uploaded at once however many tasks are running.
+
+wait() blocks until every queued upload is done, and raises UploadError
+listing each file that failed.
+"""
+import os
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+# Files uploaded at once by a worker process.
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', 4))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def upload_pool():
+    """
+    Return the worker's upload thread pool, creating it if needed.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(UPLOAD_CONCURRENCY)
+
+    return _pool
+
+
+class UploadError(Exception):
+    """
+    Raised when one or more queued uploads failed.
+
+    failures is a list of (filename, exception) pairs.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+
+        super(UploadError, self).__init__(
+            'Failed to upload {} file(s): {}'.format(
+                len(failures),
+                '; '.join('"{}": {}'.format(filename, error)
+                          for filename, error in failures)))
+
+
+class UploadQueue(object):
+    """
+    The uploads queued by one source.
+    """
+
+    def __init__(self):
+        self._pending = []
+
+    def __contains__(self, filename):
+        return any(pending == filename for pending, _ in self._pending)
+
+    def put(self, filename, function, *args):
+        """
+        Queue function(*args) to upload filename in the background.
+        """
+        self._pending.append(
+            (filename, upload_pool().apply_async(function, args)))
+
+    def wait(self):
+        """
+        Wait for all queued uploads. Return their results in the order they
+        were queued, or raise UploadError if any failed.
+        """
+        results = []
+        failures = []
+
+        for filename, result in self._pending:
+            try:
+                results.append(result.get())
+            except Exception as e:
+                failures.append((filename, e))
+
+        self._pending = []
+
+        if failures:
+            raise UploadError(failures)
+
+        return results
@@ -0,0 +1,149 @@
+"""
+Verification of VCF files while they download.
+
+VCFStreamVerifier is fed the raw bytes of a .vcf, .vcf.gz or .vcf.bz2 file
+as they arrive. It decompresses only as much as it needs to read the header
+and first record, checks those with PyVCF, and raises InvalidVCFError as soon
+as the data can't be a VCF file, so the download can be aborted early rather
+than finishing before the file is rejected.
+"""
+import bz2
+import zlib
+
+from cStringIO import StringIO
+
+import vcf
+
+# Give up if this much data is decompressed without a complete record.
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+
+
+class InvalidVCFError(ValueError):
+    """
+    Raised when downloaded data is not a VCF file.
+    """
+
+
+class MultiStreamDecompressor(object):
+    """
+    Incremental decompressor for concatenated gzip members or bzip2 streams,
+    such as BGZF files or the output of pbzip2.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.decompressor = factory()
+
+    def decompress(self, data):
+        output = []
+
+        while data:
+            try:
+                output.append(self.decompressor.decompress(data))
+            except EOFError:
+                # bz2 decompressors refuse data after the end of a stream
+                self.decompressor = self.factory()
+
+                continue
+
+            data = self.decompressor.unused_data
+
+            if data:
+                self.decompressor = self.factory()
+
+        return ''.join(output)
+
+
+def decompressor_for(filename):
+    """
+    Return a decompressor for a VCF filename, or None if it's uncompressed.
+    """
+    if filename.endswith('.vcf.gz'):
+        return MultiStreamDecompressor(
+            lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif filename.endswith('.vcf.bz2'):
+        return MultiStreamDecompressor(bz2.BZ2Decompressor)
+    elif filename.endswith('.vcf'):
+        return None
+
+    raise InvalidVCFError("Input filename doesn't match .vcf, .vcf.gz, "
+                          'or .vcf.bz2')
+
+
+class VCFStreamVerifier(object):
+    """
+    Verify that a file is a VCF file as its data arrives.
+
+    Call start() with the filename, then feed() with each chunk of data and
+    finish() at the end of the file. Each raises InvalidVCFError once the data
+    is known not to be a VCF. After verification the PyVCF header metadata is
+    available as the metadata attribute, and further data is ignored.
+    """
+
+    def __init__(self):
+        self.filename = None
+        self.metadata = None
+
+        self._decompressor = None
+        self._text = ''
+        self._scanned = 0
+
+    @property
+    def verified(self):
+        return self.metadata is not None
+
+    def start(self, filename):
+        self.filename = filename
+        self._decompressor = decompressor_for(filename)
+
+    def feed(self, data):
+        if self.verified:
+            return
+
+        if self._decompressor:
+            try:
+                data = self._decompressor.decompress(data)
+            except (IOError, zlib.error) as e:
+                raise InvalidVCFError('Unable to decompress: {}'.format(e))
+
+        self._text += data
+
+        if self._text and not self._text.startswith('#'):
+            raise InvalidVCFError('File does not start with a VCF header')
+
+        # Look for the end of the first record, scanning each line once.
+        while True:
+            line_end = self._text.find('\n', self._scanned)
+
+            if line_end == -1:
+                break
+
+            if not self._text.startswith('#', self._scanned):
+                self._verify(self._text[:line_end + 1])
+
+                return
+
+            self._scanned = line_end + 1
+
+        if len(self._text) > MAX_HEADER_SIZE:
+            raise InvalidVCFError(
+                'No VCF record in the first {} bytes'.format(MAX_HEADER_SIZE))
+
+    def finish(self):
+        if not self.verified:
+            self._verify(self._text)
+
+    def _verify(self, text):
+        """
+        Check that PyVCF can read the header and advance one record.
+        """
+        try:
+            reader = vcf.Reader(fsock=StringIO(text))
+            reader.next()
+        except StopIteration:
+            raise InvalidVCFError('File has no VCF records')
+        except Exception as e:
+            raise InvalidVCFError('Unable to parse VCF: {}'.format(e))
+
+        self.metadata = reader.metadata
+        self._text = ''
@@ -11,13 +11,14 @@ import json
 import logging
 import os
 import re
-import shutil
 
 import arrow
 from bs4 import BeautifulSoup
 import requests
 
 from base_source import BaseSource
+from data_retrieval import sessions
+from data_retrieval.stream_validation import PrefixValidator
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +41,7 @@ def get_ena_url_response(url):
         attempts += 1
 
         try:
-            req = requests.get(url)
+            req = sessions.get(url)
 
             if req.status_code == 200:
                 return req
@@ -170,73 +171,88 @@ class AmericanGutSource(BaseSource):
     """
 
     source = 'american_gut'
+    cost_class = 'download'
 
     def handle_ena_info(self, ena_info, filename_base, source):
         tsv_filename = filename_base + '-ena-info.tsv'
-        tsv_filepath = self.temp_join(tsv_filename)
+        tsv_filepath = self.temp_join(tsv_filename, small=True)
 
         with open(tsv_filepath, 'w') as f:
             for line in dict_list_as_tsv(ena_info):
                 f.write(line)
 
         json_filename = filename_base + '-ena-info.json'
-        json_filepath = self.temp_join(json_filename)
+        json_filepath = self.temp_join(json_filename, small=True)
 
         with open(json_filepath, 'w') as f:
             json.dump(ena_info, f, indent=2, sort_keys=True)
 
-        self.temp_files.append({
-            'temp_filename': tsv_filename,
-            'metadata': {
-                'description': ('American Gut sample accession data from the '
-                                'European Nucleotide Archive, TSV format.'),
-                'tags': ['metadata', 'American Gut', 'tsv'],
-                'sourceURL': source,
-                }
+        self.add_temp_file(tsv_filename, {
+            'description': ('American Gut sample accession data from the '
+                            'European Nucleotide Archive, TSV format.'),
+            'tags': ['metadata', 'American Gut', 'tsv'],
+            'sourceURL': source,
         })
 
-        self.temp_files.append({
-            'temp_filename': json_filename,
-            'metadata': {
-                'description': ('American Gut sample accession data from the '
-                                'European Nucleotide Archive, JSON format.'),
-                'tags': ['metadata', 'American Gut', 'json'],
-                'sourceURL': source,
-            }
+        self.add_temp_file(json_filename, {
+            'description': ('American Gut sample accession data from the '
+                            'European Nucleotide Archive, JSON format.'),
+            'tags': ['metadata', 'American Gut', 'json'],
+            'sourceURL': source,
         })
 
     def handle_ena_metadata(self, ena_metadata, filename_base, source):
         tsv_filename = filename_base + '-metadata.tsv'
 
-        with open(self.temp_join(tsv_filename), 'w') as f:
+        with open(self.temp_join(tsv_filename, small=True), 'w') as f:
             for line in dict_list_as_tsv([ena_metadata]):
                 f.write(line)
 
         json_filename = filename_base + '-metadata.json'
 
-        with open(self.temp_join(json_filename), 'w') as f:
+        with open(self.temp_join(json_filename, small=True), 'w') as f:
             json.dump(ena_metadata, f, indent=2, sort_keys=True)
 
-        self.temp_files.append({
-            'temp_filename': tsv_filename,
-            'metadata': {
-                'description': ('American Gut sample survey data and '
-                                'metadata, TSV format.'),
-                'tags': ['metadata', 'survey', 'American Gut', 'tsv'],
-                'sourceURL': source,
-            }
+        self.add_temp_file(tsv_filename, {
+            'description': ('American Gut sample survey data and '
+                            'metadata, TSV format.'),
+            'tags': ['metadata', 'survey', 'American Gut', 'tsv'],
+            'sourceURL': source,
         })
 
-        self.temp_files.append({
-            'temp_filename': json_filename,
-            'metadata': {
-                'description': ('American Gut sample survey data and '
-                                'metadata, JSON format.'),
-                'tags': ['metadata', 'survey', 'American Gut', 'json'],
-                'sourceURL': source,
-            }
+        self.add_temp_file(json_filename, {
+            'description': ('American Gut sample survey data and '
+                            'metadata, JSON format.'),
+            'tags': ['metadata', 'survey', 'American Gut', 'json'],
+            'sourceURL': source,
         })
 
+    @staticmethod
+    def fastq_destination(fastq_filename, fastq_url):
+        """
+        Return a passthrough_remote_file destination for a FASTQ file, which
+        is renamed to fastq_filename plus its compression extension.
+        """
+        def destination(original_filename):
+            if original_filename.endswith('.gz'):
+                new_filename = fastq_filename + '.gz'
+            elif original_filename.endswith('.bz2'):
+                new_filename = fastq_filename + '.bz2'
+            elif original_filename.endswith('.zip'):
+                new_filename = fastq_filename + '.zip'
+            else:
+                raise ValueError('Unexpected FASTQ filename: "{}"'.format(
+                    original_filename))
+
+            return new_filename, {
+                'description': 'American Gut 16S FASTQ raw sequencing data.',
+                'tags': ['fastq', 'American Gut', '16S'],
+                'sourceURL': fastq_url,
+                'originalFilename': original_filename,
+            }
+
+        return destination
+
     def archive_files(self):
         current_files = self.get_current_files()
 
@@ -254,6 +270,7 @@ class AmericanGutSource(BaseSource):
             else:
                 files_to_keep[fileinfo['basename']] = fileinfo
         ids_to_keep = [files_to_keep[bn]['id'] for bn in files_to_keep.keys()]
+        ids_to_keep += self.unchanged_file_ids
         ids_to_remove = [fi['id'] for fi in current_files if
                          fi['id'] not in ids_to_keep]
 
@@ -325,25 +342,7 @@ class AmericanGutSource(BaseSource):
                         filename_base,
                         ena_info_item['run_accession'])
 
-                    original_filename = self.get_remote_file(fastq_url)
-
-                    if original_filename.endswith('.gz'):
-                        new_filename = fastq_filename + '.gz'
-                    elif original_filename.endswith('.bz2'):
-                        new_filename = fastq_filename + '.bz2'
-                    elif original_filename.endswith('.zip'):
-                        new_filename = fastq_filename + '.zip'
-
-                    shutil.move(self.temp_join(original_filename),
-                                self.temp_join(new_filename))
-
-                    self.temp_files.append({
-                        'temp_filename': new_filename,
-                        'metadata': {
-                            'description': ('American Gut 16S FASTQ raw '
-                                            'sequencing data.'),
-                            'tags': ['fastq', 'American Gut', '16S'],
-                            'sourceURL': fastq_url,
-                            'originalFilename': original_filename,
-                        }
-                    })
+                    self.passthrough_remote_file(
+                        fastq_url,
+                        self.fastq_destination(fastq_filename, fastq_url),
+                        validator=PrefixValidator())
@@ -7,20 +7,25 @@ This software is shared under the "MIT License" license (aka "Expat License"),
 see LICENSE.TXT for full license text.
 """
 
-import bz2
-from cStringIO import StringIO
 from datetime import date, datetime
 import logging
+from operator import attrgetter
 import os
 import re
 import shutil
 import urlparse
 
 import arrow
-import bcrypt
 
 from base_source import BaseSource
-from data_retrieval.sort_vcf import sort_vcf
+from data_retrieval.genotype_records import (header_record,
+                                             parse_ancestrydna_line)
+from data_retrieval.genotype_vcf import vcf_lines_from_calls
+from data_retrieval.orig_file_hash import (check_orig_file_hash,
+                                           make_orig_file_hash)
+from data_retrieval.reference_index import open_reference_index
+from data_retrieval.sort_vcf import sort_vcf_file
+from data_retrieval.streams import write_through
 
 logger = logging.getLogger(__name__)
 
@@ -131,77 +136,61 @@ def vcf_header(source=None, reference=None, format_info=None):
     return header
 
 
-def vcf_from_raw_ancestrydna(raw_ancestrydna, genome_sex):
-    output = StringIO()
-    reference = dict()
-    with open(REF_ANCESTRYDNA_FILE) as f:
-        for line in f:
-            data = line.rstrip().split('\t')
-            if data[0] not in reference:
-                reference[data[0]] = dict()
-            reference[data[0]][data[1]] = data[2]
-    header = vcf_header(
-        source='open_humans_data_processing.ancestry_dna',
-        reference=REFERENCE_GENOME_URL,
-        format_info=['<ID=GT,Number=1,Type=String,Description="Genotype">']
-    )
-    for line in header:
-        output.write(line + '\n')
-    for line in raw_ancestrydna:
-        # Skip header
-        if line.startswith('#'):
-            continue
-        if line == EXPECTED_COLUMNS_HEADER:
-            continue
-
-        data = line.rstrip().split('\t')
-
-        # Skip uncalled and genotyping without explicit base calls
-        if not re.match(r'^[ACGT]$', data[3]):
-            continue
-        if not re.match(r'^[ACGT]$', data[4]):
+def calls_from_raw_ancestrydna(raw_ancestrydna, genome_sex):
+    """
+    Generate genotype calls with explicit base calls from AncestryDNA
+    records, reporting X and Y positions according to genome_sex.
+    """
+    for record in raw_ancestrydna:
+        # Skip header, uncalled and genotyping without explicit base calls
+        if not record.called:
             continue
-        vcf_data = {x: '.' for x in VCF_FIELDS}
 
         # Chromosome. Determine correct reporting according to genome_sex.
-        try:
-            vcf_data['REF'] = reference[data[1]][data[2]]
-        except KeyError:
+        if record.chrom == '24' and genome_sex == 'Female':
             continue
-        vcf_data['CHROM'] = CHROM_MAP[data[1]]
-        if data[1] == '24' and genome_sex == 'Female':
-            continue
-        if data[1] in ['23', '24'] and genome_sex == 'Male':
-            alleles = data[3]
-        else:
-            alleles = data[3] + data[4]
-
-        # Position, dbSNP ID, reference. Skip if we don't have ref.
-        vcf_data['POS'] = data[2]
-        if data[0].startswith('rs'):
-            vcf_data['ID'] = data[0]
-
-        # Figure out the alternate alleles.
-        alt_alleles = []
-        for alle in alleles:
-            if alle != vcf_data['REF'] and alle not in alt_alleles:
-                alt_alleles.append(alle)
-        if alt_alleles:
-            vcf_data['ALT'] = ','.join(alt_alleles)
+        if record.chrom in ['23', '24'] and genome_sex == 'Male':
+            alleles = record.alleles[0]
         else:
-            vcf_data['ALT'] = '.'
-            vcf_data['INFO'] = 'END=' + vcf_data['POS']
+            alleles = record.alleles
+
+        yield (record.rsid, record.chrom, CHROM_MAP[record.chrom], record.pos,
+               alleles)
 
-        # Get allele-indexed genotype.
-        vcf_data['FORMAT'] = 'GT'
-        all_alleles = [vcf_data['REF']] + alt_alleles
-        genotype_indexed = '/'.join([str(all_alleles.index(x))
-                                     for x in alleles])
-        vcf_data['ANCESTRYDNA_DATA'] = genotype_indexed
-        output_line = '\t'.join([vcf_data[x] for x in VCF_FIELDS])
-        output.write(output_line + '\n')
 
-    return output
+def vcf_from_raw_ancestrydna(raw_ancestrydna, genome_sex, header=True):
+    """
+    Generate VCF lines from an iterable of AncestryDNA GenotypeRecords.
+
+    The VCF header comes first, unless header is False.
+    """
+    reference = open_reference_index(REF_ANCESTRYDNA_FILE)
+    if header:
+        for line in vcf_header(
+                source='open_humans_data_processing.ancestry_dna',
+                reference=REFERENCE_GENOME_URL,
+                format_info=[
+                    '<ID=GT,Number=1,Type=String,Description="Genotype">']):
+            yield line + '\n'
+    for lines in vcf_lines_from_calls(
+            calls_from_raw_ancestrydna(raw_ancestrydna, genome_sex),
+            reference):
+        yield lines
+
+
+def defer_sex_chromosomes(raw_ancestrydna, deferred):
+    """
+    Pass through AncestryDNA records, writing the lines of X and Y records
+    to deferred instead.
+
+    How X and Y positions are reported depends on genome sex, which is only
+    known once the whole file has been read.
+    """
+    for record in raw_ancestrydna:
+        if record.chrom in ('23', '24'):
+            deferred.write(record.line)
+        else:
+            yield record
 
 
 class AncestryDNASource(BaseSource):
@@ -212,6 +201,7 @@ class AncestryDNASource(BaseSource):
     format changes inadvertantly result in unexpected leaks, e.g. names.
     """
     source = 'ancestry_dna'
+    cost_class = 'cpu'
 
     def check_header_lines(self, input_lines, header_lines, header_name):
         if not len(input_lines) == len(header_lines):
@@ -231,16 +221,18 @@ class AncestryDNASource(BaseSource):
 
         Obsessively careful processing that ensures AncestryDNA file format changes
         won't inadvertantly result in unexpected information, e.g. names.
+
+        Generates GenotypeRecords for the cleaned lines, reading the input
+        file only once. The inferred genome sex is stored as self.genome_sex
+        once all records have been generated.
         """
         inputfile = self.open_archive()
 
-        output = StringIO()
-
-        header_l1 = inputfile.next()
+        header_l1 = self.read_header_line(inputfile)
         expected_header_l1 = '#AncestryDNA raw data download\r\n'
         if header_l1 == expected_header_l1:
-            output.write(header_l1)
-        dateline = inputfile.next()
+            yield header_record(header_l1)
+        dateline = self.read_header_line(inputfile)
         re_datetime_string = (r'([0-1][0-9]/[0-3][0-9]/20[1-9][0-9] ' +
                               r'[0-9][0-9]:[0-9][0-9]:[0-9][0-9]) MDT')
         if re.search(re_datetime_string, dateline):
@@ -249,50 +241,50 @@ class AncestryDNASource(BaseSource):
             datetime_ancestrydna = datetime.strptime(datetime_string,
                                                      '%m/%d/%Y %H:%M:%S')
 
-            output.write(
+            yield header_record(
                 '#This file was generated by AncestryDNA at: {}\r\n'.format(
                     datetime_ancestrydna.strftime('%a %b %d %H:%M:%S %Y MDT')))
 
         re_array_version = (
             r'#Data was collected using AncestryDNA array version: V\d\.\d\r\n')
 
-        header_array_version = inputfile.next()
+        header_array_version = self.read_header_line(inputfile)
 
         if re.match(re_array_version, header_array_version):
-            output.write(header_array_version)
+            yield header_record(header_array_version)
 
         re_converter_version = (
             r'#Data is formatted using AncestryDNA converter version: V\d\.\d\r\n')
 
-        header_converter_version = inputfile.next()
+        header_converter_version = self.read_header_line(inputfile)
 
         if re.match(re_converter_version, header_converter_version):
-            output.write(header_converter_version)
+            yield header_record(header_converter_version)
 
-        next_line = inputfile.next()
+        next_line = self.read_header_line(inputfile)
         header_p_lines = []
 
         while next_line.startswith('#'):
             header_p_lines.append(next_line)
-            next_line = inputfile.next()
+            next_line = self.read_header_line(inputfile)
 
         if self.check_header_lines(header_p_lines, HEADER_V1, 'HEADER_V1'):
             for line in HEADER_V1:
-                output.write(line)
+                yield header_record(line)
         elif self.check_header_lines(header_p_lines, HEADER_V2, 'HEADER_V2'):
             for line in HEADER_V2:
-                output.write(line)
+                yield header_record(line)
         elif self.check_header_lines(header_p_lines, HEADER_V3, 'HEADER_V3'):
             for line in HEADER_V3:
-                output.write(line)
+                yield header_record(line)
         else:
             self.sentry_log("AncestryDNA header didn't match expected formats")
 
         data_header = next_line
         if data_header == EXPECTED_COLUMNS_HEADER:
-            output.write(EXPECTED_COLUMNS_HEADER)
+            yield header_record(EXPECTED_COLUMNS_HEADER)
 
-        next_line = inputfile.next()
+        next_line = self.read_header_line(inputfile)
         bad_format = False
         # AncestryDNA always reports two alleles for all X and Y positions.
         # For XY individuals, haplozygous positions are redundantly reported.
@@ -304,20 +296,17 @@ class AncestryDNASource(BaseSource):
         called_Y = 0
         reported_Y = 0
 
-        LINE_RE = re.compile(
-            r'(rs|VGXS)[0-9]+\t[1-9][0-9]?\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
-        REPORTED_Y = re.compile(r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
-        CALLED_Y = re.compile(r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI]\t[ACGTDI]')
-
         while next_line:
-            if LINE_RE.match(next_line):
-                if REPORTED_Y.match(next_line):
+            record = parse_ancestrydna_line(next_line)
+
+            if record:
+                if record.chrom == '24':
                     reported_Y += 1
 
-                    if CALLED_Y.match(next_line):
+                    if record.y_called:
                         called_Y += 1
 
-                output.write(next_line)
+                yield record
             else:
                 # Only report this type of format issue once.
                 if not bad_format:
@@ -333,7 +322,7 @@ class AncestryDNASource(BaseSource):
         if called_Y * 1.0 / reported_Y > 0.5:
             genome_sex = 'Male'
 
-        return output, genome_sex
+        self.genome_sex = genome_sex
 
     def should_update(self, files):
         """
@@ -375,9 +364,9 @@ class AncestryDNASource(BaseSource):
         """
         if not self.file_url:
             return False
-        url_path = str(urlparse.urlparse(self.file_url).path)
-        new_hash = bcrypt.hashpw(url_path, str(orig_file_hash))
-        return orig_file_hash == new_hash
+        url_path = urlparse.urlparse(self.file_url).path
+        return check_orig_file_hash(orig_file_hash, url_path,
+                                    persist=not self.local)
 
     def create_files(self, input_file=None, file_url=None):
         """
@@ -393,50 +382,59 @@ class AncestryDNASource(BaseSource):
         new_hash = ''
         if self.file_url:
             orig_path = urlparse.urlparse(self.file_url).path
-            new_hash = bcrypt.hashpw(str(orig_path), bcrypt.gensalt())
+            new_hash = make_orig_file_hash(orig_path)
 
         filename_base = 'AncestryDNA-genotyping'
 
-        raw_ancestrydna, genome_sex = self.clean_raw_ancestrydna()
-        raw_ancestrydna.seek(0)
-        vcf_ancestrydna_unsorted = vcf_from_raw_ancestrydna(
-            raw_ancestrydna, genome_sex)
-
-        # Save raw AncestryDNA genotyping to temp file.
         raw_filename = filename_base + '.txt'
 
-        with open(self.temp_join(raw_filename), 'w') as raw_file:
-            raw_ancestrydna.seek(0)
-
-            shutil.copyfileobj(raw_ancestrydna, raw_file)
-
-            self.temp_files.append({
-                'temp_filename': raw_filename,
-                'metadata': {
-                    'description':
-                        'AncestryDNA full genotyping data, original format',
-                    'tags': ['AncestryDNA', 'genotyping'],
-                    'orig_file_hash': new_hash,
-                    'creation_date': arrow.get().format(),
-                },
-            })
+        unsorted_path = self.temp_join(filename_base + '.unsorted.vcf')
+        sex_chromosome_path = self.temp_join(filename_base + '.sex.txt')
+
+        with open(unsorted_path, 'w') as vcf_ancestrydna_unsorted, \
+                open(sex_chromosome_path, 'w+') as sex_chromosome_lines:
+            # Save raw AncestryDNA genotyping to temp file, converting all but
+            # the X and Y positions to VCF in the same pass.
+            with open(self.temp_join(raw_filename), 'w') as raw_file:
+                raw_ancestrydna = write_through(self.clean_raw_ancestrydna(),
+                                                raw_file,
+                                                key=attrgetter('line'))
+
+                vcf_ancestrydna_unsorted.writelines(vcf_from_raw_ancestrydna(
+                    defer_sex_chromosomes(raw_ancestrydna,
+                                          sex_chromosome_lines),
+                    genome_sex=None))
+
+            sex_chromosome_lines.seek(0)
+            vcf_ancestrydna_unsorted.writelines(vcf_from_raw_ancestrydna(
+                (parse_ancestrydna_line(line)
+                 for line in sex_chromosome_lines),
+                self.genome_sex, header=False))
+
+        os.remove(sex_chromosome_path)
+
+        self.add_temp_file(raw_filename, {
+            'description': 'AncestryDNA full genotyping data, original format',
+            'tags': ['AncestryDNA', 'genotyping'],
+            'orig_file_hash': new_hash,
+            'creation_date': arrow.get().format(),
+        })
 
         # Save VCF AncestryDNA genotyping to temp file.
-        vcf_ancestrydna_unsorted.seek(0)
-        vcf_ancestrydna_sorted = sort_vcf(vcf_ancestrydna_unsorted)
-        vcf_filename = filename_base + '.vcf.bz2'
+        vcf_ancestrydna_sorted = sort_vcf_file(unsorted_path,
+                                               directory=self.temp_directory)
+        os.remove(unsorted_path)
+
+        vcf_filename, vcf_file = self.open_vcf(filename_base)
 
-        with bz2.BZ2File(self.temp_join(vcf_filename), 'w') as vcf_file:
+        with vcf_file:
             vcf_ancestrydna_sorted.seek(0)
 
             shutil.copyfileobj(vcf_ancestrydna_sorted, vcf_file)
 
-            self.temp_files.append({
-                'temp_filename': vcf_filename,
-                'metadata': {
-                    'description': 'AncestryDNA full genotyping data, VCF format',
-                    'tags': ['AncestryDNA', 'genotyping', 'vcf'],
-                    'orig_file_hash': new_hash,
-                    'creation_date': arrow.get().format(),
-                },
-            })
+        self.add_vcf_temp_files(vcf_filename, vcf_file, {
+            'description': 'AncestryDNA full genotyping data, VCF format',
+            'tags': ['AncestryDNA', 'genotyping', 'vcf'],
+            'orig_file_hash': new_hash,
+            'creation_date': arrow.get().format(),
+        })
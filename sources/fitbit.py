@@ -24,6 +24,8 @@ from requests_respectful import (RespectfulRequester,
                                  RequestsRespectfulRateLimitedError)
 
 from base_source import BaseSource
+from data_retrieval.fair_share import FairShareAllocator
+from data_retrieval.rate_limits import requeue_countdown
 from models import CacheItem
 
 logger = logging.getLogger(__name__)
@@ -42,6 +44,9 @@ logger.info('Connecting to redis at %s:%s',
             url_object.hostname,
             url_object.port)
 
+# Requests kept in reserve in each realm.
+SAFETY_THRESHOLD = 5
+
 RespectfulRequester.configure(
     redis={
         'host': url_object.hostname,
@@ -49,12 +54,20 @@ RespectfulRequester.configure(
         'password': url_object.password,
         'database': 0,
     },
-    safety_threshold=5)
+    safety_threshold=SAFETY_THRESHOLD)
+
+# The Fitbit API; may be overridden to use a stand-in, such as the one in
+# benchmarks.fake_api.
+FITBIT_API_URL = os.getenv('FITBIT_API_URL') or 'https://api.fitbit.com'
 
 requests = RespectfulRequester()
 requests.register_realm('fitbit', max_requests=3600, timespan=3600)
 requests.update_realm('fitbit', max_requests=3600, timespan=3600)
 
+# Divides the global realm's budget between the members being retrieved.
+allocator = FairShareAllocator(requests.redis, 'fitbit', 'fitbit-{}',
+                               safety_threshold=SAFETY_THRESHOLD)
+
 # Only use cached data if cached less than CACHE_MAX before now.
 # Cache target dates older than CACHE_MIN before now.
 # Based on these settings 23 URLs won't be cached, and full data retrieval
@@ -67,6 +80,9 @@ CACHE_MIN = timedelta(days=1)
 # to be hit unless more than a couple weeks have passed since previous storage.
 STORAGE_MIN = timedelta(weeks=4)
 
+# Seconds to wait before retrying after Fitbit times out.
+TIMEOUT_COUNTDOWN = 900
+
 fitbit_urls = [
     # Requires the 'settings' scope, which we haven't asked for
     # {'name': 'devices', 'url': '/-/devices.json', 'period': None},
@@ -155,38 +171,33 @@ fitbit_urls = [
 class RateLimitException(Exception):
     """
     An exception that is raised if we reach a request rate cap.
+
+    retry_after is the delay in seconds Fitbit asked for, if it did, and
+    remaining the number of requests the retrieval still needed, if known.
     """
 
-    # TODO: add the source of the rate limit we hit for logging (fitit,
-    # internal global fitbit, internal user-specific fitbit)
+    def __init__(self, retry_after=None):
+        super(RateLimitException, self).__init__()
 
-    pass
+        self.retry_after = retry_after
+        self.remaining = None
 
 
-def fitbit_query(access_token, path, open_humans_id, parameters=None,
-                 target_date=None):
+def fitbit_data_key(path, open_humans_id, parameters=None):
     """
-    Query Fitbit API and return result.
-
-    Cache queries if the date for target data is greater than CACHE_MIN
-    before now. Use cached queries if the cache time was less than CACHE_MAX
-    before now.
-
-    If no date is associated with target data, don't use query caching.
+    Return the URL of a query and the key its response is cached under.
     """
-    if not parameters:
-        parameters = {}
+    data_url = '{}/1/user{}'.format(FITBIT_API_URL,
+                                    path.format(**(parameters or {})))
 
-    headers = {
-        'Authorization': 'Bearer %s' % access_token,
-        # Required for American units (miles, pounds)
-        'Accept-Language': 'en_US',
-    }
+    return data_url, '{}-{}'.format(data_url, open_humans_id)
 
-    path = path.format(**parameters)
-    data_url = 'https://api.fitbit.com/1/user{}'.format(path)
-    data_key = '{}-{}'.format(data_url, open_humans_id)
 
+def cached_query(data_key, target_date=None):
+    """
+    Return the cached response of a query, or None if there's no usable
+    cached response.
+    """
     cached_response = (CacheItem.query
                        .filter_by(key=data_key)
                        .order_by(CacheItem.request_time.desc())
@@ -207,6 +218,40 @@ def fitbit_query(access_token, path, open_humans_id, parameters=None,
             logging.debug('Rejecting cache for {}, cache date more than '
                           'CACHE_MAX'.format(data_key))
 
+    return None
+
+
+def fitbit_query(access_token, path, open_humans_id, parameters=None,
+                 target_date=None, grant=None):
+    """
+    Query Fitbit API and return result.
+
+    Cache queries if the date for target data is greater than CACHE_MIN
+    before now. Use cached queries if the cache time was less than CACHE_MAX
+    before now.
+
+    If no date is associated with target data, don't use query caching.
+
+    Requests made (rather than loaded from the cache) are taken from grant,
+    if given, and raise RateLimitException once it's used up.
+    """
+    headers = {
+        'Authorization': 'Bearer %s' % access_token,
+        # Required for American units (miles, pounds)
+        'Accept-Language': 'en_US',
+    }
+
+    data_url, data_key = fitbit_data_key(path, open_humans_id, parameters)
+
+    cached_response = cached_query(data_key, target_date)
+
+    if cached_response is not None:
+        return cached_response
+
+    if grant and not grant.take():
+        logging.info('Fair share of the Fitbit budget used.')
+        raise RateLimitException(retry_after=grant.wait)
+
     try:
         data_response = requests.get(
             data_url,
@@ -219,10 +264,13 @@ def fitbit_query(access_token, path, open_humans_id, parameters=None,
     # If a rate cap is encountered, return a result reporting this.
     if data_response.status_code == 429:
         logging.info('Fitbit reports rate limit hit!')
-        raise RateLimitException()
+        # Fitbit's own limit, reset at the top of the hour.
+        raise RateLimitException(retry_after=int(
+            data_response.headers.get('Fitbit-Rate-Limit-Reset',
+                                      TIMEOUT_COUNTDOWN)))
     if data_response.status_code == 504:
         logging.info('Fitbit server reports 504 response timeout!')
-        raise RateLimitException()
+        raise RateLimitException(retry_after=TIMEOUT_COUNTDOWN)
     logging.debug('Fitbit returns status code: {}'.format(
         data_response.status_code))
 
@@ -282,17 +330,13 @@ def get_fitbit_data(access_token, open_humans_id, fitbit_data):
         'weight': query_result['user']['weight'],
         }
 
-    for url in [u for u in fitbit_urls if u['period'] is None]:
-        if not user_id and 'profile' in fitbit_data:
-            user_id = fitbit_data['profile']['user']['encodedId']
+    # Work out every query first, so we know how many remain if we hit a
+    # rate limit part way through.
+    queries = []
+    skipped = 0
 
-        query_result = fitbit_query(access_token=access_token,
-                                    path=url['url'],
-                                    parameters={'user_id': user_id},
-                                    open_humans_id=open_humans_id,
-                                    target_date=arrow.get())
-
-        fitbit_data[url['name']] = query_result
+    for url in [u for u in fitbit_urls if u['period'] is None]:
+        queries.append((url, None, {'user_id': user_id}, arrow.get()))
 
     for url in [u for u in fitbit_urls if u['period'] == 'year']:
         years = arrow.Arrow.range('year', start_date.floor('year'),
@@ -302,21 +346,14 @@ def get_fitbit_data(access_token, open_humans_id, fitbit_data):
 
             if year in fitbit_data[url['name']]:
                 logger.info('Skip retrieval {}: {}'.format(url['name'], year))
+                skipped += 1
                 continue
 
-            logger.info('Retrieving %s: %s', url['name'], year)
-            query_result = fitbit_query(
-                access_token=access_token,
-                path=url['url'],
-                parameters={
-                    'user_id': user_id,
-                    'start_date': year_date.floor('year').format('YYYY-MM-DD'),
-                    'end_date': year_date.ceil('year').format('YYYY-MM-DD'),
-                },
-                open_humans_id=open_humans_id,
-                target_date=year_date.ceil('year'))
-
-            fitbit_data[url['name']][str(year)] = query_result
+            queries.append((url, str(year), {
+                'user_id': user_id,
+                'start_date': year_date.floor('year').format('YYYY-MM-DD'),
+                'end_date': year_date.ceil('year').format('YYYY-MM-DD'),
+            }, year_date.ceil('year')))
 
     for url in [u for u in fitbit_urls if u['period'] == 'month']:
         months = arrow.Arrow.range('month', start_date.floor('month'),
@@ -326,21 +363,60 @@ def get_fitbit_data(access_token, open_humans_id, fitbit_data):
 
             if month in fitbit_data[url['name']]:
                 logger.info('Skip retrieval {}: {}'.format(url['name'], month))
+                skipped += 1
                 continue
 
-            logger.info('Retrieving %s: %s', url['name'], month)
-            query_result = fitbit_query(
-                access_token=access_token,
-                path=url['url'],
-                parameters={
-                    'user_id': user_id,
-                    'start_date': month_date.floor('month').format('YYYY-MM-DD'),
-                    'end_date': month_date.ceil('month').format('YYYY-MM-DD'),
-                },
-                open_humans_id=open_humans_id,
-                target_date=month_date.ceil('month'))
+            queries.append((url, month, {
+                'user_id': user_id,
+                'start_date': month_date.floor('month').format('YYYY-MM-DD'),
+                'end_date': month_date.ceil('month').format('YYYY-MM-DD'),
+            }, month_date.ceil('month')))
+
+    def store(url, period, query_result):
+        if period:
+            fitbit_data[url['name']][period] = query_result
+        else:
+            fitbit_data[url['name']] = query_result
+
+    # Load what's cached now, so that only the queries that need a request
+    # count towards what the retrieval still needs.
+    uncached = []
+
+    for query in queries:
+        url, period, parameters, target_date = query
+        _, data_key = fitbit_data_key(url['url'], open_humans_id, parameters)
+
+        query_result = cached_query(data_key, target_date)
+
+        if query_result is None:
+            uncached.append(query)
+        else:
+            store(url, period, query_result)
+
+    # Only make as many requests as this member's fair share of the global
+    # budget allows; retrievals that are nearly complete get more.
+    grant = allocator.grant(open_humans_id, remaining=len(uncached),
+                            done=skipped + len(queries) - len(uncached))
+
+    for i, (url, period, parameters, target_date) in enumerate(uncached):
+        if period:
+            logger.info('Retrieving %s: %s', url['name'], period)
+
+        try:
+            query_result = fitbit_query(access_token=access_token,
+                                        path=url['url'],
+                                        parameters=parameters,
+                                        open_humans_id=open_humans_id,
+                                        target_date=target_date,
+                                        grant=grant)
+        except RateLimitException as e:
+            e.remaining = len(uncached) - i
+
+            raise
+
+        store(url, period, query_result)
 
-            fitbit_data[url['name']][month] = query_result
+    allocator.release(open_humans_id)
 
     # Intraday retrieval -- not currently authorized.
     """
@@ -381,6 +457,7 @@ class FitbitSource(BaseSource):
     """
 
     source = 'fitbit'
+    cost_class = 'api'
 
     @staticmethod
     def _guess_storage_date(stored_data):
@@ -477,9 +554,10 @@ class FitbitSource(BaseSource):
         Retrieve data and create fitbit data files.
 
         If an API cap is encountered, skip file creation and instead return
-        a countdown. Data retrieval will be resubmitted, and when it runs again
-        it will use previously cached queries. (This iterates until all
-        queries can be completed.)
+        a countdown until the rate limits allow the remaining queries. Data
+        retrieval will be resubmitted, and when it runs again it will use
+        previously cached queries. (This iterates until all queries can be
+        completed.)
         """
         filename = 'fitbit-data.json'
         filepath = os.path.join(self.temp_directory, filename)
@@ -500,8 +578,16 @@ class FitbitSource(BaseSource):
         try:
             fitbit_data = get_fitbit_data(self.access_token, self.oh_user_id,
                                           fitbit_data=stored_data)
-        except RateLimitException:
-            return {'countdown': 900}
+        except RateLimitException as e:
+            # Requeue for when the global and member realms both have room
+            # for the rest of the retrieval, or for when Fitbit said to.
+            countdown = requeue_countdown(
+                requests.redis,
+                ['fitbit', 'fitbit-{}'.format(self.oh_user_id)],
+                requests_needed=e.remaining,
+                safety_threshold=SAFETY_THRESHOLD)
+
+            return {'countdown': max(countdown, e.retry_after or 0)}
 
         with open(filepath, 'w') as f:
             json.dump(fitbit_data, f)
@@ -8,11 +8,9 @@ see LICENSE.TXT for full license text.
 """
 
 import json
-import os
-
-import requests
 
 from base_source import BaseSource
+from data_retrieval import sessions
 
 GO_VIRAL_DATA_URL = 'https://www.goviralstudy.com/participants/{}/data'
 
@@ -27,12 +25,13 @@ class GoViralSource(BaseSource):
     """
 
     source = 'go_viral'
+    cost_class = 'api'
 
     def get_go_viral_data(self):
         """
         Retrieve GoViral data from the API for a given user.
         """
-        request = requests.get(GO_VIRAL_DATA_URL.format(self.go_viral_id),
+        request = sessions.get(GO_VIRAL_DATA_URL.format(self.go_viral_id),
                                params={'access_token': self.access_token})
 
         if request.status_code != 200:
@@ -63,14 +62,13 @@ class GoViralSource(BaseSource):
 
     def handle_go_viral_data(self, data):
         json_filename = 'GoViral-sickness-data.json'
-        json_filepath = os.path.join(self.temp_directory, json_filename)
+        json_filepath = self.temp_join(json_filename, small=True)
 
         with open(json_filepath, 'w') as f:
             json.dump(data, f, indent=2, sort_keys=True)
 
         return {
             'temp_filename': json_filename,
-            'tempdir': self.temp_directory,
             'metadata': {
                 'description': ('GoViral annual surveys, and sickness reports '
                                 'with viral lab test results (if available)'),
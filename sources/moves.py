@@ -25,9 +25,8 @@ import json
 import os
 import time
 
-import requests
-
 from base_source import BaseSource
+from data_retrieval import sessions
 from models import CacheItem
 
 if __name__ == '__main__':
@@ -37,6 +36,10 @@ if __name__ == '__main__':
 else:
     from models import db
 
+# The Moves API; may be overridden to use a stand-in, such as the one in
+# benchmarks.fake_api.
+MOVES_API_URL = os.getenv('MOVES_API_URL') or 'https://api.moves-app.com'
+
 
 class MovesSource(BaseSource):
     """
@@ -47,6 +50,7 @@ class MovesSource(BaseSource):
     """
 
     source = 'moves'
+    cost_class = 'api'
 
     def moves_query(self, path):
         """
@@ -55,15 +59,17 @@ class MovesSource(BaseSource):
         Result is a dict with the following keys:
             'response_json': data from the query JSON, or None if rate cap hit.
             'rate_cap_encountered': None, or True if rate cap hit.
+            'retry_after': seconds Moves asked us to wait, if it did.
         """
         headers = {'Authorization': 'Bearer %s' % self.access_token}
-        data_url = 'https://api.moves-app.com/api/1.1{}'.format(path)
+        data_url = '{}/api/1.1{}'.format(MOVES_API_URL, path)
         data_key = '{}{}'.format(data_url, self.access_token)
 
         # Return dict. Either contains data, or indicates rate cap encountered.
         query_result = {
             'response_json': None,
             'rate_cap_encountered': None,
+            'retry_after': None,
         }
 
         cached_response = (CacheItem.query
@@ -75,12 +81,17 @@ class MovesSource(BaseSource):
             query_result['response_json'] = cached_response.response
             return query_result
 
-        data_response = requests.get(data_url, headers=headers)
+        data_response = sessions.get(data_url, headers=headers)
 
         # If a rate cap is encountered, return a result reporting this.
         if data_response.status_code == 429:
             query_result['rate_cap_encountered'] = True
 
+            retry_after = data_response.headers.get('Retry-After', '')
+
+            if retry_after.isdigit():
+                query_result['retry_after'] = int(retry_after)
+
             return query_result
 
         query_result['response_json'] = data_response.json()
@@ -98,10 +109,12 @@ class MovesSource(BaseSource):
         Result is a dict with the following keys:
             'all_data': data from all items, or None if rate cap hit.
             'rate_cap_encountered': None, or True if rate cap hit.
+            'retry_after': seconds Moves asked us to wait, if it did.
         """
         full_storyline_result = {
             'all_data': [],
             'rate_cap_encountered': None,
+            'retry_after': None,
         }
 
         current_year = int(datetime.utcnow().strftime('%Y'))
@@ -118,6 +131,8 @@ class MovesSource(BaseSource):
 
             if query_result['rate_cap_encountered']:
                 full_storyline_result['rate_cap_encountered'] = True
+                full_storyline_result['retry_after'] = (
+                    query_result['retry_after'])
                 return full_storyline_result
 
             week_data = query_result['response_json']
@@ -152,9 +167,14 @@ class MovesSource(BaseSource):
         full_storyline_result = self.get_full_storyline()
 
         if full_storyline_result['rate_cap_encountered']:
+            # Moves doesn't share its limits with us ahead of time, but says
+            # when to retry if it can.
+            if full_storyline_result['retry_after']:
+                countdown = full_storyline_result['retry_after']
             # If this is previously called and we got no new data this round,
             # double the wait period for resubmission.
-            if self.return_status and not full_storyline_result['all_data']:
+            elif (self.return_status and
+                  not full_storyline_result['all_data']):
                 countdown = 2 * self.return_status['countdown']
             else:
                 countdown = 60
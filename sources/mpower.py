@@ -17,6 +17,7 @@ import shutil
 import zipfile
 
 from base_source import BaseSource
+from data_retrieval.stream_validation import ZipValidator
 
 
 class MPowerSource(BaseSource):
@@ -25,38 +26,55 @@ class MPowerSource(BaseSource):
     """
 
     source = 'mpower'
+    cost_class = 'download'
 
-    def verify_mpower(self, input_filepath):
+    def verify_mpower(self, zip_files):
         """
-        Create clean file in mPower format from downloaded version
+        Verify that the files in a ZIP archive are mPower files.
         """
-        if input_filepath.endswith('.zip'):
-            zip_file = zipfile.ZipFile(input_filepath)
-            zip_files = self.filter_archive(zip_file)
-
-            for filename in zip_files:
-                if not filename.startswith('parkinson-'):
-                    self.sentry_log(
-                        'mPower file did not conform to expected format.')
-
-                    raise ValueError(
-                        'Found a filename that did not start with '
-                        '"parkinson-": "{}"'.format(filename))
-        else:
-            raise ValueError('Input file is expected to be a ZIP archive')
+        for filename in zip_files:
+            if not filename.startswith('parkinson-'):
+                self.sentry_log(
+                    'mPower file did not conform to expected format.')
+
+                raise ValueError(
+                    'Found a filename that did not start with '
+                    '"parkinson-": "{}"'.format(filename))
+
+    def coerce_file(self):
+        """
+        A file_url is copied straight through by create_files rather than
+        downloaded first.
+        """
+        if self.file_url and self.input_file:
+            raise Exception('Run with input_file or file_url, not both')
 
     def create_files(self):
-        self.verify_mpower(self.input_file)
+        metadata = {
+            'description': 'mPower data, original format',
+            'tags': ['mPower', 'CSV', 'JSON'],
+        }
+
+        if self.file_url:
+            self.passthrough_remote_file(
+                self.file_url,
+                lambda filename: ('mPower-Parkinsons.zip', metadata),
+                validator=ZipValidator(self.verify_mpower))
+
+            return
+
+        if not self.input_file.endswith('.zip'):
+            raise ValueError('Input file is expected to be a ZIP archive')
+
+        self.verify_mpower(
+            self.filter_archive(zipfile.ZipFile(self.input_file)))
 
         shutil.copyfile(self.input_file,
                         self.temp_join('mPower-Parkinsons.zip'))
 
         self.temp_files.append({
             'temp_filename': 'mPower-Parkinsons.zip',
-            'metadata': {
-                'description': 'mPower data, original format',
-                'tags': ['mPower', 'CSV', 'JSON'],
-            },
+            'metadata': metadata,
         })
 
 
@@ -29,18 +29,23 @@ import shutil
 
 import arrow
 import cgivar2gvcf
-import requests
-
 from bs4 import BeautifulSoup
 
 from base_source import BaseSource
+from data_retrieval import sessions
+from data_retrieval.bgzf import BgzfVCFWriter
+from data_retrieval.bz2_parallel import ParallelBZ2File
+from data_retrieval.stream_validation import PrefixValidator
 
 logger = logging.getLogger(__name__)
 
-BASE_URL = 'https://my.pgp-hms.org'
+# May be overridden to use a stand-in, such as the one in benchmarks.fake_api.
+BASE_URL = os.getenv('PGP_BASE_URL') or 'https://my.pgp-hms.org'
 
 REFRESH_DAYS = 180
 
+MASTERVARBETA_RE = r'^masterVarBeta-[^/]*.tsv.bz2'
+
 class PGPSource(BaseSource):
     """
     Create DataFiles for Open Humans from a PGP Harvard ID.
@@ -50,6 +55,7 @@ class PGPSource(BaseSource):
     """
 
     source = 'pgp'
+    cost_class = 'cpu'
 
     def __init__(self, *args, **kwargs):
         if 'hu_id' in kwargs:
@@ -197,7 +203,7 @@ class PGPSource(BaseSource):
                  parse_survey_div.
         """
         url = '{}/profile/{}'.format(BASE_URL, self.hu_id)
-        profile_page = requests.get(url)
+        profile_page = sessions.get(url)
 
         assert profile_page.status_code == 200
 
@@ -222,21 +228,30 @@ class PGPSource(BaseSource):
         reference, twobit_name = cgivar2gvcf.get_reference_genome_file(
             refseqdir=storage_dir, build='b37')
 
+        # cgivar2gvcf writes to a file object if given one; use that to
+        # compress .bz2 output in parallel, or to write BGZF and index it.
+        if self.vcf_format == 'bgzip':
+            output_file = BgzfVCFWriter(vcf_filepath)
+        elif vcf_filepath.endswith('.bz2'):
+            output_file = ParallelBZ2File(vcf_filepath)
+        else:
+            output_file = vcf_filepath
+
         # TODO: Mock this for performing tests. This is extremely slow.
         cgivar2gvcf.convert_to_file(
             cgi_input=var_filepath,
-            output_file=vcf_filepath,
+            output_file=output_file,
             twobit_ref=reference,
             twobit_name=twobit_name,
             var_only=True)
 
-        self.temp_files.append({
-            'temp_filename': vcf_filename,
-            'metadata': {
-                'description': ('PGP Harvard genome, VCF file. Derived from '
-                                'Complete Genomics var file.'),
-                'tags': ['vcf', 'genome', 'Complete Genomics'],
-            }
+        if not isinstance(output_file, basestring):
+            output_file.close()
+
+        self.add_vcf_temp_files(vcf_filename, output_file, {
+            'description': ('PGP Harvard genome, VCF file. Derived from '
+                            'Complete Genomics var file.'),
+            'tags': ['vcf', 'genome', 'Complete Genomics'],
         })
 
     def handle_var_file(self, filename, source):
@@ -270,16 +285,18 @@ class PGPSource(BaseSource):
 
         vcf_filename = re.sub(r'\.tsv', '.vcf', new_filename)
 
-        if not (vcf_filename.endswith('.gz') or vcf_filename.endswith('.bz2')):
+        if self.vcf_format == 'bgzip':
+            vcf_filename = re.sub(r'\.(gz|bz2)$', '', vcf_filename) + '.gz'
+        elif not (vcf_filename.endswith('.gz') or
+                  vcf_filename.endswith('.bz2')):
             vcf_filename += '.bz2'
 
         self.vcf_from_var(vcf_filename, var_filepath=new_filepath)
 
-    def handle_mastervarbeta_file(self, filename, source):
+    def mastervarbeta_target(self, filename, source):
         """
-        Rename masterVarBeta data file from PGP Harvard genome data.
-
-        Returns temp file info as array of dicts. Only one dict expected.
+        Return the filename and metadata to store a masterVarBeta data file
+        from PGP Harvard genome data as.
         """
         description = ('PGP Harvard genome, Complete Genomics masterVarBeta '
                        'file format.')
@@ -290,18 +307,27 @@ class PGPSource(BaseSource):
         elif filename.endswith('.gz'):
             new_filename += '.gz'
 
+        return new_filename, {
+            'description': description,
+            'tags': ['Complete Genomics', 'mastervarbeta', 'genome'],
+            'sourceURL': source,
+            'originalFilename': filename,
+        }
+
+    def handle_mastervarbeta_file(self, filename, source):
+        """
+        Rename masterVarBeta data file from PGP Harvard genome data.
+
+        Returns temp file info as array of dicts. Only one dict expected.
+        """
+        new_filename, metadata = self.mastervarbeta_target(filename, source)
         new_filepath = os.path.join(self.temp_directory, new_filename)
 
         shutil.move(os.path.join(self.temp_directory, filename), new_filepath)
 
         self.temp_files.append({
             'temp_filename': new_filename,
-            'metadata': {
-                'description': description,
-                'tags': ['Complete Genomics', 'mastervarbeta', 'genome'],
-                'sourceURL': source,
-                'originalFilename': filename,
-            },
+            'metadata': metadata,
         })
 
     def make_survey_file(self, survey_data, source):
@@ -312,7 +338,7 @@ class PGPSource(BaseSource):
         """
         description = 'PGP Harvard survey data, JSON format.'
         survey_filename = 'PGP-Harvard-{}-surveys.json'.format(self.hu_id)
-        survey_filepath = os.path.join(self.temp_directory, survey_filename)
+        survey_filepath = self.temp_join(survey_filename, small=True)
 
         with open(survey_filepath, 'w') as f:
             json.dump(survey_data, f, indent=2, sort_keys=True)
@@ -329,7 +355,7 @@ class PGPSource(BaseSource):
     def handle_uploaded_file(self, filename, source, **kwargs):
         if re.search(r'^var-[^/]*.tsv.bz2', filename):
             self.handle_var_file(filename, source, **kwargs)
-        elif re.search(r'^masterVarBeta-[^/]*.tsv.bz2', filename):
+        elif re.search(MASTERVARBETA_RE, filename):
             self.handle_mastervarbeta_file(filename, source, **kwargs)
         elif re.search(r'^GS00253-DNA[^/]*.tsv.bz2', filename):
             self.handle_var_file(filename, source, **kwargs)
@@ -349,6 +375,16 @@ class PGPSource(BaseSource):
             self.sentry_log('PGP Complete Genomics filename in '
                             'unexpected format: {}'.format(filename))
 
+    def passthrough_destination(self, filename, source):
+        """
+        masterVarBeta files are stored unchanged, so they're copied straight
+        through; other files need processing and are downloaded.
+        """
+        if re.search(MASTERVARBETA_RE, filename):
+            return self.mastervarbeta_target(filename, source)
+
+        return None
+
     def create_files(self):
         file_links, survey_data, profile_url = self.parse_pgp_profile_page()
 
@@ -363,6 +399,11 @@ class PGPSource(BaseSource):
                     continue
 
                 # TODO: Mock this for performing tests. This is slow.
-                filename = self.get_remote_file(item['link'])
-
-                self.handle_uploaded_file(filename, source=item['link'])
+                filename = self.passthrough_remote_file(
+                    item['link'],
+                    lambda filename: self.passthrough_destination(
+                        filename, item['link']),
+                    validator=PrefixValidator())
+
+                if filename:
+                    self.handle_uploaded_file(filename, source=item['link'])
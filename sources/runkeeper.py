@@ -24,9 +24,8 @@ import os
 
 from datetime import datetime, timedelta
 
-import requests
-
 from base_source import BaseSource
+from data_retrieval import sessions
 
 BACKGROUND_DATA_KEYS = ['timestamp', 'steps', 'calories_burned', 'source']
 FITNESS_SUMMARY_KEYS = ['type', 'equipment', 'start_time', 'utc_offset',
@@ -36,6 +35,11 @@ FITNESS_PATH_KEYS = ['latitude', 'longitude', 'altitude', 'timestamp', 'type']
 
 PAGESIZE = '10000'
 
+# The RunKeeper API; may be overridden to use a stand-in, such as the one in
+# benchmarks.fake_api.
+RUNKEEPER_API_URL = (os.getenv('RUNKEEPER_API_URL') or
+                     'https://api.runkeeper.com')
+
 
 def data_for_keys(data_dict, data_keys):
     """
@@ -78,6 +82,7 @@ class RunKeeperSource(BaseSource):
     """
 
     source = 'runkeeper'
+    cost_class = 'api'
 
     def runkeeper_query(self, path, content_type=None):
         """
@@ -88,9 +93,9 @@ class RunKeeperSource(BaseSource):
         if content_type:
             headers['Content-Type'] = content_type
 
-        data_url = 'https://api.runkeeper.com{}'.format(path)
+        data_url = '{}{}'.format(RUNKEEPER_API_URL, path)
 
-        data_response = requests.get(data_url, headers=headers)
+        data_response = sessions.get(data_url, headers=headers)
         data = data_response.json()
 
         return data
@@ -200,15 +205,12 @@ class RunKeeperSource(BaseSource):
             with open(filepath, 'w') as f:
                 json.dump(outdata, f, indent=2, sort_keys=True)
 
-            self.temp_files.append({
-                'temp_filename': filename,
-                'metadata': {
-                    'description': ('Runkeeper GPS maps and imported '
-                                    'activity data.'),
-                    'tags': ['GPS', 'Runkeeper'],
-                    'dataYear': year,
-                    'complete': year in all_completed_years,
-                }
+            self.add_temp_file(filename, {
+                'description': ('Runkeeper GPS maps and imported '
+                                'activity data.'),
+                'tags': ['GPS', 'Runkeeper'],
+                'dataYear': year,
+                'complete': year in all_completed_years,
             })
 
 
@@ -7,20 +7,25 @@ This software is shared under the "MIT License" license (aka "Expat License"),
 see LICENSE.TXT for full license text.
 """
 
-import bz2
 import logging
 import os
 import re
 import shutil
 import urlparse
 
-from cStringIO import StringIO
 from datetime import date, datetime
+from operator import attrgetter
 
 import arrow
-import bcrypt
 
 from base_source import BaseSource
+from data_retrieval.genotype_records import header_record, parse_23andme_line
+from data_retrieval.genotype_vcf import vcf_lines_from_calls
+from data_retrieval.orig_file_hash import (check_orig_file_hash,
+                                           make_orig_file_hash)
+from data_retrieval.reference_index import open_reference_index
+from data_retrieval.sort_vcf import sort_vcf_file
+from data_retrieval.streams import write_through
 
 logger = logging.getLogger(__name__)
 
@@ -60,18 +65,26 @@ def vcf_header(source=None, reference=None, format_info=None):
     return header
 
 
-def vcf_from_raw_23andme(raw_23andme):
-    output = StringIO()
-    reference = dict()
+def calls_from_raw_23andme(raw_23andme):
+    """
+    Generate genotype calls with explicit base calls from 23andMe records.
+    """
+    for record in raw_23andme:
+        # Skip header, uncalled and genotyping without explicit base calls
+        if not record.called:
+            continue
 
-    with open(REF_23ANDME_FILE) as f:
-        for line in f:
-            data = line.rstrip().split('\t')
+        yield (record.rsid, record.chrom,
+               'M' if record.chrom == 'MT' else record.chrom, record.pos,
+               record.alleles)
 
-            if data[0] not in reference:
-                reference[data[0]] = dict()
 
-            reference[data[0]][data[1]] = data[2]
+def vcf_from_raw_23andme(raw_23andme):
+    """
+    Generate VCF lines, header first, from an iterable of 23andMe
+    GenotypeRecords.
+    """
+    reference = open_reference_index(REF_23ANDME_FILE)
 
     header = vcf_header(
         source='open_humans_data_processing.twenty_three_and_me',
@@ -79,59 +92,11 @@ def vcf_from_raw_23andme(raw_23andme):
         format_info=['<ID=GT,Number=1,Type=String,Description="Genotype">'])
 
     for line in header:
-        output.write(line + '\n')
-
-    for line in raw_23andme:
-        # Skip header
-        if line.startswith('#'):
-            continue
-
-        data = line.rstrip().split('\t')
-
-        # Skip uncalled and genotyping without explicit base calls
-        if not re.match(r'^[ACGT]{1,2}$', data[3]):
-            continue
-        vcf_data = {x: '.' for x in VCF_FIELDS}
-
-        # Chromosome, position, dbSNP ID, reference. Skip if we don't have ref.
-        try:
-            vcf_data['REF'] = reference[data[1]][data[2]]
-        except KeyError:
-            continue
-
-        if data[1] == 'MT':
-            vcf_data['CHROM'] = 'M'
-        else:
-            vcf_data['CHROM'] = data[1]
-
-        vcf_data['POS'] = data[2]
-
-        if data[0].startswith('rs'):
-            vcf_data['ID'] = data[0]
+        yield line + '\n'
 
-        # Figure out the alternate alleles.
-        alt_alleles = []
-
-        for alle in data[3]:
-            if alle != vcf_data['REF'] and alle not in alt_alleles:
-                alt_alleles.append(alle)
-
-        if alt_alleles:
-            vcf_data['ALT'] = ','.join(alt_alleles)
-        else:
-            vcf_data['ALT'] = '.'
-            vcf_data['INFO'] = 'END=' + vcf_data['POS']
-
-        # Get allele-indexed genotype.
-        vcf_data['FORMAT'] = 'GT'
-        all_alleles = [vcf_data['REF']] + alt_alleles
-        genotype_indexed = '/'.join([str(all_alleles.index(x))
-                                     for x in data[3]])
-        vcf_data['23ANDME_DATA'] = genotype_indexed
-        output_line = '\t'.join([vcf_data[x] for x in VCF_FIELDS])
-        output.write(output_line + '\n')
-
-    return output
+    for lines in vcf_lines_from_calls(calls_from_raw_23andme(raw_23andme),
+                                      reference):
+        yield lines
 
 
 class TwentyThreeAndMeSource(BaseSource):
@@ -143,13 +108,16 @@ class TwentyThreeAndMeSource(BaseSource):
     """
 
     source = 'twenty_three_and_me'
+    cost_class = 'cpu'
 
     def clean_raw_23andme(self):
+        """
+        Generate GenotypeRecords for the cleaned lines of the input file,
+        reading it only once.
+        """
         input_file = self.open_archive()
 
-        output = StringIO()
-
-        dateline = input_file.next()
+        dateline = self.read_header_line(input_file)
 
         re_datetime_string = (r'([A-Z][a-z]{2} [A-Z][a-z]{2} [ 1-9][0-9] '
                               r'[0-9][0-9]:[0-9][0-9]:[0-9][0-9] 2[0-9]{3})')
@@ -164,9 +132,9 @@ class TwentyThreeAndMeSource(BaseSource):
             datetime_23andme = datetime.strptime(datetime_norm,
                                                  '%a %b %d %H:%M:%S %Y')
 
-            output.write('# This data file generated by 23andMe at: {}\r\n'
-                         .format(datetime_23andme.strftime(
-                             '%a %b %d %H:%M:%S %Y')))
+            yield header_record(
+                '# This data file generated by 23andMe at: {}\r\n'.format(
+                    datetime_23andme.strftime('%a %b %d %H:%M:%S %Y')))
 
         cwd = os.path.dirname(__file__)
 
@@ -177,21 +145,21 @@ class TwentyThreeAndMeSource(BaseSource):
 
         header_lines = ''
 
-        next_line = input_file.next()
+        next_line = self.read_header_line(input_file)
 
         while next_line.startswith('#'):
             header_lines += next_line
 
-            next_line = input_file.next()
+            next_line = self.read_header_line(input_file)
 
         if (header_lines.splitlines() == header_v1.splitlines() or
                 header_lines.splitlines() == header_v2.splitlines()):
-            output.write(header_lines)
+            yield header_record(header_lines)
         elif (header_lines.splitlines()[:13] == header_v3_p1.splitlines() and
               header_lines.splitlines()[-5:] == header_v3_p2.splitlines()):
-            output.write(header_v3_p1)
-            output.write('# [URL REDACTED]\n')
-            output.write(header_v3_p2)
+            yield header_record(header_v3_p1)
+            yield header_record('# [URL REDACTED]\n')
+            yield header_record(header_v3_p2)
         else:
             self.sentry_log(
                 '23andMe header did not conform to expected format.')
@@ -199,8 +167,10 @@ class TwentyThreeAndMeSource(BaseSource):
         bad_format = False
 
         while next_line:
-            if re.match(r'(rs|i)[0-9]+\t[1-9XYM][0-9T]?\t[0-9]+\t[ACGT\-ID][ACGT\-ID]?', next_line):
-                output.write(next_line)
+            record = parse_23andme_line(next_line)
+
+            if record:
+                yield record
             else:
                 # Only report this type of format issue once.
                 if not bad_format:
@@ -216,8 +186,6 @@ class TwentyThreeAndMeSource(BaseSource):
         if bad_format:
             self.sentry_log('23andMe body did not conform to expected format.')
 
-        return output
-
     def should_update(self, files):
         """
         Reprocess only if source file has changed.
@@ -252,9 +220,9 @@ class TwentyThreeAndMeSource(BaseSource):
         """
         if not self.file_url:
             return False
-        url_path = str(urlparse.urlparse(self.file_url).path)
-        new_hash = bcrypt.hashpw(url_path, str(orig_file_hash))
-        return orig_file_hash == new_hash
+        url_path = urlparse.urlparse(self.file_url).path
+        return check_orig_file_hash(orig_file_hash, url_path,
+                                    persist=not self.local)
 
     def create_files(self):
         """
@@ -270,47 +238,45 @@ class TwentyThreeAndMeSource(BaseSource):
         new_hash = ''
         if self.file_url:
             orig_path = urlparse.urlparse(self.file_url).path
-            new_hash = bcrypt.hashpw(str(orig_path), bcrypt.gensalt())
+            new_hash = make_orig_file_hash(orig_path)
 
         filename_base = '23andMe-genotyping'
 
-        raw_23andme = self.clean_raw_23andme()
-        raw_23andme.seek(0)
-        vcf_23andme = vcf_from_raw_23andme(raw_23andme)
-
-        # Save raw 23andMe genotyping to temp file.
         raw_filename = filename_base + '.txt'
+        vcf_filename, vcf_file = self.open_vcf(filename_base)
+
+        # Save raw and VCF 23andMe genotyping to temp files in one pass.
+        with open(self.temp_join(raw_filename), 'w') as raw_file, vcf_file:
+            raw_23andme = write_through(self.clean_raw_23andme(), raw_file,
+                                        key=attrgetter('line'))
+
+            vcf_lines = vcf_from_raw_23andme(raw_23andme)
 
-        with open(self.temp_join(raw_filename), 'w') as raw_file:
-            raw_23andme.seek(0)
-
-            shutil.copyfileobj(raw_23andme, raw_file)
-
-            self.temp_files.append({
-                'temp_filename': raw_filename,
-                'metadata': {
-                    'description':
-                        '23andMe full genotyping data, original format',
-                    'tags': ['23andMe', 'genotyping'],
-                    'orig_file_hash': new_hash,
-                    'creation_date': arrow.get().format(),
-                },
-            })
-
-        # Save VCF 23andMe genotyping to temp file.
-        vcf_filename = filename_base + '.vcf.bz2'
-
-        with bz2.BZ2File(self.temp_join(vcf_filename), 'w') as vcf_file:
-            vcf_23andme.seek(0)
-
-            shutil.copyfileobj(vcf_23andme, vcf_file)
-
-            self.temp_files.append({
-                'temp_filename': vcf_filename,
-                'metadata': {
-                    'description': '23andMe full genotyping data, VCF format',
-                    'tags': ['23andMe', 'genotyping', 'vcf'],
-                    'orig_file_hash': new_hash,
-                    'creation_date': arrow.get().format(),
-                },
-            })
+            # A tabix index needs sorted records; 23andMe files are expected
+            # to be in order, but make sure.
+            if self.vcf_format == 'bgzip':
+                unsorted_path = self.temp_join(filename_base + '.unsorted.vcf')
+
+                with open(unsorted_path, 'w') as vcf_23andme_unsorted:
+                    vcf_23andme_unsorted.writelines(vcf_lines)
+
+                shutil.copyfileobj(sort_vcf_file(
+                    unsorted_path, directory=self.temp_directory), vcf_file)
+
+                os.remove(unsorted_path)
+            else:
+                vcf_file.writelines(vcf_lines)
+
+        self.add_temp_file(raw_filename, {
+            'description': '23andMe full genotyping data, original format',
+            'tags': ['23andMe', 'genotyping'],
+            'orig_file_hash': new_hash,
+            'creation_date': arrow.get().format(),
+        })
+
+        self.add_vcf_temp_files(vcf_filename, vcf_file, {
+            'description': '23andMe full genotyping data, VCF format',
+            'tags': ['23andMe', 'genotyping', 'vcf'],
+            'orig_file_hash': new_hash,
+            'creation_date': arrow.get().format(),
+        })
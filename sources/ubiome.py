@@ -7,13 +7,12 @@ This software is shared under the "MIT License" license (aka "Expat License"),
 see LICENSE.TXT for full license text.
 """
 
-import os
 import shutil
-import zipfile
 
 from cStringIO import StringIO
 
 from base_source import BaseSource
+from data_retrieval.stream_validation import ZipValidator
 
 
 class UBiomeSource(BaseSource):
@@ -25,39 +24,26 @@ class UBiomeSource(BaseSource):
     """
 
     source = 'ubiome'
+    cost_class = 'download'
 
-    def verify_ubiome(self, input_filepath):
+    def verify_ubiome(self, zip_files):
         """
-        Verify that this is a uBiome file.
+        Verify that the files in a ZIP archive are uBiome files.
         """
-        if input_filepath.endswith('.zip'):
-            zip_file = zipfile.ZipFile(input_filepath)
-            zip_files = self.filter_archive(zip_file)
+        for filename in zip_files:
+            if not filename.endswith('.fastq.gz'):
+                self.sentry_log(
+                    'uBiome file did not conform to expected format.')
 
-            for filename in zip_files:
-                if not filename.endswith('.fastq.gz'):
-                    self.sentry_log(
-                        'uBiome file did not conform to expected format.')
-
-                    raise ValueError(
-                        'Found a filename that did not end with ".fastq.gz": '
-                        '"{}"'.format(filename))
-        else:
-            raise ValueError('Input file is expected to be a ZIP archive')
+                raise ValueError(
+                    'Found a filename that did not end with ".fastq.gz": '
+                    '"{}"'.format(filename))
 
     def create_files(self):
         for sample in enumerate(self.samples):
-            filename = self.get_remote_file(sample[1]['sequence_file']['url'])
-            input_file = self.temp_join(filename)
-
-            self.verify_ubiome(input_file)
-
             fastq_filename = 'uBiome-fastq{}.zip'.format(
                 '-' + str(sample[0] + 1) if len(self.samples) > 1 else '')
 
-            shutil.move(input_file,
-                        os.path.join(self.temp_directory, fastq_filename))
-
             metadata = {
                 'description': 'uBiome 16S FASTQ raw sequencing data.',
                 'tags': ['fastq', 'uBiome', '16S']
@@ -66,10 +52,12 @@ class UBiomeSource(BaseSource):
             if sample[1]['additional_notes']:
                 metadata['user_notes'] = sample[1]['additional_notes']
 
-            self.temp_files.append({
-                'temp_filename': fastq_filename,
-                'metadata': metadata,
-            })
+            # Copied straight through, checking the ZIP archive's contents as
+            # it's streamed.
+            self.passthrough_remote_file(
+                sample[1]['sequence_file']['url'],
+                lambda filename: (fastq_filename, metadata),
+                validator=ZipValidator(self.verify_ubiome))
 
             taxonomy = StringIO(sample[1]['taxonomy'])
             taxonomy_filename = 'taxonomy{}.json'.format(
@@ -77,8 +65,7 @@ class UBiomeSource(BaseSource):
 
             shutil.copyfileobj(
                 taxonomy,
-                file(os.path.join(self.temp_directory, taxonomy_filename),
-                     'w'))
+                file(self.temp_join(taxonomy_filename, small=True), 'w'))
 
             metadata = {
                 'description': 'uBiome 16S taxonomy data, JSON format.',
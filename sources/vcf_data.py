@@ -6,12 +6,24 @@ Copyright (C) 2016 PersonalGenomes.org
 This software is shared under the "MIT License" license (aka "Expat License"),
 see LICENSE.TXT for full license text.
 """
-import bz2
 import json
+import logging
 import os
-import vcf
+import re
+import shutil
+
+from multiprocessing.pool import ThreadPool
 
 from base_source import BaseSource
+from data_retrieval.bgzf import BgzfVCFWriter
+from data_retrieval.decompress import decompressed_chunks
+from data_retrieval.sort_vcf import sort_vcf_file
+from data_retrieval.vcf_stream import VCFStreamVerifier
+
+logger = logging.getLogger(__name__)
+
+# vcf_data items downloaded and verified at once.
+DOWNLOAD_THREADS = 4
 
 
 class VCFDataSource(BaseSource):
@@ -23,43 +35,145 @@ class VCFDataSource(BaseSource):
     """
 
     source = 'vcf_data'
+    cost_class = 'download'
+
+    def get_verified_vcf(self, vcf_data_item, directory):
+        """
+        Download the VCF file of a vcf_data item into a directory of its own,
+        verifying it as it arrives. Return the filename used and the VCF
+        header metadata.
+
+        Items are downloaded at the same time, and two may have files with
+        the same name, so each needs its own directory.
+        """
+        verifier = VCFStreamVerifier()
+        filename = self.get_remote_file(vcf_data_item['vcf_file']['url'],
+                                        verifier=verifier,
+                                        directory=directory)
+
+        return filename, verifier.metadata
+
+    def claim_download(self, directory, filename):
+        """
+        Move a downloaded file into the temporary directory, renaming it if
+        an earlier item's file has the same name. Return the filename used.
+        """
+        base, extension = re.match(r'(.*?)((?:\.vcf)?(?:\.gz|\.bz2)?)$',
+                                   filename).groups()
+        target = filename
+        number = 1
 
-    @staticmethod
-    def verify_vcf(input_file):
+        while os.path.exists(self.temp_join(target)):
+            number += 1
+            target = '{}-{}{}'.format(base, number, extension)
+
+        os.rename(os.path.join(directory, filename), self.temp_join(target))
+        os.rmdir(directory)
+
+        return target
+
+    def bgzip_vcf(self, filename):
         """
-        Verify that this is a VCF file.
+        Re-encode an uploaded VCF file as BGZF with a tabix index, replacing
+        the original. Return the new filename and the closed writer.
+
+        A file that can't be indexed as uploaded (usually because it isn't in
+        order) is sorted, and the sorted copy used if it can be indexed and
+        keeps every record.
         """
-        if input_file.endswith('.vcf.gz'):
-            input_vcf = vcf.Reader(filename=input_file, compressed=True)
-        elif input_file.endswith('.vcf.bz2'):
-            vcf_file = bz2.BZ2File(input_file)
-            input_vcf = vcf.Reader(vcf_file)
-        elif input_file.endswith('.vcf'):
-            input_vcf = vcf.Reader(filename=input_file)
-        else:
-            raise ValueError("Input filename doesn't match .vcf, .vcf.gz, "
-                             'or .vcf.bz2')
-
-        # Check that it can advance one record without error.
-        input_vcf.next()
-
-        return input_vcf.metadata
+        original_file = self.temp_join(filename + '.original')
+        os.rename(self.temp_join(filename), original_file)
+
+        bgzf_filename = re.sub(r'\.(gz|bz2)$', '', filename) + '.gz'
+
+        with BgzfVCFWriter(self.temp_join(bgzf_filename)) as vcf_file:
+            for chunk in decompressed_chunks(original_file):
+                vcf_file.write(chunk)
+
+        if vcf_file.index_filename is None:
+            vcf_file = self.sort_bgzf_vcf(original_file, vcf_file)
+
+        os.remove(original_file)
+
+        return bgzf_filename, vcf_file
+
+    def sort_bgzf_vcf(self, original_file, vcf_file):
+        """
+        Sort an uploaded VCF file into a BGZF file with a tabix index, and
+        return its writer to use in place of vcf_file if nothing was lost.
+        Large files are sorted per chromosome in parallel; see
+        data_retrieval.sort_vcf.
+        """
+        logger.info('vcf_data: sorting "%s" to index it', vcf_file.name)
+
+        sorted_file = BgzfVCFWriter(vcf_file.name + '.sorted.gz')
+
+        with sorted_file:
+            shutil.copyfileobj(sort_vcf_file(
+                original_file, directory=self.temp_directory), sorted_file)
+
+        # Sorting drops records on contigs it doesn't know.
+        if (sorted_file.index_filename is None or
+                sorted_file.lines_written != vcf_file.lines_written):
+            logger.info('vcf_data: not using sorted copy of "%s"',
+                        vcf_file.name)
+
+            os.remove(sorted_file.name)
+
+            if sorted_file.index_filename:
+                os.remove(sorted_file.index_filename)
+
+            return vcf_file
+
+        os.rename(sorted_file.name, vcf_file.name)
+        os.rename(sorted_file.index_filename, vcf_file.name + '.tbi')
+
+        sorted_file.name = vcf_file.name
+        sorted_file.index_filename = vcf_file.name + '.tbi'
+
+        return sorted_file
 
     def create_files(self):
-        for vcf_data_item in self.vcf_data:
-            filename = self.get_remote_file(vcf_data_item['vcf_file']['url'])
-            input_file = os.path.join(self.temp_directory, filename)
+        # Download and verify the files concurrently, then handle them in
+        # order.
+        pool = ThreadPool(max(1, min(DOWNLOAD_THREADS, len(self.vcf_data))))
+
+        try:
+            self.handle_downloads(pool)
+        finally:
+            pool.close()
+            pool.join()
 
+    def handle_downloads(self, pool):
+        """
+        Download the items' files in pool, each into its own directory, and
+        handle them in order as they finish.
+        """
+        directories = [self.temp_join('download-{}'.format(i))
+                       for i in range(len(self.vcf_data))]
+
+        for directory in directories:
+            os.mkdir(directory)
+
+        downloads = [pool.apply_async(self.get_verified_vcf,
+                                      (vcf_data_item, directory))
+                     for vcf_data_item, directory
+                     in zip(self.vcf_data, directories)]
+
+        for vcf_data_item, directory, download in zip(
+                self.vcf_data, directories, downloads):
             try:
-                header_data = self.verify_vcf(input_file)
+                filename, header_data = download.get()
             except Exception as e:
                 self.sentry_log(
                     'vcf_data: error in processing! File URL: {0}, '
-                    'Error: "{2}"'.format(
+                    'Error: "{1}"'.format(
                         vcf_data_item['vcf_file']['url'], e))
 
                 continue
 
+            filename = self.claim_download(directory, filename)
+
             metadata = {
                 'description': 'User-contributed VCF data',
                 'tags': ['vcf'],
@@ -69,10 +183,15 @@ class VCFDataSource(BaseSource):
             if vcf_data_item['additional_notes']:
                 metadata['user_notes'] = vcf_data_item['additional_notes']
 
-            self.temp_files.append({
-                'temp_filename': filename,
-                'metadata': metadata,
-            })
+            if self.vcf_format == 'bgzip':
+                filename, vcf_file = self.bgzip_vcf(filename)
+
+                self.add_vcf_temp_files(filename, vcf_file, metadata)
+            else:
+                self.temp_files.append({
+                    'temp_filename': filename,
+                    'metadata': metadata,
+                })
 
             # Create metadata file.
             base_filename = filename
@@ -83,8 +202,7 @@ class VCFDataSource(BaseSource):
                 base_filename = filename[0:-4]
 
             metadata_filename = base_filename + '.metadata.json'
-            metadata_filepath = os.path.join(self.temp_directory,
-                                             metadata_filename)
+            metadata_filepath = self.temp_join(metadata_filename, small=True)
 
             with open(metadata_filepath, 'w') as f:
                 json.dump(header_data, f)
@@ -24,6 +24,7 @@ class WildlifeSource(BaseSource):
     """
 
     source = 'wildlife'
+    cost_class = 'cpu'
 
     def create_files(self):
         for filename in self.files:
@@ -33,13 +34,10 @@ class WildlifeSource(BaseSource):
             base_tags = ['Wild Life of Our Homes']
 
             if re.search('home-data-', filename):
-                self.temp_files.append({
-                    'temp_filename': filename,
-                    'metadata': {
-                        'description': ('Geographical and architectural '
-                                        'information about residence'),
-                        'tags': ['survey', 'location'] + base_tags,
-                    }
+                self.add_temp_file(filename, {
+                    'description': ('Geographical and architectural '
+                                    'information about residence'),
+                    'tags': ['survey', 'location'] + base_tags,
                 })
             elif (re.search('fungi-kit-', filename) or
                   re.search('bacteria-kit-', filename)):
@@ -68,18 +66,12 @@ class WildlifeSource(BaseSource):
 
                 visualization.make_pie_charts(counts, vis_filepath)
 
-                self.temp_files.append({
-                    'temp_filename': filename,
-                    'metadata': {
-                        'description': data_descr,
-                        'tags': data_tags,
-                    }
+                self.add_temp_file(filename, {
+                    'description': data_descr,
+                    'tags': data_tags,
                 })
 
-                self.temp_files.append({
-                    'temp_filename': vis_filename,
-                    'metadata': {
-                        'description': vis_descr,
-                        'tags': vis_tags,
-                    }
+                self.add_temp_file(vis_filename, {
+                    'description': vis_descr,
+                    'tags': vis_tags,
                 })